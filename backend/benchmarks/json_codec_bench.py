@@ -0,0 +1,185 @@
+"""
+JSON 编解码微基准：一次 Agent 迭代中与上下文大小相关的序列化开销
+
+模拟 150k token 上下文（中英混合对话 + 大型工具结果），对比：
+- 标准库（httpx json= 的等价写法）与 core.json_codec（orjson 可用时）的请求体序列化
+- 非流式响应 / SSE 帧解析
+- 工具结果序列化与解析
+- 响应对象构造（动态 type() 的 Function 与 __slots__ 版本）
+- 消息片段缓存：历史消息已编码时，请求体只需编码本轮新增消息再拼接
+
+用法（在 backend 目录）：
+    python -m benchmarks.json_codec_bench [--tokens 150000] [--rounds 20]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from typing import Any, Callable, Dict, List
+
+from core import json_codec
+from core.httpx_openai_adapter import ChatCompletion, ChatCompletionChunk, ToolCall
+from core.tokenizer import token_counter
+
+
+def _stdlib_body(payload: Dict[str, Any]) -> bytes:
+    # 与 httpx 的 json= 参数一致
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), allow_nan=False).encode("utf-8")
+
+
+def build_context(target_tokens: int) -> List[Dict[str, Any]]:
+    """构造接近目标 token 数的上下文：用户/助手往返 + 工具调用 + 大型工具结果"""
+    messages: List[Dict[str, Any]] = [{"role": "system", "content": "你是七海，一个乐于助人的AI助手。" * 40}]
+    i = 0
+    while token_counter.count_messages(messages) < target_tokens:
+        call_id = f"call_{i}"
+        messages.append({"role": "user", "content": f"第{i}轮：请帮我搜索 Python asyncio 的最佳实践，并总结要点。" * 3})
+        messages.append({
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{
+                "id": call_id,
+                "type": "function",
+                "function": {"name": "tavily_search", "arguments": json.dumps({"query": f"asyncio best practices {i}"})},
+            }],
+        })
+        messages.append({
+            "role": "tool",
+            "tool_call_id": call_id,
+            "name": "tavily_search",
+            "content": json.dumps({
+                "error": False,
+                "data": {
+                    "results": [
+                        {
+                            "title": f"Result {k}: asyncio 任务调度与取消",
+                            "url": f"https://example.com/{i}/{k}",
+                            "content": ("Use asyncio.TaskGroup for structured concurrency; 避免在协程中调用阻塞IO。" * 6),
+                            "score": 0.9 - k * 0.01,
+                        }
+                        for k in range(5)
+                    ],
+                },
+            }, ensure_ascii=False),
+        })
+        messages.append({"role": "assistant", "content": "总结：" + "使用 TaskGroup、超时控制与取消传播。" * 20})
+        i += 1
+    return messages
+
+
+def build_response() -> bytes:
+    return json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "bench",
+        "choices": [{
+            "index": 0,
+            "finish_reason": "tool_calls",
+            "message": {
+                "role": "assistant",
+                "content": "我来并行执行这几个任务。",
+                "tool_calls": [
+                    {"id": f"call_{k}", "type": "function",
+                     "function": {"name": "tavily_search", "arguments": json.dumps({"query": f"q{k}"})}}
+                    for k in range(4)
+                ],
+            },
+        }],
+        "usage": {"prompt_tokens": 150000, "completion_tokens": 200, "total_tokens": 150200},
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def build_sse_frames(count: int = 400) -> List[str]:
+    return [
+        json.dumps({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "model": "bench",
+            "choices": [{"index": 0, "delta": {"content": "七海正在思考"}, "finish_reason": None}],
+        }, ensure_ascii=False)
+        for _ in range(count)
+    ]
+
+
+class _LegacyToolCall:
+    """改造前的 ToolCall：每次构造都动态创建一个 Function 类"""
+
+    def __init__(self, data: Dict[str, Any]):
+        self.id = data.get("id", "")
+        self.type = data.get("type", "function")
+        self.function = type('Function', (), {
+            'name': data.get("function", {}).get("name", ""),
+            'arguments': data.get("function", {}).get("arguments", "{}")
+        })()
+
+
+def cpu_ms(func: Callable[[], Any], rounds: int) -> float:
+    """每次调用的平均 CPU 时间（毫秒）"""
+    func()
+    start = time.process_time()
+    for _ in range(rounds):
+        func()
+    return (time.process_time() - start) * 1000 / rounds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=150_000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    messages = build_context(args.tokens)
+    payload = {"model": "bench", "messages": messages, "temperature": 0.2, "stream": True}
+    body = _stdlib_body(payload)
+    response = build_response()
+    frames = build_sse_frames()
+    tool_result = json.loads(messages[3]["content"])
+    tool_result_str = messages[3]["content"]
+    tool_call_data = json.loads(response)["choices"][0]["message"]["tool_calls"]
+
+    print(f"上下文: {len(messages)} 条消息, ~{token_counter.count_messages(messages)} tokens, 请求体 {len(body) / 1024:.0f} KB")
+    print(f"json_codec 后端: {json_codec.BACKEND}\n")
+
+    # 片段缓存：历史消息已在加入上下文时编码，本轮只新增一对 assistant/tool 消息
+    fragments = json_codec.MessageFragmentCache()
+    for message in messages:
+        fragments.encode(message)
+
+    def spliced_body() -> bytes:
+        new_messages = [dict(m) for m in messages[-2:]]
+        return json_codec.dumps_payload({**payload, "messages": messages[:-2] + new_messages}, fragments)
+
+    assert json.loads(spliced_body()) == json.loads(body)
+
+    rows = [
+        ("请求体序列化", lambda: _stdlib_body(payload), spliced_body, 1),
+        ("请求体(全量codec)", lambda: _stdlib_body(payload), lambda: json_codec.dumps_bytes(payload), 0),
+        ("上下文解析(会话加载)", lambda: json.loads(body), lambda: json_codec.loads(body), 0),
+        ("非流式响应解析", lambda: ChatCompletion(json.loads(response)),
+         lambda: ChatCompletion(json_codec.loads(response)), 1),
+        ("SSE帧解析 x400", lambda: [ChatCompletionChunk(json.loads(f)) for f in frames],
+         lambda: [ChatCompletionChunk(json_codec.loads(f)) for f in frames], 1),
+        ("工具结果序列化+解析 x4", lambda: [json.loads(json.dumps(tool_result, ensure_ascii=False)) for _ in range(4)],
+         lambda: [json_codec.loads(json_codec.dumps(tool_result)) for _ in range(4)], 1),
+        ("工具结果截断重复解析 x4", lambda: [json.loads(tool_result_str) for _ in range(4)], lambda: None, 1),
+        ("ToolCall构造 x4", lambda: [_LegacyToolCall(tc) for tc in tool_call_data],
+         lambda: [ToolCall(tc) for tc in tool_call_data], 1),
+    ]
+
+    print(f"{'项目':<24}{'标准库 ms':>12}{'codec ms':>12}{'加速':>8}")
+    saved = 0.0
+    for name, before, after, per_iteration in rows:
+        before_ms = cpu_ms(before, args.rounds)
+        after_ms = cpu_ms(after, args.rounds)
+        speedup = f"{before_ms / after_ms:.1f}x" if after_ms > 0 else "-"
+        print(f"{name:<24}{before_ms:>12.2f}{after_ms:>12.2f}{speedup:>8}")
+        if per_iteration:
+            saved += before_ms - after_ms
+
+    print(f"\n每轮迭代节省 CPU ≈ {saved:.1f} ms（请求体序列化 + 响应/SSE解析 + 工具结果编解码）")
+
+
+if __name__ == "__main__":
+    main()
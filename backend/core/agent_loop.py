@@ -7,12 +7,16 @@ Agent 核心循环（含记忆、压缩、工具调用、长期记忆提炼）
 """
 from __future__ import annotations
 
-import json
+import asyncio
+import contextlib
 from typing import Any, AsyncGenerator, Dict, List, Optional
 
+from core import json_codec
 from core.model_manager import model_manager
-from core.memory import MemoryManager
-from core.prompts import get_system_message
+from core.memory import MemoryManager, forget_messages
+from core.prompts import get_system_message, get_volatile_message, retire_volatile_message
+from core.session_cache import session_cache
+from services.usage_ledger import bind_usage_context
 from core.ltm import LTMMarkdown, ltm_md_enabled
 from services.file_store import (
     get_file_content_by_id,
@@ -20,10 +24,14 @@ from services.file_store import (
     get_image_as_base64,
     is_image_file
 )
-from tools.manager import tool_manager
+from tools.manager import ToolCallDispatcher, tool_manager
 
 
-def _truncate_large_tool_result(tool_result: Dict[str, Any]) -> Dict[str, Any]:
+# 标记“调用方尚未解析工具结果”
+_UNPARSED = object()
+
+
+def _truncate_large_tool_result(tool_result: Dict[str, Any], content_data: Any = _UNPARSED) -> Dict[str, Any]:
     """截断大型工具结果，避免上下文爆炸
 
     策略：
@@ -53,10 +61,13 @@ def _truncate_large_tool_result(tool_result: Dict[str, Any]) -> Dict[str, Any]:
     if len(content_str) <= max_size:
         return tool_result
 
-    # 尝试解析JSON
+    # 尝试解析JSON（调用方已解析过时直接复用，避免大结果重复解析）
     try:
-        content_data = json.loads(content_str)
-    except json.JSONDecodeError:
+        if content_data is _UNPARSED:
+            content_data = json_codec.loads(content_str)
+        elif content_data is None:
+            raise json_codec.JSONDecodeError("not json", content_str, 0)
+    except json_codec.JSONDecodeError:
         # 不是JSON，直接截断文本
         truncated_content = content_str[:max_size] + f"\n\n[... 内容过长，已截断 {len(content_str)} 字符中的 {len(content_str) - max_size} 字符]"
         return {
@@ -128,7 +139,7 @@ def _truncate_large_tool_result(tool_result: Dict[str, Any]) -> Dict[str, Any]:
             # 重新序列化
             return {
                 **tool_result,
-                "content": json.dumps(content_data, ensure_ascii=False)
+                "content": json_codec.dumps(content_data)
             }
 
     # 如果没有特殊处理，但内容仍然很大，直接截断JSON
@@ -149,7 +160,7 @@ async def _process_subagent_report(
 
     Args:
         tool_result: SubAgent工具返回结果
-        next_round_images: 图片列表（会被修改，添加artifacts中的图片）
+        next_round_images: 图片列表（会被修改，添加artifacts中的图片，元素为 {"file_id", "url", "caption"}）
 
     Returns:
         {
@@ -163,7 +174,7 @@ async def _process_subagent_report(
     try:
         # 解析SubAgent报告
         content_str = tool_result.get("content", "{}")
-        report = json.loads(content_str)
+        report = json_codec.loads(content_str)
 
         # 提取报告字段
         if isinstance(report, dict) and not report.get("error", False):
@@ -182,10 +193,9 @@ async def _process_subagent_report(
                     image_data = get_image_as_base64(artifact_id)
                     if image_data:
                         next_round_images.append({
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_data["url"]
-                            }
+                            "file_id": artifact_id,
+                            "url": image_data["url"],
+                            "caption": f"{subagent_name} 返回的截图",
                         })
                         logger.info(f"📸 SubAgent返回截图 file_id: {artifact_id}，将在下一轮注入")
 
@@ -208,7 +218,7 @@ async def _process_subagent_report(
                 "tool_call_id": tool_result.get("tool_call_id"),
                 "role": "tool",
                 "name": tool_result.get("name"),
-                "content": json.dumps({
+                "content": json_codec.dumps({
                     "error": False,
                     "data": {
                         "subagent": subagent_name,
@@ -218,7 +228,7 @@ async def _process_subagent_report(
                         "todos_status": f"{todos_completed}/{todos_total}",
                         "iterations": iterations
                     }
-                }, ensure_ascii=False)
+                })
             }
 
             return {
@@ -235,10 +245,10 @@ async def _process_subagent_report(
                 "tool_call_id": tool_result.get("tool_call_id"),
                 "role": "tool",
                 "name": tool_result.get("name"),
-                "content": json.dumps({
+                "content": json_codec.dumps({
                     "error": True,
                     "message": error_message
-                }, ensure_ascii=False)
+                })
             }
 
             return {
@@ -255,6 +265,162 @@ async def _process_subagent_report(
         }
 
 
+def _image_caption(tool_name: str, data: Dict[str, Any]) -> str:
+    """图片的一句话说明（老化为 file_id 引用后提示模型这是什么图）"""
+    source = data.get("url") or data.get("title") or data.get("window_title")
+    caption = f"{tool_name} 的截图"
+    if source:
+        caption += f"（{str(source)[:80]}）"
+    return caption
+
+
+def _is_subagent_report(tool_name: str, result_content: Any) -> bool:
+    """是否为SubAgent报告：*_subagent 同步执行的结果，或 subagent_job 取回的已结束作业
+
+    后台作业的提交回执与进行中状态（带 "job" 且未结束）按普通工具结果处理
+    """
+    from core.subagent_jobs import FINISHED_STATUSES
+
+    job = result_content.get("job") if isinstance(result_content, dict) else None
+    if tool_name == "subagent_job":
+        return isinstance(job, dict) and job.get("status") in FINISHED_STATUSES
+    return tool_name.endswith("_subagent") and not isinstance(job, dict)
+
+
+async def _process_tool_result(
+    tool_result: Dict[str, Any],
+    next_round_images: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+    """处理单个工具结果
+
+    Args:
+        tool_result: 工具返回的 role=tool 消息
+        next_round_images: 图片列表（会被修改，添加工具返回的截图，元素为 {"file_id", "url", "caption"}）
+
+    Returns:
+        {
+            "memory_message": {...},  # 注入到记忆的消息（已截断/压缩）
+            "user_message": "...",    # 展示给用户的内容
+            "error": bool             # 工具是否执行失败
+        }
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+
+    tool_name = tool_result.get("name") or "unknown"
+
+    # 结果只解析一次，SubAgent报告识别、截断与file_id检测共用
+    try:
+        result_content = json_codec.loads(tool_result.get("content") or "{}")
+    except json_codec.JSONDecodeError:
+        result_content = None
+
+    # 🔑 核心优化：检测SubAgent报告并特殊处理
+    if _is_subagent_report(tool_name, result_content):
+        report = await _process_subagent_report(tool_result, next_round_images)
+        try:
+            error = bool(json_codec.loads(report["memory_message"].get("content") or "{}").get("error"))
+        except Exception:
+            error = False
+        return {**report, "error": error}
+
+    # 普通工具：截断大型结果，检测截图file_id
+    truncated_result = _truncate_large_tool_result(tool_result, result_content)
+
+    # 检查file_id，如果是图片则准备注入
+    try:
+        if isinstance(result_content, dict) and not result_content.get("error", False):
+            data = result_content.get("data", {})
+            if isinstance(data, dict) and "file_id" in data:
+                fid = data["file_id"]
+                file_path = get_file_path_by_id(fid)
+
+                if file_path and is_image_file(file_path):
+                    image_data = get_image_as_base64(fid)
+                    if image_data:
+                        next_round_images.append({
+                            "file_id": fid,
+                            "url": image_data["url"],
+                            "caption": _image_caption(tool_name, data),
+                        })
+                        logger.info(f"📸 检测到截图 file_id: {fid}，将在下一轮注入到对话中")
+    except Exception as e:
+        logger.debug(f"解析工具结果时出错（可忽略）: {e}")
+
+    return {
+        "memory_message": truncated_result,
+        "user_message": tool_result.get("content", ""),
+        "error": isinstance(result_content, dict) and bool(result_content.get("error")),
+    }
+
+
+async def _execute_tool_calls(
+    memory: MemoryManager,
+    dispatcher: ToolCallDispatcher,
+    tool_call_dicts: List[Dict[str, Any]],
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """执行一批工具调用：按完成顺序推送进度与结果，全部完成后按调用顺序写入记忆并注入截图"""
+    import logging
+    logger = logging.getLogger(__name__)
+
+    # 按完成顺序推送：每个工具一结束就把结果发给前端（快的工具不必等慢的SubAgent），
+    # 写入记忆时仍按模型给出的调用顺序
+    processed: List[Optional[Dict[str, Any]]] = [None] * len(tool_call_dicts)
+    images_by_index: Dict[int, List[Dict[str, Any]]] = {}
+
+    async for event in dispatcher.stream(tool_call_dicts):
+        progress = {"call_id": event["id"], "tool": event["tool"], "index": event["index"]}
+        if event["event"] == "start":
+            yield {"type": "tool_progress", "data": {**progress, "status": "running"}}
+            continue
+
+        # 【关键修复】收集工具返回的图片file_id，注入到下一轮对话
+        images: List[Dict[str, Any]] = []
+        outcome = await _process_tool_result(event["result"], images)
+        processed[event["index"]] = outcome["memory_message"]
+        # 检查点：工具一完成即记录（按在 assistant 消息 tool_calls 中的位置），中断后恢复时不再重跑
+        # 补跑中断的调用时 tool_call_dicts 只是其中一部分，位置取自 checkpoint.replay 给出的 index
+        position = tool_call_dicts[event["index"]].get("index", event["index"])
+        memory.checkpoint({"op": "tool", "index": position, "message": outcome["memory_message"]})
+        images_by_index[event["index"]] = images
+
+        yield {
+            "type": "tool_progress",
+            "data": {**progress, "status": "error" if outcome["error"] else "done", "elapsed": event["elapsed"]},
+        }
+        yield {
+            "type": "tool_result",
+            "data": {
+                "tool": event["tool"] or "unknown",
+                "result": outcome["user_message"],
+            },
+        }
+
+    for index, memory_message in enumerate(processed):
+        if memory_message is None:
+            # 不应发生：每个位置都有 finish 事件；防御性跳过，避免把 None 写进记忆
+            logger.warning(f"工具调用 #{index} 没有返回结果，已跳过写入记忆")
+            continue
+        memory.add_message(memory_message)
+    next_round_images = [img for i in sorted(images_by_index) for img in images_by_index[i]]
+
+    # 【关键修复】如果有截图，将其注入到下一轮对话中供模型分析
+    if next_round_images:
+        for image in next_round_images:
+            memory.register_image(image["url"], image["file_id"], image["caption"])
+        screenshot_message = {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": "📸 这是刚才工具执行后的截图，请分析页面内容："
+                }
+            ] + [{"type": "image_url", "image_url": {"url": image["url"]}} for image in next_round_images]
+        }
+        memory.add_message(screenshot_message)
+        logger.info(f"✅ 已注入 {len(next_round_images)} 张截图到对话中，模型可以在下一轮分析")
+
+
 async def agent_main_loop(
     user_input: str,
     file_ids: Optional[List[str]] = None,
@@ -262,6 +428,8 @@ async def agent_main_loop(
     save_ltm: bool = False,
     history_messages: Optional[List[Dict[str, Any]]] = None,
     session_id: Optional[str] = None,  # 会话ID（前端对话窗口ID）
+    history_hash: Optional[str] = None,
+    resume: bool = False,
 ) -> AsyncGenerator[Dict[str, Any], None]:
     """Agent 主循环：支持记忆、压缩、工具调用与长期记忆提炼
 
@@ -274,42 +442,108 @@ async def agent_main_loop(
         save_ltm: 是否保存长期记忆
         history_messages: 历史消息列表（前端传递），格式：[{"role": "user|assistant", "content": "..."}]
         session_id: 会话ID（前端对话窗口ID，用于TODO和对话持久化隔离）
+        history_hash: 前端持有的历史版本；提供时 history_messages 只是增量消息，在热会话的上下文上继续。
+            取得会话锁后再次核对（排队期间上一轮可能已推进历史），不一致时产出 history_mismatch 错误、不执行本轮；
+            未提供时以 history_messages 为完整历史重建上下文
+        resume: 从检查点恢复该会话中断的一轮（忽略 user_input 等参数）
 
     Yields:
         事件流：{"type": "meta|content|tool_call|tool_result|done", "data": ...}
     """
+    # 有 session_id 时使用热会话缓存中的 MemoryManager（未命中时从磁盘恢复），同一会话的请求按顺序执行；
+    # 取锁之后再读取，等待期间上一轮可能已替换（reload）该会话的上下文
+    # 如果前端未传递，则自动生成新 UUID（保持向后兼容）
+    holder = session_cache.hold(session_id) if session_id else contextlib.nullcontext(MemoryManager())
+
+    async with holder as memory:
+        try:
+            if resume:
+                # 检查点基于磁盘快照：丢弃热缓存中中断时的上下文，重新从磁盘加载
+                if session_id:
+                    memory = session_cache.reload(session_id)
+                turn = _resume_turn(memory, max_iterations=max_iterations, save_ltm=save_ltm)
+            elif history_hash and memory.history_hash != history_hash:
+                # 等锁期间同一会话的另一轮已推进历史：增量消息基于前端未见过的历史，不能合并
+                yield {
+                    "type": "error",
+                    "data": {"code": "history_mismatch", "message": "服务端会话历史版本不一致，请发送完整历史"},
+                }
+                return
+            else:
+                turn = _agent_turn(
+                    memory,
+                    user_input,
+                    file_ids,
+                    max_iterations=max_iterations,
+                    save_ltm=save_ltm,
+                    history_messages=history_messages,
+                    history_synced=bool(history_hash),
+                )
+            async for event in turn:
+                yield event
+        finally:
+            if session_id:
+                # 热会话保留未完成的后台摘要，空闲期间继续生成，下一轮换入
+                session_cache.release(session_id)
+            else:
+                memory.cancel_background_compaction()
+
+
+async def _agent_turn(
+    memory: MemoryManager,
+    user_input: str,
+    file_ids: Optional[List[str]],
+    max_iterations: int,
+    save_ltm: bool,
+    history_messages: Optional[List[Dict[str, Any]]],
+    history_synced: bool,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """一轮对话（调用方持有会话锁）"""
     # 初始化日志
     import logging
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__name__)
 
-    # 核心修改：使用前端传递的 session_id 创建 MemoryManager
-    # 如果前端未传递，则自动生成新 UUID（保持向后兼容）
-    memory = MemoryManager(session_id=session_id)
-
     # 日志记录会话ID，便于调试和追踪
     logger.info(f"🎯 Agent主循环启动: session_id={memory.session_id}")
+    # 用量账本归属：本请求内的LLM调用（含工具/SubAgent派生的调用）都记到该会话
+    bind_usage_context(session_id=memory.session_id, agent="main", iteration=0)
+
+    # 上下文即将被修改：本轮成功结束前，前端持有的历史版本都视为过期
+    resumed = (
+        history_synced
+        and bool(memory.short_term_memory)
+        and memory.short_term_memory[0].get("role") == "system"
+    )
+    if not resumed:
+        memory.reset()
+    memory.begin_turn()
 
     # 1) 注入系统提示（含七海人格 + 工具说明）
+    # 系统提示保持逐字节稳定，时间/长期记忆/TODO提醒放到用户消息之后（见步骤8），便于提供商前缀缓存命中
     tool_descriptions = tool_manager.get_tool_descriptions()
     system_msg = get_system_message(tool_descriptions)
-    memory.add_message(system_msg)
-
-    # 2) 加载长期记忆（LTM）到上下文
+    if not resumed:
+        memory.add_message(system_msg)
+    else:
+        logger.info(f"♻️ 热会话续接: {len(memory.short_term_memory)} 条上下文消息，增量 {len(history_messages or [])} 条")
+        if memory.short_term_memory[0].get("content") != system_msg["content"]:
+            # 工具集等变化导致系统提示不同：原位替换，不改变消息结构
+            forget_messages([memory.short_term_memory[0]])
+            memory.short_term_memory[0] = system_msg
+
+    # 2) 读取长期记忆（LTM），在步骤8随易变上下文一起注入
+    ltm_content = ""
     if ltm_md_enabled():
         try:
             ltm = LTMMarkdown()
             ltm_content = ltm.read_all()
             if ltm_content and ltm_content.strip():
-                memory.add_message({
-                    "role": "system",
-                    "content": f"## 哥哥的长期偏好（从历史对话中提炼）\n\n{ltm_content}"
-                })
-                logger.info(f"✅ 已加载完整长期记忆到上下文")
+                logger.info(f"✅ 已读取完整长期记忆")
         except Exception as e:
             logger.warning(f"⚠️ 加载长期记忆失败: {e}")
 
-    # 3) 注入历史消息（如果前端传递了历史）
+    # 3) 注入历史消息（如果前端传递了历史；续接热会话时只有增量消息）
     if history_messages:
         # 只加载用户和助手的历史消息，跳过系统消息（系统消息已经在步骤1注入）
         for msg in history_messages:
@@ -336,6 +570,7 @@ async def agent_main_loop(
                             "url": image_data["url"]
                         }
                     })
+                    memory.register_image(image_data["url"], fid, "用户上传的图片")
                     logger.info(f"✅ 已加载图片文件: {fid} ({image_data['mime_type']})")
             else:
                 # 文本文件，直接读取内容
@@ -366,7 +601,7 @@ async def agent_main_loop(
         # 纯文本消息
         memory.add_message({"role": "user", "content": user_input})
 
-    # 6) 上下文压缩检查
+    # 6) 上下文压缩检查（超过低水位只启动后台摘要，仅触及硬阈值时才在此等待）
     compact_state = await memory.check_and_compact()
     yield {"type": "meta", "data": {"compact": compact_state}}
 
@@ -374,21 +609,20 @@ async def agent_main_loop(
     from services.todo_store import list_todos
     existing_todos = list_todos(session_id=memory.session_id)  # 🔑 关键：传入session_id隔离TODO
 
+    todo_reminder = ""
     if existing_todos:
         pending_todos = [t for t in existing_todos if t.status in ["pending", "in_progress"]]
 
         if pending_todos:
             logger.info(f"✅ 检测到 {len(pending_todos)} 个未完成的TODO，准备继续执行")
 
-            # 注入System Reminder，提示模型继续执行
+            # 构建System Reminder（步骤8随易变上下文注入），提示模型继续执行
             todo_summary = "\n".join([
                 f"- [{t.status}] {t.title}: {t.description or '无描述'}"
                 for t in pending_todos[:10]  # 最多显示10个
             ])
 
-            memory.add_message({
-                "role": "system",
-                "content": f"""<system-reminder>
+            todo_reminder = f"""<system-reminder>
 📋 **检测到未完成的TODO任务**
 
 你之前创建了以下任务清单，现在可以继续执行：
@@ -402,7 +636,6 @@ async def agent_main_loop(
 
 不需要重新创建TODO LIST，直接继续执行即可。
 </system-reminder>"""
-            })
 
             yield {
                 "type": "meta",
@@ -413,26 +646,143 @@ async def agent_main_loop(
                 }
             }
 
-    # 8) 主循环（思考→工具→再思考）
+    # 8) 注入易变上下文（当前时间 + 长期记忆 + TODO提醒），位于用户消息之后
+    # 续接热会话时，之前各轮的易变上下文只保留时间，避免长期记忆/TODO提醒逐轮重复累积
+    if resumed:
+        for i, message in enumerate(memory.short_term_memory):
+            retired = retire_volatile_message(message)
+            if retired is not None:
+                forget_messages([message])
+                memory.short_term_memory[i] = retired
+    memory.add_message(get_volatile_message(ltm_content, todo_reminder))
+
+    # 9) 主循环（思考→工具→再思考），此后的上下文变化与工具结果写入检查点
+    memory.checkpoint_turn()
+    async for event in _run_iterations(memory, max_iterations, save_ltm):
+        yield event
+
+
+async def _resume_turn(
+    memory: MemoryManager,
+    max_iterations: int,
+    save_ltm: bool,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """从检查点恢复中断的一轮（调用方持有会话锁，memory 为磁盘快照）
+
+    重放检查点中的消息与已完成的工具结果，只补跑未完成的工具调用，然后从中断的迭代继续。
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+
+    bind_usage_context(session_id=memory.session_id, agent="main", iteration=0)
+    memory.begin_turn()
+    info = memory.restore_checkpoint(memory.session_id)
+    if info is None:
+        logger.info(f"♻️ 没有可恢复的检查点: session_id={memory.session_id}")
+        yield {"type": "content", "data": "没有可恢复的检查点（上一轮已正常结束或检查点已过期）\n"}
+        yield {"type": "done"}
+        return
+
+    logger.info(
+        f"♻️ 从检查点恢复: session_id={memory.session_id}, 第 {info['iteration']} 轮，"
+        f"重放 {info['restored']} 条消息，待补跑 {len(info['pending_tool_calls'])} 个工具调用"
+    )
+    yield {
+        "type": "meta",
+        "data": {
+            "resumed": {
+                "iteration": info["iteration"],
+                "restored": info["restored"],
+                "pending_tool_calls": len(info["pending_tool_calls"]),
+            }
+        },
+    }
+
+    if info["finished"]:
+        # 最终回复已生成，只是未来得及保存：直接结束本轮
+        history_hash = memory.end_turn()
+        yield {"type": "meta", "data": {"history_sync": {"hash": history_hash}}}
+        yield {"type": "done"}
+        return
+
+    if info["pending_tool_calls"]:
+        yield {"type": "tool_call", "data": {"message": f"正在补跑{len(info['pending_tool_calls'])}个中断的工具.."}}
+        dispatcher = tool_manager.create_dispatcher(session_id=memory.session_id)
+        try:
+            async for event in _execute_tool_calls(memory, dispatcher, info["pending_tool_calls"]):
+                yield event
+        finally:
+            dispatcher.cancel()
+
+    async for event in _run_iterations(memory, max_iterations, save_ltm, start_iteration=info["iteration"]):
+        yield event
+
+
+async def _run_iterations(
+    memory: MemoryManager,
+    max_iterations: int,
+    save_ltm: bool,
+    start_iteration: int = 0,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """主循环（思考→工具→再思考），从 start_iteration 之后的迭代开始"""
+    import logging
+    logger = logging.getLogger(__name__)
+
     main_client = model_manager.get_model("main")
     openai_tools = tool_manager.get_openai_tools()
 
-    iteration = 0
+    iteration = start_iteration
     while iteration < max_iterations:
         iteration += 1
         logger.info(f"📍 Iteration {iteration}/{max_iterations}")
+        bind_usage_context(iteration=iteration)
+        memory.checkpoint({"op": "iteration", "iteration": iteration})
 
+        dispatcher = None
         try:
-            # 获取上下文并调用模型
+            # 换入已完成的后台摘要；上下文涨过低水位时启动后台摘要
+            if iteration > 1:
+                compact_state = await memory.check_and_compact()
+                if compact_state["compacted"] or compact_state["masked"]:
+                    logger.info(f"🗜️ 上下文已压缩: {compact_state['tokens']} tokens (阈值 {compact_state['threshold']})")
+                    yield {"type": "meta", "data": {"compact": compact_state}}
+
+            # 获取上下文并流式调用模型：文本增量到达即推送给前端
+            # 只读工具的 tool_call 参数一完整就提前派发执行，不必等整条消息结束
+            aged = memory.age_images()
+            if aged:
+                logger.info(f"🖼️ 图片老化: {aged} 张较早的图片已替换为 file_id 引用")
             context = memory.get_context()
-            try:
-                resp = await main_client.chat(context, tools=openai_tools)
-            except TypeError:
-                resp = await main_client.chat(context)
+            dispatcher = tool_manager.create_dispatcher(session_id=memory.session_id)  # ✅ 传递session_id
+            resp: Dict[str, Any] = {}
+            async for event in main_client.chat_stream(context, tools=openai_tools):
+                if event["type"] == "content":
+                    yield {"type": "content", "data": event["data"]}
+                elif event["type"] == "tool_call":
+                    # 只读工具提前派发；有副作用的调用等完整回复确定后再执行
+                    if dispatcher.submit_early(event["data"]):
+                        logger.info(f"⚡ 提前派发工具: {event['data']['function']['name']}")
+                elif event["type"] == "final":
+                    resp = event
 
             content = resp.get("content", "")
             raw_response = resp.get("raw")
 
+            # 上报本轮 token 用量与提供商前缀缓存命中
+            usage = getattr(raw_response, "usage", None)
+            if usage is not None and usage.prompt_tokens:
+                logger.info(f"🧊 Prompt缓存命中: {usage.cached_tokens}/{usage.prompt_tokens} tokens")
+                yield {
+                    "type": "meta",
+                    "data": {
+                        "usage": {
+                            "prompt_tokens": usage.prompt_tokens,
+                            "cached_tokens": usage.cached_tokens,
+                            "completion_tokens": usage.completion_tokens,
+                        }
+                    }
+                }
+
             # 解析 tool_calls（OpenAI 兼容格式）
             tool_calls = None
             if raw_response and hasattr(raw_response, "choices"):
@@ -463,21 +813,25 @@ async def agent_main_loop(
                     # 短响应直接保存
                     memory.add_message({"role": "assistant", "content": content})
 
-                chunk_size = 1000
-                for i in range(0, len(content), chunk_size):
-                    yield {"type": "content", "data": content[i : i + chunk_size]}
+                # 未走流式（LLM_STREAM=0 或首字节前出错）时一次性输出
+                if not resp.get("streamed"):
+                    chunk_size = 1000
+                    for i in range(0, len(content), chunk_size):
+                        yield {"type": "content", "data": content[i : i + chunk_size]}
 
             # 判断是否需要结束
             if not tool_calls:
+                dispatcher.cancel()
                 logger.info(f"🏁 无工具调用，任务结束 (iteration={iteration})")
                 if content:
                     # 如果还没添加消息（长响应缓存时已添加），则添加
                     if len(content) <= 5000:
                         pass  # 已在上面添加过了
 
-                # 保存对话到磁盘
-                memory.save_to_disk()
+                # 保存对话到磁盘，并把新的历史版本告诉前端（下一轮只需发送增量消息）
+                history_hash = memory.end_turn()
                 logger.info(f"💾 对话已保存: session_id={memory.session_id}")
+                yield {"type": "meta", "data": {"history_sync": {"hash": history_hash}}}
 
                 # 尝试提炼"用户偏好"写入 Markdown（仅当前端明确请求时）
                 try:
@@ -525,85 +879,21 @@ async def agent_main_loop(
                 for tc in tool_calls
             ]
 
-            tool_results = await tool_manager.execute_tool_calls(tool_call_dicts, session_id=memory.session_id)  # ✅ 传递session_id
+            # 等待工具期间主循环空闲，适合在后台生成摘要
+            memory.maybe_compact_in_background()
 
-            # 【关键修复】收集工具返回的图片file_id，注入到下一轮对话
-            next_round_images = []
-
-            for tool_result in tool_results:
-                tool_name = tool_result.get("name", "unknown")
-
-                # 🔑 核心优化：检测SubAgent报告并特殊处理
-                is_subagent_report = tool_name.endswith("_subagent")
-
-                if is_subagent_report:
-                    # SubAgent报告处理逻辑
-                    subagent_report = await _process_subagent_report(tool_result, next_round_images)
-
-                    # 注入紧凑报告到记忆
-                    memory.add_message(subagent_report["memory_message"])
-
-                    # 返回格式化报告给前端
-                    yield {
-                        "type": "tool_result",
-                        "data": {
-                            "tool": tool_name,
-                            "result": subagent_report["user_message"],
-                        },
-                    }
-                else:
-                    # 普通工具处理逻辑（保持原有逻辑）
-                    truncated_result = _truncate_large_tool_result(tool_result)
-
-                    # 检查file_id，如果是图片则准备注入
-                    try:
-                        result_content = json.loads(tool_result.get("content", "{}"))
-                        if isinstance(result_content, dict) and not result_content.get("error", False):
-                            data = result_content.get("data", {})
-                            if isinstance(data, dict) and "file_id" in data:
-                                fid = data["file_id"]
-                                file_path = get_file_path_by_id(fid)
-
-                                if file_path and is_image_file(file_path):
-                                    image_data = get_image_as_base64(fid)
-                                    if image_data:
-                                        next_round_images.append({
-                                            "type": "image_url",
-                                            "image_url": {
-                                                "url": image_data["url"]
-                                            }
-                                        })
-                                        logger.info(f"📸 检测到截图 file_id: {fid}，将在下一轮注入到对话中")
-                    except Exception as e:
-                        logger.debug(f"解析工具结果时出错（可忽略）: {e}")
-
-                    # 注入到记忆
-                    memory.add_message(truncated_result)
-
-                    # 返回给前端
-                    yield {
-                        "type": "tool_result",
-                        "data": {
-                            "tool": tool_name,
-                            "result": tool_result.get("content", ""),
-                        },
-                    }
-
-            # 【关键修复】如果有截图，将其注入到下一轮对话中供模型分析
-            if next_round_images:
-                screenshot_message = {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "📸 这是刚才工具执行后的截图，请分析页面内容："
-                        }
-                    ] + next_round_images
-                }
-                memory.add_message(screenshot_message)
-                logger.info(f"✅ 已注入 {len(next_round_images)} 张截图到对话中，模型可以在下一轮分析")
+            async for event in _execute_tool_calls(memory, dispatcher, tool_call_dicts):
+                yield event
 
+        except asyncio.CancelledError:
+            # 客户端断开或显式停止：取消在途工具（含 SubAgent），LLM 请求随 await 一并取消
+            if dispatcher is not None:
+                dispatcher.cancel()
+            logger.info(f"⏹️ Iteration {iteration} 已取消: session_id={memory.session_id}")
+            raise
         except Exception as e:
+            if dispatcher is not None:
+                dispatcher.cancel()
             logger.error(f"❌ Iteration {iteration} 异常: {str(e)}")
             import traceback
             logger.error(traceback.format_exc())
@@ -621,9 +911,10 @@ async def agent_main_loop(
             "data": f"\n\n⚠️ 任务未完成：达到最大迭代次数({max_iterations})，可尝试增加 max_iterations 参数\n",
         }
 
-        # 保存对话到磁盘
-        memory.save_to_disk()
+        # 保存对话到磁盘，并把新的历史版本告诉前端（下一轮只需发送增量消息）
+        history_hash = memory.end_turn()
         logger.info(f"💾 对话已保存: session_id={memory.session_id}")
+        yield {"type": "meta", "data": {"history_sync": {"hash": history_hash}}}
 
         try:
             if save_ltm:  # 只有前端明确传递 save_ltm=True 时才提炼
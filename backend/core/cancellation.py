@@ -0,0 +1,166 @@
+"""
+对话轮次取消
+
+目标：
+- 记录每个会话正在执行的 Agent 轮次（asyncio.Task），客户端断开或显式点击停止时取消
+- 取消沿 asyncio 结构化传播：主循环 → 工具调度（ToolCallDispatcher 取消在途工具任务）→
+  SubAgent（取消其派发的工具任务）→ LLM 请求（httpx 连接随之关闭，限流名额归还）
+
+- 断开检测：流式响应只有在写出数据时才会发现客户端已断开，长时间的工具调用/SubAgent 期间
+  没有输出；run_cancellable() 在等待事件时定期检查连接，断开即取消整轮
+- 背压：客户端读取慢于模型输出时，事件在队列中积压；转发时把排队中的连续文本增量合并为一个事件，
+  减少写出次数与协议开销
+
+环境变量：
+- CLIENT_DISCONNECT_POLL: 等待事件期间检查客户端连接的间隔（秒），默认 1
+
+用法：
+    async for event in run_cancellable(agent_main_loop(...), session_id, request.is_disconnected):
+        ...
+    turn_registry.cancel(session_id)    # POST /chat/{session_id}/cancel
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import weakref
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class TurnRegistry:
+    """session_id -> 正在执行的轮次任务"""
+
+    def __init__(self) -> None:
+        self._turns: Dict[str, Set[asyncio.Task]] = {}
+        # 取消原因（任务结束后仍可查询，随任务对象回收）
+        self._reasons: "weakref.WeakKeyDictionary[asyncio.Task, str]" = weakref.WeakKeyDictionary()
+        self.cancelled = 0
+
+    def register(self, session_id: str, task: asyncio.Task) -> None:
+        self._turns.setdefault(session_id, set()).add(task)
+        task.add_done_callback(lambda t, sid=session_id: self._discard(sid, t))
+
+    def _discard(self, session_id: str, task: asyncio.Task) -> None:
+        tasks = self._turns.get(session_id)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                self._turns.pop(session_id, None)
+
+    def cancel_task(self, task: asyncio.Task, reason: str) -> bool:
+        if task.done():
+            return False
+        self._reasons.setdefault(task, reason)
+        task.cancel()
+        self.cancelled += 1
+        return True
+
+    def cancel(self, session_id: str, reason: str = "user") -> int:
+        """取消该会话正在执行的全部轮次，返回取消的数量"""
+        count = sum(self.cancel_task(task, reason) for task in list(self._turns.get(session_id, ())))
+        if count:
+            logger.info(f"⏹️ 已取消会话 {session_id} 的 {count} 个执行中的轮次 (reason={reason})")
+        return count
+
+    def reason(self, task: asyncio.Task) -> Optional[str]:
+        return self._reasons.get(task)
+
+    def running(self, session_id: str) -> bool:
+        return any(not t.done() for t in self._turns.get(session_id, ()))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running_sessions": len(self._turns),
+            "running_turns": sum(len(tasks) for tasks in self._turns.values()),
+            "cancelled": self.cancelled,
+        }
+
+
+# 单例，便于全局使用
+turn_registry = TurnRegistry()
+
+
+def _disconnect_poll() -> float:
+    try:
+        return max(0.1, float(os.getenv("CLIENT_DISCONNECT_POLL", "1")))
+    except Exception:
+        return 1.0
+
+
+async def run_cancellable(
+    events: AsyncIterator[Dict[str, Any]],
+    session_id: Optional[str],
+    is_disconnected: Callable[[], Awaitable[bool]],
+) -> AsyncIterator[Dict[str, Any]]:
+    """在独立任务中驱动一轮 Agent 事件流，转发事件并处理取消
+
+    - 客户端断开（轮询 is_disconnected）或调用方提前关闭本生成器：取消该轮任务
+    - 被 turn_registry.cancel() 取消：产出 {"type": "cancelled", "data": {"reason"}} 后结束
+    - 该轮任务抛出的异常原样抛给调用方
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+
+    async def produce() -> None:
+        async for event in events:
+            await queue.put(event)
+
+    producer = asyncio.create_task(produce())
+    if session_id:
+        turn_registry.register(session_id, producer)
+    poll = _disconnect_poll()
+    getter: Optional[asyncio.Task] = None
+    held: Optional[Dict[str, Any]] = None  # 合并文本增量时取出的下一个非文本事件
+
+    def coalesce(event: Dict[str, Any]) -> Dict[str, Any]:
+        nonlocal held
+        if event.get("type") != "content":
+            return event
+        parts = [event["data"]]
+        while not queue.empty():
+            following = queue.get_nowait()
+            if following.get("type") != "content":
+                held = following
+                break
+            parts.append(following["data"])
+        return event if len(parts) == 1 else {"type": "content", "data": "".join(parts)}
+
+    try:
+        while True:
+            if held is not None:
+                event, held = held, None
+                yield coalesce(event)
+                continue
+            if getter is None:
+                getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, producer}, timeout=poll, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                event = getter.result()
+                getter = None
+                yield coalesce(event)
+                continue
+            if producer in done:
+                while held is not None or not queue.empty():
+                    event = held if held is not None else queue.get_nowait()
+                    held = None
+                    yield coalesce(event)
+                if producer.cancelled():
+                    yield {"type": "cancelled", "data": {"reason": turn_registry.reason(producer) or "cancelled"}}
+                    return
+                exc = producer.exception()
+                if exc is not None:
+                    raise exc
+                return
+            if await is_disconnected():
+                logger.info(f"🔌 客户端已断开，取消本轮执行 (session={session_id})")
+                turn_registry.cancel_task(producer, "disconnect")
+                return
+    finally:
+        if getter is not None:
+            getter.cancel()
+        if not producer.done():
+            producer.cancel()
+        # 等待取消在主循环/工具/SubAgent 中传播完毕（释放会话锁、资源名额与连接）
+        await asyncio.wait({producer}, timeout=10)
@@ -0,0 +1,174 @@
+"""
+/chat 结构化事件流协议（版本 1）
+
+目标：
+- 替代 text/plain 中混杂 "[meta] ..."、"[✓ tool]: ..." 标记的文本流，前端不再需要正则解析
+- 每个事件是一个带 type 的 JSON 对象，NDJSON（每行一个）或 SSE（event: 类型 / data: JSON）承载
+- 大型工具结果不内联：写入文件缓存，事件中只带 file_id 与预览（GET /files/{file_id} 取完整内容）
+- 背压：客户端读取跟不上时，连续的文本增量合并为一个事件写出
+- 续传：事件按序编号（"id"，SSE 同时写 id: 行），连接中断后可从最后收到的编号继续（见 core/run_stream.py）
+
+事件（所有事件都有 "type" 与 "id"）：
+- start:        {"v": 协议版本, "session_id", "run_id"}
+- content:      {"delta": 文本增量}
+- tool_call:    {"message": 调用提示}
+- tool_progress:{"call_id", "tool", "index", "status": running|done|error, "elapsed"?}
+- tool_result:  {"tool", "error", "size": 结果字符数, "result": 结果 JSON}
+                或 {"tool", "error", "size", "file_id", "preview"}（超过 CHAT_INLINE_RESULT_CHARS 时）
+- meta:         {"data": 元信息（compact / history_sync / resumed / ltm_saved 等）}
+- usage:        {"prompt_tokens", "cached_tokens", "completion_tokens"}
+- cancelled:    {"reason"}
+- error:        {"message", "code"?}（code=history_mismatch：取得会话锁时历史已被另一轮推进，应改为发送完整历史重试）
+- done:         {}
+
+协商：请求头 Accept 含 application/x-ndjson 或 text/event-stream，或表单字段 stream_format=ndjson|sse；
+都没有时仍返回旧的文本流（兼容旧客户端）。响应头 X-Chat-Protocol 为协议版本。
+
+环境变量：
+- CHAT_INLINE_RESULT_CHARS: 内联工具结果的最大字符数，超过时改为 file_id 引用，默认 8000
+- CHAT_RESULT_PREVIEW_CHARS: 引用时附带的预览字符数，默认 500
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from . import json_codec
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = 1
+
+# 已写入文件缓存的大型工具结果：(工具名, 内容哈希) -> file_id，同一结果再次发送（如恢复运行）时复用
+_RESULT_FILE_IDS: "OrderedDict[tuple, str]" = OrderedDict()
+_RESULT_FILE_IDS_MAX = 256
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+
+def _int_env(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def negotiate(accept: Optional[str], requested: Optional[str] = None) -> Optional[str]:
+    """选择事件流格式："ndjson" / "sse"；客户端未声明时返回 None（旧文本流）"""
+    if requested in MEDIA_TYPES:
+        return requested
+    accept = (accept or "").lower()
+    if MEDIA_TYPES["ndjson"] in accept:
+        return "ndjson"
+    if MEDIA_TYPES["sse"] in accept:
+        return "sse"
+    return None
+
+
+def response_headers(fmt: str) -> Dict[str, str]:
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        "X-Chat-Protocol": str(PROTOCOL_VERSION),
+    }
+    if fmt == "sse":
+        headers["Connection"] = "keep-alive"
+    return headers
+
+
+def encode(event: Dict[str, Any], fmt: str) -> bytes:
+    data = json_codec.dumps_bytes(event)
+    if fmt == "sse":
+        event_id = f"id: {event['id']}\n".encode("ascii") if "id" in event else b""
+        return event_id + b"event: " + event["type"].encode("utf-8") + b"\ndata: " + data + b"\n\n"
+    return data + b"\n"
+
+
+def _cache_result_text(tool: str, text: str, file_type: str, known_id: Optional[str]) -> Tuple[str, bool]:
+    """把大型工具结果写入文件缓存（在线程中执行），返回 (file_id, 是否新写入)
+
+    known_id 为此前写入同一结果的 file_id，文件仍在时直接复用（可能已被 cleanup_storage 清理）
+    """
+    from services.file_store import cache_base64_data, get_file_path_by_id
+
+    if known_id:
+        path = get_file_path_by_id(known_id)
+        if path and os.path.exists(path):
+            return known_id, False
+    file_id = cache_base64_data(
+        base64.b64encode(text.encode("utf-8")).decode("ascii"),
+        file_type=file_type,
+        metadata={"tool": tool, "length": len(text)},
+    )
+    return file_id, True
+
+
+async def _tool_result_event(data: Dict[str, Any]) -> Dict[str, Any]:
+    """工具结果事件：小结果内联解析后的 JSON，大结果写入文件缓存后只发送引用与预览"""
+    text = data.get("result", "")
+    if not isinstance(text, str):
+        text = json_codec.dumps(text)
+    event: Dict[str, Any] = {"type": "tool_result", "tool": data.get("tool") or "unknown", "size": len(text)}
+    try:
+        parsed = json_codec.loads(text)
+    except json_codec.JSONDecodeError:
+        parsed = text
+    event["error"] = isinstance(parsed, dict) and bool(parsed.get("error"))
+
+    if len(text) <= _int_env("CHAT_INLINE_RESULT_CHARS", 8000):
+        event["result"] = parsed
+        return event
+    try:
+        from tools.result_cache import tool_result_cache
+
+        key = (event["tool"], hashlib.sha256(text.encode("utf-8")).hexdigest())
+        file_id, written = await asyncio.to_thread(
+            _cache_result_text, event["tool"], text, "json" if parsed is not text else "text", _RESULT_FILE_IDS.get(key)
+        )
+        if written:
+            # 新文件写入 file_store：list_cached_files / storage_stats 等缓存结果随之失效
+            tool_result_cache.invalidate_all(("file_store",))
+        _RESULT_FILE_IDS[key] = file_id
+        _RESULT_FILE_IDS.move_to_end(key)
+        if len(_RESULT_FILE_IDS) > _RESULT_FILE_IDS_MAX:
+            _RESULT_FILE_IDS.popitem(last=False)
+        event["file_id"] = file_id
+        event["preview"] = text[:_int_env("CHAT_RESULT_PREVIEW_CHARS", 500)]
+    except Exception as e:
+        logger.warning(f"⚠️ 缓存工具结果失败，改为内联发送: {e}")
+        event["result"] = parsed
+    return event
+
+
+async def to_wire_event(chunk: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Agent 内部事件 → 协议事件；不需要发送的事件返回 None"""
+    kind = chunk.get("type")
+    data = chunk.get("data")
+    if kind == "content":
+        return {"type": "content", "delta": data} if data else None
+    if kind == "tool_call":
+        return {"type": "tool_call", "message": (data or {}).get("message", "工具调用")}
+    if kind == "tool_progress":
+        return {"type": "tool_progress", **(data or {})}
+    if kind == "tool_result":
+        return await _tool_result_event(data or {})
+    if kind == "meta":
+        if isinstance(data, dict) and set(data) == {"usage"}:
+            return {"type": "usage", **data["usage"]}
+        return {"type": "meta", "data": data}
+    if kind == "cancelled":
+        return {"type": "cancelled", "reason": (data or {}).get("reason", "cancelled")}
+    if kind == "error":
+        return {"type": "error", **(data or {})}
+    if kind == "done":
+        return {"type": "done"}
+    return None
+
@@ -0,0 +1,191 @@
+"""
+Agent 运行检查点（追加写日志）
+
+目标：
+- 进程在长任务中途退出时，已完成的 LLM 调用与工具结果不丢失、不必重新付费
+- 主循环与 SubAgent 的每条上下文消息、每个完成的工具结果都追加写入
+  data/checkpoints/{key}.jsonl，恢复时在会话快照上重放，只补跑未完成的工具调用
+
+日志格式（每行一个 JSON 记录）：
+- {"op": "start", "snapshot_id", "ts"}：日志头，snapshot_id 为所基于的对话快照
+  （data/conversations/{session_id}.json），与磁盘快照不一致的日志视为过期
+- {"op": "add", "message"}：加入上下文的消息
+- {"op": "tool", "index", "message"}：完成的工具结果（写入上下文前，按完成顺序），
+  index 为该调用在 assistant 消息 tool_calls 中的位置（tool_call id 可能为空或重复，按位置对应）
+- {"op": "iteration", "iteration"}：新一轮迭代开始
+
+快照重写时（压缩、轮次结束）日志随之截断为新的日志头；轮次正常结束后删除日志。
+
+键：
+- 主循环：session_id
+- SubAgent：{session_id}.{SubAgent名}.{tool_call_id}（同一次工具调用恢复时续接同一个 SubAgent）
+
+环境变量：
+- CHECKPOINT_ENABLED: 1 启用（默认）/ 0 关闭
+- CHECKPOINT_FSYNC: 1 时每条记录 fsync（默认 0，只保证进程崩溃不丢失）
+"""
+from __future__ import annotations
+
+import contextvars
+import glob
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import json_codec
+
+# 检查点目录
+CHECKPOINT_DIR = os.path.join(os.getcwd(), "data", "checkpoints")
+
+# 当前正在执行的工具调用 id（ToolManager.run_tool_call 内设置，SubAgent 据此生成检查点键）
+current_tool_call_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_tool_call_id", default=None)
+
+
+def checkpoint_enabled() -> bool:
+    return os.getenv("CHECKPOINT_ENABLED", "1") == "1"
+
+
+def _safe_key(key: str) -> str:
+    return re.sub(r"[^\w.\-]", "_", key)
+
+
+class CheckpointJournal:
+    """单个检查点的追加写日志"""
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.path = os.path.join(CHECKPOINT_DIR, f"{_safe_key(key)}.jsonl")
+        self._file = None
+        self._fsync = os.getenv("CHECKPOINT_FSYNC", "0") == "1"
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def start(self, snapshot_id: Optional[str]) -> None:
+        """截断并写入日志头（之前的记录已包含在快照中或已作废）"""
+        self.close()
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        self._file = open(self.path, "wb")
+        self.append({"op": "start", "snapshot_id": snapshot_id, "ts": time.time()})
+
+    def resume(self) -> None:
+        """在已有日志后继续追加"""
+        self.close()
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        self._file = open(self.path, "ab")
+
+    def append(self, record: Dict[str, Any]) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.write(json_codec.dumps_bytes(record) + b"\n")
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+        except Exception as e:
+            print(f"⚠️ 写入检查点失败: {e}")
+
+    def read(self) -> List[Dict[str, Any]]:
+        """读取全部记录（进程崩溃时最后一行可能不完整，直接丢弃）"""
+        records: List[Dict[str, Any]] = []
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        records.append(json_codec.loads(line))
+                    except json_codec.JSONDecodeError:
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def close(self) -> None:
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+            self._file = None
+
+    def remove(self) -> None:
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def purge(prefix: str) -> None:
+    """删除以 prefix 开头的检查点（新一轮开始时清理上一轮遗留的 SubAgent 检查点）"""
+    for path in glob.glob(os.path.join(CHECKPOINT_DIR, f"{_safe_key(prefix)}*.jsonl")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def replay(records: List[Dict[str, Any]], messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """把日志记录重放到 messages（原地追加），返回恢复信息
+
+    Returns:
+        {
+            "iteration": 最后开始的迭代序号,
+            "restored": 重放的消息数,
+            "pending_tool_calls": 最后一条 assistant 消息中尚无结果的 tool_call（OpenAI 格式，index 为其在 tool_calls 中的位置）,
+            "finished": 最后一条消息是不带 tool_calls 的助手回复（本轮实际已完成）,
+        }
+    """
+    iteration = 0
+    restored = 0
+    # 最近一组 tool_calls 已完成的结果：[(位置, 消息)]，位置缺失（旧日志）时为 None
+    completed: List[Tuple[Optional[int], Dict[str, Any]]] = []
+    for record in records:
+        op = record.get("op")
+        if op == "add":
+            message = record["message"]
+            messages.append(message)
+            restored += 1
+            if message.get("role") == "assistant" and message.get("tool_calls"):
+                completed = []
+        elif op == "tool":
+            completed.append((record.get("index"), record["message"]))
+        elif op == "iteration":
+            iteration = record.get("iteration", iteration)
+
+    # 最后一条带 tool_calls 的 assistant 消息之后缺少的工具结果：已完成的补入上下文，其余待补跑
+    # 结果按位置对应调用（与 ToolCallDispatcher 一致），id 为空或重复时也不会串位
+    pending: List[Dict[str, Any]] = []
+    last_call_index = next(
+        (i for i in range(len(messages) - 1, -1, -1)
+         if messages[i].get("role") == "assistant" and messages[i].get("tool_calls")),
+        None,
+    )
+    if last_call_index is not None and all(m.get("role") == "tool" for m in messages[last_call_index + 1:]):
+        calls = messages[last_call_index]["tool_calls"]
+        # 已写入上下文的结果按调用顺序写入，占据前面的位置
+        answered = len(messages) - last_call_index - 1
+        by_index: Dict[int, Dict[str, Any]] = {}
+        unindexed: List[Dict[str, Any]] = []
+        for index, message in completed:
+            if isinstance(index, int) and answered <= index < len(calls):
+                by_index.setdefault(index, message)
+            elif index is None:
+                unindexed.append(message)
+        for index in range(answered, len(calls)):
+            call = calls[index]
+            result = by_index.get(index)
+            if result is None:
+                # 旧日志没有位置信息：按 id 认领第一个尚未使用的结果
+                result = next((m for m in unindexed if m.get("tool_call_id") == call.get("id")), None)
+                if result is not None:
+                    unindexed.remove(result)
+            if result is not None:
+                messages.append(result)
+                restored += 1
+            else:
+                pending.append({"id": call.get("id"), "index": index, "function": call.get("function") or {}})
+
+    last = messages[-1] if messages else {}
+    finished = last.get("role") == "assistant" and not last.get("tool_calls")
+    return {"iteration": iteration, "restored": restored, "pending_tool_calls": pending, "finished": finished}
@@ -0,0 +1,337 @@
+"""
+分层上下文压缩引擎
+
+两级压缩：
+1. 观测折叠（mask_observations，无需调用模型）：较早的大型工具结果替换为紧凑占位，
+   保留工具名、参数、原始大小与 file_id/report_id 等引用，最近几条工具结果原样保留
+2. 分层摘要（CompactionEngine，调用压缩模型）：折叠后仍超过水位时才进行
+
+分层摘要的目标：
+- 压缩后的消息窗口始终是合法请求：按结构切分历史，assistant(tool_calls) 与其 tool 结果永不拆开，
+  不会出现"孤立 tool 消息"导致提供商拒绝请求
+- 最近的段落在 token 预算内原样保留，只摘要更早的段落
+- 分层摘要：较早的段落按块并行生成一级摘要；摘要条数超过扇入上限时，最早的若干条再合并为
+  更高一级的"摘要的摘要"，摘要总长度随会话增长保持有界
+- 摘要输入是纯文本对话记录（工具结果截断），比直接发送完整上下文便宜，也不依赖 tools 定义
+
+切分规则：
+- 开头的 system 消息（系统提示）固定保留，不参与摘要
+- 原子组：一条非 tool 消息 + 紧随其后的 tool 消息
+- 段落：以 user 消息开始的一轮对话（含该轮的全部原子组）；超过 COMPACT_CHUNK_TOKENS 的轮次
+  按原子组拆开，使切分点更细
+
+环境变量：
+- OBSERVATION_KEEP_RECENT: 原样保留的最近工具结果条数，默认 5
+- OBSERVATION_MASK_MIN_CHARS: 小于该字符数的工具结果不折叠（折叠收益不大），默认 800
+- COMPACT_KEEP_RATIO: 原样保留的最近段落占上下文窗口的比例，默认 0.2（至少保留最后一段）
+- COMPACT_CHUNK_TOKENS: 单次一级摘要的输入上限（token），默认 12000
+- COMPACT_SUMMARY_FAN_IN: 摘要条数上限，超过时合并最早的若干条，默认 4
+- COMPACT_MESSAGE_CHARS: 对话记录中单条消息保留的字符数，默认 2000
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from .tokenizer import token_counter
+
+logger = logging.getLogger(__name__)
+
+
+def _int_env(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+LEAF_PROMPT = (
+    "以下是一段较早的对话记录。请生成结构化中文摘要，保留：项目背景/关键信息/已完成/待办/注意事项，"
+    "以及文件路径、file_id、report_id 等后续可能引用的标识，用于继续协作。输出应简洁、要点化。"
+)
+
+MERGE_PROMPT = (
+    "以下是按时间顺序排列的若干段会话摘要。请合并为一份结构化中文摘要，保留：项目背景/关键信息/"
+    "已完成/待办/注意事项及其中的标识；后面的摘要与前面冲突时以后面为准。输出应简洁、要点化。"
+)
+
+
+@dataclass
+class Segment:
+    """历史中的一段连续消息 [start, end)，切分点只落在段落边界上"""
+
+    start: int
+    end: int
+    tokens: int
+
+
+def _atomic_groups(messages: List[Dict[str, Any]], start: int) -> List[Segment]:
+    groups: List[Segment] = []
+    for i in range(start, len(messages)):
+        tokens = token_counter.count_message(messages[i])
+        if groups and messages[i].get("role") == "tool":
+            groups[-1].end = i + 1
+            groups[-1].tokens += tokens
+        else:
+            groups.append(Segment(i, i + 1, tokens))
+    return groups
+
+
+def split_segments(messages: List[Dict[str, Any]], start: int = 0, max_tokens: Optional[int] = None) -> List[Segment]:
+    """把 messages[start:] 切成轮次级段落；超过 max_tokens 的轮次拆成原子组"""
+    if max_tokens is None:
+        max_tokens = _int_env("COMPACT_CHUNK_TOKENS", 12000)
+    turns: List[List[Segment]] = []
+    for group in _atomic_groups(messages, start):
+        if not turns or messages[group.start].get("role") == "user":
+            turns.append([group])
+        else:
+            turns[-1].append(group)
+
+    segments: List[Segment] = []
+    for groups in turns:
+        tokens = sum(g.tokens for g in groups)
+        if tokens > max_tokens:
+            segments.extend(groups)
+        else:
+            segments.append(Segment(groups[0].start, groups[-1].end, tokens))
+    return segments
+
+
+def pinned_prefix(messages: List[Dict[str, Any]]) -> int:
+    """开头连续 system 消息的条数（系统提示，固定保留）"""
+    pin = 0
+    while pin < len(messages) and messages[pin].get("role") == "system":
+        pin += 1
+    return pin
+
+
+def _clip(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    head = limit * 2 // 3
+    return f"{text[:head]}\n…（省略 {len(text) - limit} 字符）…\n{text[-(limit - head):]}"
+
+
+def _text_of(content: Any) -> str:
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                parts.append(part.get("text", ""))
+            elif isinstance(part, dict) and part.get("type") == "image_url":
+                parts.append("[图片]")
+        return "\n".join(parts)
+    return str(content)
+
+
+def render_transcript(messages: List[Dict[str, Any]], max_chars: Optional[int] = None) -> str:
+    """把消息渲染为摘要用的纯文本对话记录（长内容截断，图片替换为占位）"""
+    if max_chars is None:
+        max_chars = _int_env("COMPACT_MESSAGE_CHARS", 2000)
+    labels = {"user": "用户", "assistant": "助手", "system": "系统"}
+    lines: List[str] = []
+    for message in messages:
+        role = message.get("role")
+        text = _text_of(message.get("content"))
+        if role == "tool":
+            lines.append(f"【工具结果 {message.get('name') or ''}】{_clip(text, max_chars)}")
+            continue
+        if text:
+            lines.append(f"【{labels.get(role, role)}】{_clip(text, max_chars)}")
+        for call in message.get("tool_calls") or []:
+            function = call.get("function") or {}
+            lines.append(f"【调用工具 {function.get('name', '')}】{_clip(function.get('arguments') or '', 500)}")
+    return "\n".join(lines)
+
+
+MASK_PREFIX = "[已折叠的工具结果]"
+
+# 占位中保留的引用字段（含 screenshot_file_id 等后缀形式）
+_REF_SUFFIXES = ("file_id", "report_id")
+
+
+def _collect_refs(data: Any, refs: Dict[str, str], depth: int = 0) -> None:
+    if depth > 4 or len(refs) >= 8:
+        return
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if isinstance(value, str) and key.endswith(_REF_SUFFIXES):
+                refs.setdefault(key, value)
+            elif isinstance(value, (dict, list)):
+                _collect_refs(value, refs, depth + 1)
+    elif isinstance(data, list):
+        for item in data[:20]:
+            _collect_refs(item, refs, depth + 1)
+
+
+def _observation_stub(message: Dict[str, Any], arguments: str) -> str:
+    from . import json_codec
+
+    content = message.get("content") or ""
+    refs: Dict[str, str] = {}
+    status = ""
+    try:
+        data = json_codec.loads(content)
+    except json_codec.JSONDecodeError:
+        data = None
+    if isinstance(data, dict):
+        status = "，执行失败" if data.get("error") else ""
+        _collect_refs(data, refs)
+    parts = [f"{MASK_PREFIX} {message.get('name') or 'unknown'}({_clip(arguments, 200)}) → 原始结果 {len(content)} 字符{status}"]
+    if refs:
+        parts.append("引用：" + "，".join(f"{k}={v}" for k, v in refs.items()))
+    parts.append("内容已移出上下文，需要时重新调用工具，或通过上述引用（read_report / view_image 等）查看。")
+    return "；".join(parts)
+
+
+def mask_observations(messages: List[Dict[str, Any]], keep_recent: Optional[int] = None,
+                      min_chars: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int, int]:
+    """观测折叠：较早的大型工具结果替换为占位，返回 (新消息列表, 折叠条数, 节省字符数)
+
+    不改变消息条数与 tool_call_id 配对，请求始终合法；被折叠的消息换成新对象（原列表不变，
+    调用方负责从缓存中释放旧对象，见 MemoryManager.mask_observations）。已折叠的占位不会再次处理。
+    """
+    if keep_recent is None:
+        keep_recent = _int_env("OBSERVATION_KEEP_RECENT", 5)
+    if min_chars is None:
+        min_chars = _int_env("OBSERVATION_MASK_MIN_CHARS", 800)
+    tool_indexes = [i for i, m in enumerate(messages) if m.get("role") == "tool"]
+    candidates = tool_indexes[:max(0, len(tool_indexes) - keep_recent)]
+    if not candidates:
+        return messages, 0, 0
+
+    arguments: Dict[str, str] = {}
+    for message in messages:
+        for call in message.get("tool_calls") or []:
+            arguments[call.get("id", "")] = (call.get("function") or {}).get("arguments") or ""
+
+    result = messages
+    masked = 0
+    saved = 0
+    for i in candidates:
+        message = messages[i]
+        content = message.get("content")
+        if not isinstance(content, str) or len(content) < min_chars or content.startswith(MASK_PREFIX):
+            continue
+        stub = _observation_stub(message, arguments.get(message.get("tool_call_id", ""), ""))
+        if result is messages:
+            result = list(messages)
+        result[i] = {**message, "content": stub}
+        masked += 1
+        saved += len(content) - len(stub)
+    return result, masked, saved
+
+
+def render_summaries(summaries: List[Dict[str, Any]]) -> Optional[str]:
+    """分层摘要拼成上下文中的摘要文本（按时间顺序）"""
+    texts = [s["text"] for s in summaries if s.get("text")]
+    return "\n\n---\n\n".join(texts) if texts else None
+
+
+class CompactionEngine:
+    """分层压缩：plan() 决定摘要区间，summarize() 生成新的摘要列表
+
+    摘要列表按时间顺序排列，元素为 {"level": 层级, "text": 摘要}；一级摘要 level=0，
+    合并生成的摘要层级为被合并摘要的最高层级 + 1。
+    """
+
+    def __init__(self, model: str = "compact") -> None:
+        self.model = model
+
+    def plan(self, messages: List[Dict[str, Any]], context_length: int) -> Optional[Tuple[int, int]]:
+        """摘要覆盖的消息区间 [start, end)；没有可摘要的段落时返回 None
+
+        从最新的段落向前，在 COMPACT_KEEP_RATIO 的预算内原样保留（至少保留最后一段），
+        其余更早的段落（固定的系统提示除外）进入摘要。
+        """
+        pin = pinned_prefix(messages)
+        segments = split_segments(messages, pin)
+        if len(segments) < 2:
+            return None
+        budget = int(context_length * _float_env("COMPACT_KEEP_RATIO", 0.2))
+        kept = 1
+        used = segments[-1].tokens
+        while kept < len(segments) and used + segments[-kept - 1].tokens <= budget:
+            kept += 1
+            used += segments[-kept].tokens
+        if kept >= len(segments):
+            return None
+        return pin, segments[-kept].start
+
+    def _chunks(self, messages: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        limit = _int_env("COMPACT_CHUNK_TOKENS", 12000)
+        chunks: List[List[Dict[str, Any]]] = []
+        current: List[Dict[str, Any]] = []
+        used = 0
+        for segment in split_segments(messages, 0, limit):
+            if current and used + segment.tokens > limit:
+                chunks.append(current)
+                current, used = [], 0
+            current.extend(messages[segment.start:segment.end])
+            used += segment.tokens
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def _complete(self, prompt: str, text: str, hedge: bool = False) -> Optional[str]:
+        from .model_manager import model_manager
+
+        client = model_manager.get_model(self.model)
+        # 幂等的摘要请求：前台（硬阈值，阻塞用户轮次）时启用对冲，避免个别请求长尾卡住主循环；
+        # 后台预压缩不阻塞主循环，不做对冲，避免成倍的提示词费用
+        resp = await client.chat(
+            [{"role": "system", "content": prompt}, {"role": "user", "content": text}],
+            hedge=hedge,
+        )
+        if isinstance(resp, dict) and resp.get("error"):
+            logger.warning(f"⚠️ 上下文摘要失败: {resp.get('content')}")
+            return None
+        summary = resp.get("content") if isinstance(resp, dict) else str(resp)
+        return summary or None
+
+    async def summarize(self, summaries: List[Dict[str, Any]],
+                        messages: List[Dict[str, Any]], hedge: bool = False) -> Optional[List[Dict[str, Any]]]:
+        """为 messages 生成一级摘要（按块并行），追加到 summaries 后按扇入上限逐层合并
+
+        任一块摘要失败时返回 None（调用方保持原上下文不变）；合并失败时保留未合并的摘要。
+        hedge: 是否对摘要请求启用对冲（前台压缩阻塞用户轮次时使用）。
+        """
+        chunks = self._chunks(messages)
+        if not chunks:
+            return list(summaries)
+        leaves = await asyncio.gather(*(self._complete(LEAF_PROMPT, render_transcript(c), hedge) for c in chunks))
+        if not all(leaves):
+            return None
+        result = list(summaries) + [{"level": 0, "text": text} for text in leaves]
+
+        fan_in = max(2, _int_env("COMPACT_SUMMARY_FAN_IN", 4))
+        while len(result) > fan_in:
+            oldest = result[:fan_in]
+            merged = await self._complete(MERGE_PROMPT, "\n\n---\n\n".join(s["text"] for s in oldest), hedge)
+            if not merged:
+                break
+            result = [{"level": max(s.get("level", 0) for s in oldest) + 1, "text": merged}] + result[fan_in:]
+        logger.info(
+            f"🗜️ 分层摘要: {len(messages)} 条消息 → {len(chunks)} 块一级摘要，"
+            f"当前 {len(result)} 条摘要（最高层级 {max(s.get('level', 0) for s in result)}）"
+        )
+        return result
+
+
+# 单例，便于全局使用
+compaction_engine = CompactionEngine()
@@ -0,0 +1,136 @@
+"""
+多端点负载均衡与故障转移（EndpointBalancer）
+
+目标：
+- 同一模型指针可配置多个 base_url / api_key（逗号分隔），吞吐随 key 数量线性扩展
+- 按“在途请求最少”选择端点，空闲时轮转，避免单个 key 被打满
+- 跟踪端点健康：失败后按指数退避暂时摘除，冷却结束自动恢复
+- 请求失败（限流/5xx/超时/鉴权失败/熔断）时自动切换到下一个端点
+
+环境变量：
+- LLM_ENDPOINT_COOLDOWN: 端点失败后的基础冷却时长（秒），连续失败时指数增长，默认 10
+- LLM_ENDPOINT_MAX_COOLDOWN: 冷却时长上限（秒），默认 300
+"""
+from __future__ import annotations
+
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from core.http_pool import http_client_pool, key_fingerprint
+from core.httpx_openai_adapter import HttpxAsyncOpenAI
+from core.retry_policy import CircuitOpenError, LLMHTTPError, circuit_breakers, is_retryable
+
+logger = logging.getLogger(__name__)
+
+# 换一个 key 可能成功的状态码（鉴权失败、额度耗尽）
+_KEY_SPECIFIC_STATUS = {401, 402, 403}
+
+
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def should_failover(exc: BaseException) -> bool:
+    """该错误是否值得换一个端点重试（400 等请求本身的问题换端点也没用）"""
+    if isinstance(exc, CircuitOpenError):
+        return True
+    if isinstance(exc, LLMHTTPError) and exc.status_code in _KEY_SPECIFIC_STATUS:
+        return True
+    return is_retryable(exc)
+
+
+class EndpointState:
+    """单个端点（base_url + api_key）的运行状态"""
+
+    def __init__(self, base_url: Optional[str], api_key: Optional[str],
+                 client: Optional[HttpxAsyncOpenAI] = None) -> None:
+        self.base_url = base_url
+        self.api_key = api_key
+        self.fingerprint = key_fingerprint(api_key)
+        self._client = client
+        self.outstanding = 0
+        self.requests_total = 0
+        self.failures_total = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.latency_ewma: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def client(self) -> HttpxAsyncOpenAI:
+        # 每次从连接池取，连接池关闭重建后自动拿到新客户端
+        return self._client or http_client_pool.get_client(self.base_url, self.api_key)
+
+    @property
+    def label(self) -> str:
+        return f"{self.base_url or 'default'}#{self.fingerprint}"
+
+    def is_healthy(self, now: float) -> bool:
+        if self.unhealthy_until > now:
+            return False
+        return circuit_breakers.get(self.client.breaker_key).state != "open"
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "endpoint": self.label,
+            "healthy": self.is_healthy(now),
+            "cooldown": round(max(0.0, self.unhealthy_until - now), 1),
+            "outstanding": self.outstanding,
+            "requests_total": self.requests_total,
+            "failures_total": self.failures_total,
+            "latency_ewma": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "last_error": self.last_error,
+        }
+
+
+class EndpointBalancer:
+    """一个模型指针的端点集合：选择、计数与健康跟踪"""
+
+    def __init__(self, endpoints: List[EndpointState]) -> None:
+        self.endpoints = endpoints
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def candidates(self) -> List[EndpointState]:
+        """按优先级返回端点列表：健康端点按（在途数, 累计请求数）升序，冷却中的按恢复时间排在最后"""
+        now = time.monotonic()
+        healthy = [e for e in self.endpoints if e.is_healthy(now)]
+        cooling = [e for e in self.endpoints if not e.is_healthy(now)]
+        healthy.sort(key=lambda e: (e.outstanding, e.requests_total))
+        cooling.sort(key=lambda e: e.unhealthy_until)
+        return healthy + cooling
+
+    @staticmethod
+    def record_success(endpoint: EndpointState, latency: float) -> None:
+        endpoint.consecutive_failures = 0
+        endpoint.unhealthy_until = 0.0
+        if endpoint.latency_ewma is None:
+            endpoint.latency_ewma = latency
+        else:
+            endpoint.latency_ewma = endpoint.latency_ewma * 0.8 + latency * 0.2
+
+    @staticmethod
+    def record_failure(endpoint: EndpointState, exc: BaseException) -> None:
+        endpoint.failures_total += 1
+        endpoint.last_error = str(exc)[:200]
+        if not should_failover(exc):
+            return
+        endpoint.consecutive_failures += 1
+        base = _float_env("LLM_ENDPOINT_COOLDOWN", 10.0)
+        cap = _float_env("LLM_ENDPOINT_MAX_COOLDOWN", 300.0)
+        cooldown = min(cap, base * (2 ** min(endpoint.consecutive_failures - 1, 10)))
+        # 限流时优先采用服务端给出的等待时长
+        if isinstance(exc, LLMHTTPError) and exc.retry_after is not None:
+            cooldown = min(cap, exc.retry_after)
+        endpoint.unhealthy_until = time.monotonic() + cooldown
+        logger.warning(f"🩺 端点暂时摘除 {cooldown:.0f}s: {endpoint.label} ({type(exc).__name__})")
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [e.stats() for e in self.endpoints]
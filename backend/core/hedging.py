@@ -0,0 +1,137 @@
+"""
+LLM 对冲请求（Hedged Requests）
+
+目标：
+- 对幂等的短请求（生成标题、SubAgent 报告摘要等），主请求超过历史延迟分位数仍未返回时，
+  追加一个备份请求，谁先成功用谁，另一个取消
+- 每个模型指针维护滑动窗口延迟直方图，对冲等待时长随实际延迟自动调整
+- 对冲计时从主请求拿到限流名额、实际发出时开始：在限流器中排队不算慢，
+  此时追加备份请求只会在同一限流器上继续排队，徒增已饱和 key 的压力
+
+环境变量：
+- LLM_HEDGE_ENABLED: 全局开关（1 启用，默认 1；仅对调用方显式传 hedge=True 的请求生效）
+- LLM_HEDGE_PERCENTILE: 触发备份请求的延迟分位数，默认 95
+- LLM_HEDGE_MIN_SAMPLES: 样本数不足时使用 LLM_HEDGE_DEFAULT_DELAY，默认 20
+- LLM_HEDGE_DEFAULT_DELAY: 默认对冲等待（秒），默认 5
+- LLM_HEDGE_MIN_DELAY / LLM_HEDGE_MAX_DELAY: 对冲等待的上下限（秒），默认 0.5 / 30
+- LLM_HEDGE_WINDOW: 直方图滑动窗口大小（样本数），默认 200
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def hedging_enabled() -> bool:
+    return os.getenv("LLM_HEDGE_ENABLED", "1") == "1"
+
+
+class LatencyHistogram:
+    """滑动窗口延迟样本（按模型指针统计），提供分位数与对冲统计"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.samples: deque = deque(maxlen=max(10, int(_float_env("LLM_HEDGE_WINDOW", 200))))
+        self.hedges_fired = 0
+        self.hedges_won = 0
+
+    def record(self, latency: float) -> None:
+        self.samples.append(latency)
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+        return ordered[index]
+
+    def hedge_delay(self) -> float:
+        """当前的对冲等待时长：样本充足时取分位数，否则用默认值"""
+        if len(self.samples) < _float_env("LLM_HEDGE_MIN_SAMPLES", 20):
+            delay = _float_env("LLM_HEDGE_DEFAULT_DELAY", 5.0)
+        else:
+            delay = self.percentile(_float_env("LLM_HEDGE_PERCENTILE", 95.0))
+        return min(_float_env("LLM_HEDGE_MAX_DELAY", 30.0), max(_float_env("LLM_HEDGE_MIN_DELAY", 0.5), delay))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "samples": len(self.samples),
+            "p50": round(self.percentile(50), 3),
+            "p95": round(self.percentile(95), 3),
+            "p99": round(self.percentile(99), 3),
+            "hedge_delay": round(self.hedge_delay(), 3),
+            "hedges_fired": self.hedges_fired,
+            "hedges_won": self.hedges_won,
+        }
+
+
+def _is_success(result: Dict[str, Any]) -> bool:
+    return not result.get("error")
+
+
+async def hedged_call(
+    call: Callable[[asyncio.Event], Awaitable[Dict[str, Any]]],
+    histogram: LatencyHistogram,
+) -> Dict[str, Any]:
+    """执行对冲请求
+
+    Args:
+        call: 发起一次请求的协程函数，参数为"已发出"事件（拿到限流名额后 set），
+            返回 LLMClient.chat 的统一结构（失败时含 "error": True）
+        histogram: 所属指针的延迟直方图（决定等待时长并记录对冲统计）
+
+    Returns:
+        最先成功的结果；两个都失败时返回最后一个失败结果
+    """
+    sent = asyncio.Event()
+    primary = asyncio.create_task(call(sent))
+    tasks = {primary}
+    try:
+        # 主请求仍在限流器中排队时不计时
+        sent_waiter = asyncio.create_task(sent.wait())
+        try:
+            await asyncio.wait({primary, sent_waiter}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            sent_waiter.cancel()
+        if primary.done():
+            return primary.result()
+
+        done, _ = await asyncio.wait(tasks, timeout=histogram.hedge_delay())
+        if primary in done:
+            return primary.result()
+
+        # 主请求超过分位数延迟仍未返回：追加备份请求
+        histogram.hedges_fired += 1
+        logger.info(f"🪁 对冲请求: {histogram.name} 已等待 {histogram.hedge_delay():.2f}s，发起备份请求")
+        backup = asyncio.create_task(call(asyncio.Event()))
+        tasks.add(backup)
+
+        result: Dict[str, Any] = {}
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if _is_success(result):
+                    if task is backup:
+                        histogram.hedges_won += 1
+                    return result
+        return result
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        # 等待被取消的请求释放连接与限流名额
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
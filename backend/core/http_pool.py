@@ -0,0 +1,207 @@
+"""
+LLM HTTP 连接池注册表（HttpClientPool）
+
+目标：
+- 按 (base_url, api_key) 复用同一个 httpx.AsyncClient，避免每次 get_model() 都新建连接池
+- 同一提供商的所有模型指针（main/compact/quick/subagent）共享 TLS 连接与 HTTP/2 复用
+- 启动时预热连接，运行时输出连接池统计，FastAPI 关闭时统一释放
+
+环境变量：
+- API_REQUEST_TIMEOUT: 单次请求超时（秒），默认 600
+- API_MAX_RETRIES: 最大重试次数，默认 3
+- LLM_POOL_MAX_CONNECTIONS: 每个提供商的最大连接数，默认 100
+- LLM_POOL_MAX_KEEPALIVE: 每个提供商保持的空闲连接数，默认 20
+- LLM_WARMUP_ENABLED: 启动时是否预热连接（1 启用，默认 1）
+- LLM_WARMUP_TIMEOUT: 预热请求超时（秒），默认 10
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import httpx
+
+from core.httpx_openai_adapter import HttpxAsyncOpenAI
+from core.retry_policy import circuit_breakers, key_fingerprint
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+
+
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _int_env(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+class _PoolEntry:
+    """单个提供商的共享客户端及其统计信息"""
+
+    __slots__ = ("client", "base_url", "fingerprint", "created_at", "requests_total",
+                 "responses_total", "last_used")
+
+    def __init__(self, client: HttpxAsyncOpenAI, base_url: str, fingerprint: str) -> None:
+        self.client = client
+        self.base_url = base_url
+        self.fingerprint = fingerprint
+        self.created_at = time.time()
+        self.requests_total = 0
+        self.responses_total = 0
+        self.last_used: Optional[float] = None
+
+
+class HttpClientPool:
+    """按 (base_url, api_key) 共享的 OpenAI 兼容客户端注册表。
+
+    - get_client(): 返回共享的 HttpxAsyncOpenAI（同一 key 始终返回同一实例）
+    - warmup(): 并发向各提供商发起一次轻量请求，提前完成 DNS/TLS/HTTP2 握手
+    - stats(): 返回每个连接池的请求计数、连接状态与熔断状态
+    - aclose(): 关闭全部底层 httpx.AsyncClient
+    """
+
+    def __init__(self) -> None:
+        self._entries: Dict[Tuple[str, str], _PoolEntry] = {}
+
+    @staticmethod
+    def _normalize(base_url: Optional[str], api_key: Optional[str]) -> Tuple[str, str]:
+        # 如果未提供专用 key/base_url，回退到 OPENAI_*
+        url = (base_url or os.getenv("OPENAI_BASE_URL") or DEFAULT_BASE_URL).rstrip("/")
+        key = api_key or os.getenv("OPENAI_API_KEY") or ""
+        return url, key
+
+    def _create_entry(self, base_url: str, api_key: str) -> _PoolEntry:
+        # 配置超时时间（从环境变量读取，默认10分钟）
+        # 考虑到工具执行可能需要较长时间（例如访问慢速网站），设置较长的超时
+        timeout_seconds = _float_env("API_REQUEST_TIMEOUT", 600.0)
+        # 配置重试策略，默认重试3次，对502/503错误特别有效
+        max_retries = _int_env("API_MAX_RETRIES", 3)
+
+        entry_ref: Dict[str, _PoolEntry] = {}
+
+        async def _on_request(request: httpx.Request) -> None:
+            entry = entry_ref.get("entry")
+            if entry is not None:
+                entry.requests_total += 1
+                entry.last_used = time.time()
+
+        async def _on_response(response: httpx.Response) -> None:
+            entry = entry_ref.get("entry")
+            if entry is not None:
+                entry.responses_total += 1
+
+        http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout_seconds),
+            limits=httpx.Limits(
+                max_connections=_int_env("LLM_POOL_MAX_CONNECTIONS", 100),
+                max_keepalive_connections=_int_env("LLM_POOL_MAX_KEEPALIVE", 20),
+            ),
+            http2=True,
+            follow_redirects=True,
+            event_hooks={"request": [_on_request], "response": [_on_response]},
+        )
+
+        # 使用自定义httpx客户端替代OpenAI SDK，绕过CF盾拦截
+        client = HttpxAsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=http_client,
+            max_retries=max_retries,
+            timeout=timeout_seconds,
+        )
+        entry = _PoolEntry(client, base_url, key_fingerprint(api_key))
+        entry_ref["entry"] = entry
+        logger.info(f"🔌 创建共享LLM连接池: {base_url} (key={entry.fingerprint})")
+        return entry
+
+    def get_client(self, base_url: Optional[str], api_key: Optional[str]) -> HttpxAsyncOpenAI:
+        """获取 (base_url, api_key) 对应的共享客户端，不存在则创建"""
+        key = self._normalize(base_url, api_key)
+        entry = self._entries.get(key)
+        if entry is None or entry.client.http_client.is_closed:
+            entry = self._create_entry(*key)
+            self._entries[key] = entry
+        return entry.client
+
+    async def warmup(self, endpoints: Iterable[Tuple[Optional[str], Optional[str]]]) -> Dict[str, Any]:
+        """预热连接：对每个唯一提供商发起一次 GET /models（失败忽略）
+
+        Args:
+            endpoints: (base_url, api_key) 列表，重复项会被合并
+
+        Returns:
+            {base_url: "ok"|"HTTP xxx"|"错误信息"}
+        """
+        if os.getenv("LLM_WARMUP_ENABLED", "1") != "1":
+            return {}
+
+        unique = {self._normalize(url, key) for url, key in endpoints}
+        timeout = _float_env("LLM_WARMUP_TIMEOUT", 10.0)
+
+        async def _warm(base_url: str, api_key: str) -> Tuple[str, str]:
+            client = self.get_client(base_url, api_key)
+            try:
+                resp = await client.http_client.get(
+                    f"{client.base_url}/models",
+                    headers=client.headers,
+                    timeout=timeout,
+                )
+                return base_url, "ok" if resp.status_code < 400 else f"HTTP {resp.status_code}"
+            except Exception as e:
+                return base_url, f"{type(e).__name__}: {e}"
+
+        results = await asyncio.gather(*[_warm(url, key) for url, key in unique])
+        summary = dict(results)
+        logger.info(f"🔥 LLM连接预热完成: {summary}")
+        return summary
+
+    def stats(self) -> Dict[str, Any]:
+        """返回每个共享连接池的统计信息"""
+        pools = []
+        for entry in self._entries.values():
+            info: Dict[str, Any] = {
+                "base_url": entry.base_url,
+                "key": entry.fingerprint,
+                "closed": entry.client.http_client.is_closed,
+                "requests_total": entry.requests_total,
+                "responses_total": entry.responses_total,
+                "created_at": entry.created_at,
+                "last_used": entry.last_used,
+                "circuit": circuit_breakers.get(entry.client.breaker_key).stats(),
+            }
+            # httpcore 连接池内部状态（非公开接口，取不到时忽略）
+            try:
+                connections = entry.client.http_client._transport._pool.connections
+                info["connections"] = len(connections)
+                info["idle_connections"] = len([c for c in connections if c.is_idle()])
+            except Exception:
+                pass
+            pools.append(info)
+        return {"pools": pools, "count": len(pools)}
+
+    async def aclose(self) -> None:
+        """关闭全部共享客户端（FastAPI lifespan 关闭阶段调用）"""
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for entry in entries:
+            try:
+                await entry.client.close()
+            except Exception as e:
+                logger.warning(f"⚠️ 关闭LLM连接池失败: {entry.base_url} - {e}")
+        if entries:
+            logger.info(f"🔌 已关闭 {len(entries)} 个LLM连接池")
+
+
+# 单例，便于全局使用
+http_client_pool = HttpClientPool()
@@ -12,6 +12,8 @@ import os
 from typing import Any, Dict, List, Optional
 from dataclasses import dataclass
 
+from core.retry_policy import LLMHTTPError, endpoint_key, retry_policy
+
 
 @dataclass
 class ChatCompletionChoice:
@@ -49,6 +51,7 @@ class HttpxOpenAIClient:
     ):
         self.api_key = api_key
         self.base_url = base_url.rstrip('/')
+        self.breaker_key = endpoint_key(self.base_url, api_key)
         self.timeout = timeout
         self.max_retries = max_retries
 
@@ -100,67 +103,46 @@ class HttpxOpenAIClient:
             if tool_choice:
                 payload["tool_choice"] = tool_choice
 
-        for attempt in range(self.max_retries):
-            try:
-                response = await self.client.post(
-                    url,
-                    headers=self.headers,
-                    json=payload
+        async def _send() -> ChatCompletion:
+            response = await self.client.post(
+                url,
+                headers=self.headers,
+                json=payload
+            )
+            if response.status_code != 200:
+                raise LLMHTTPError.from_response(response)
+
+            data = response.json()
+
+            choices = [
+                ChatCompletionChoice(
+                    index=choice["index"],
+                    message=choice["message"],
+                    finish_reason=choice.get("finish_reason", "stop")
                 )
-
-                if response.status_code == 200:
-                    data = response.json()
-
-                    choices = [
-                        ChatCompletionChoice(
-                            index=choice["index"],
-                            message=choice["message"],
-                            finish_reason=choice.get("finish_reason", "stop")
-                        )
-                        for choice in data["choices"]
-                    ]
-
-                    usage = ChatCompletionUsage(
-                        prompt_tokens=data["usage"]["prompt_tokens"],
-                        completion_tokens=data["usage"]["completion_tokens"],
-                        total_tokens=data["usage"]["total_tokens"]
-                    )
-
-                    return ChatCompletion(
-                        id=data["id"],
-                        object=data["object"],
-                        created=data["created"],
-                        model=data["model"],
-                        choices=choices,
-                        usage=usage
-                    )
-
-                elif response.status_code in [502, 503, 429]:
-                    if attempt < self.max_retries - 1:
-                        import asyncio
-                        await asyncio.sleep(2 ** attempt)
-                        continue
-                    else:
-                        raise Exception(f"HTTP {response.status_code}: {response.text}")
-
-                else:
-                    raise Exception(f"HTTP {response.status_code}: {response.text}")
-
-            except httpx.TimeoutException:
-                if attempt < self.max_retries - 1:
-                    import asyncio
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                else:
-                    raise Exception("Request timeout")
-
-            except Exception as e:
-                if attempt < self.max_retries - 1:
-                    import asyncio
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                else:
-                    raise e
+                for choice in data["choices"]
+            ]
+
+            usage = ChatCompletionUsage(
+                prompt_tokens=data["usage"]["prompt_tokens"],
+                completion_tokens=data["usage"]["completion_tokens"],
+                total_tokens=data["usage"]["total_tokens"]
+            )
+
+            return ChatCompletion(
+                id=data["id"],
+                object=data["object"],
+                created=data["created"],
+                model=data["model"],
+                choices=choices,
+                usage=usage
+            )
+
+        # 与 httpx_openai_adapter 共用重试策略与熔断器
+        try:
+            return await retry_policy.call(_send, key=self.breaker_key, max_attempts=self.max_retries)
+        except httpx.TimeoutException as e:
+            raise Exception("Request timeout") from e
 
     async def close(self):
         """关闭客户端"""
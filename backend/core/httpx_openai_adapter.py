@@ -7,25 +7,38 @@ httpx实现的OpenAI SDK适配器 - 完全兼容原有接口
 3. 零侵入式替换,无需修改任何调用代码
 """
 import httpx
-import json
 import os
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 from dataclasses import dataclass, field
 
+from core import json_codec
+from core.retry_policy import LLMHTTPError, endpoint_key, retry_policy
+
+
+class Function:
+    """模拟OpenAI SDK的Function对象"""
+    __slots__ = ("name", "arguments")
+
+    def __init__(self, name: str, arguments: str):
+        self.name = name
+        self.arguments = arguments
+
 
 class ToolCall:
     """模拟OpenAI SDK的ToolCall对象"""
+    __slots__ = ("id", "type", "function")
+
     def __init__(self, data: Dict[str, Any]):
         self.id = data.get("id", "")
         self.type = data.get("type", "function")
-        self.function = type('Function', (), {
-            'name': data.get("function", {}).get("name", ""),
-            'arguments': data.get("function", {}).get("arguments", "{}")
-        })()
+        function = data.get("function") or {}
+        self.function = Function(function.get("name", ""), function.get("arguments", "{}"))
 
 
 class Message:
     """模拟OpenAI SDK的Message对象"""
+    __slots__ = ("content", "role", "tool_calls")
+
     def __init__(self, data: Dict[str, Any]):
         self.content = data.get("content")
         self.role = data.get("role", "assistant")
@@ -39,6 +52,8 @@ class Message:
 
 class Choice:
     """模拟OpenAI SDK的Choice对象"""
+    __slots__ = ("index", "message", "finish_reason")
+
     def __init__(self, data: Dict[str, Any]):
         self.index = data.get("index", 0)
         self.message = Message(data.get("message", {}))
@@ -47,21 +62,230 @@ class Choice:
 
 class Usage:
     """模拟OpenAI SDK的Usage对象"""
+    __slots__ = ("prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens")
+
     def __init__(self, data: Dict[str, Any]):
         self.prompt_tokens = data.get("prompt_tokens", 0)
         self.completion_tokens = data.get("completion_tokens", 0)
         self.total_tokens = data.get("total_tokens", 0)
+        # 提供商前缀缓存命中的 token 数：OpenAI 为 prompt_tokens_details.cached_tokens，
+        # DeepSeek 为 prompt_cache_hit_tokens
+        details = data.get("prompt_tokens_details") or {}
+        self.cached_tokens = details.get("cached_tokens") or data.get("prompt_cache_hit_tokens") or 0
 
 
 class ChatCompletion:
     """模拟OpenAI SDK的ChatCompletion对象"""
+    __slots__ = ("id", "object", "created", "model", "choices", "usage")
+
     def __init__(self, data: Dict[str, Any]):
         self.id = data.get("id", "")
         self.object = data.get("object", "chat.completion")
         self.created = data.get("created", 0)
         self.model = data.get("model", "")
         self.choices = [Choice(c) for c in data.get("choices", [])]
-        self.usage = Usage(data.get("usage", {}))
+        self.usage = Usage(data.get("usage") or {})
+
+
+class DeltaFunction:
+    """流式增量中的function片段"""
+    __slots__ = ("name", "arguments")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.name = data.get("name")
+        self.arguments = data.get("arguments")
+
+
+class ToolCallDelta:
+    """流式增量中的tool_call片段（按index拼接）"""
+    __slots__ = ("index", "id", "type", "function")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.index = data.get("index", 0)
+        self.id = data.get("id")
+        self.type = data.get("type")
+        self.function = DeltaFunction(data.get("function") or {})
+
+
+class Delta:
+    """模拟OpenAI SDK的ChoiceDelta对象"""
+    __slots__ = ("role", "content", "tool_calls")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.role = data.get("role")
+        self.content = data.get("content")
+        tool_calls_data = data.get("tool_calls")
+        if tool_calls_data:
+            self.tool_calls = [ToolCallDelta(tc) for tc in tool_calls_data]
+        else:
+            self.tool_calls = None
+
+
+class ChunkChoice:
+    """模拟OpenAI SDK的流式Choice对象"""
+    __slots__ = ("index", "delta", "finish_reason")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.index = data.get("index", 0)
+        self.delta = Delta(data.get("delta") or {})
+        self.finish_reason = data.get("finish_reason")
+
+
+class ChatCompletionChunk:
+    """模拟OpenAI SDK的ChatCompletionChunk对象（SSE中的一帧）"""
+    __slots__ = ("id", "object", "created", "model", "choices", "usage")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.id = data.get("id", "")
+        self.object = data.get("object", "chat.completion.chunk")
+        self.created = data.get("created", 0)
+        self.model = data.get("model", "")
+        self.choices = [ChunkChoice(c) for c in data.get("choices") or []]
+        usage = data.get("usage")
+        self.usage = Usage(usage) if usage else None
+
+
+class AsyncStream:
+    """模拟OpenAI SDK的AsyncStream：逐帧解析SSE响应
+
+    用法：
+        stream = await client.chat.completions.create(..., stream=True)
+        async for chunk in stream:
+            ...
+    迭代结束（或提前退出）时自动关闭底层响应。
+    """
+    def __init__(self, response: httpx.Response):
+        self.response = response
+
+    async def __aiter__(self):
+        try:
+            async for line in self.response.aiter_lines():
+                line = line.strip()
+                # 空行是事件分隔符，":" 开头是注释/keepalive，event: 行忽略
+                if not line or not line.startswith("data:"):
+                    continue
+                data_str = line[5:].strip()
+                if data_str == "[DONE]":
+                    break
+                data = json_codec.loads(data_str)
+                if isinstance(data, dict) and data.get("error"):
+                    raise Exception(f"Stream error: {data['error']}")
+                yield ChatCompletionChunk(data)
+        finally:
+            await self.close()
+
+    async def close(self):
+        await self.response.aclose()
+
+
+class StreamAccumulator:
+    """把流式增量拼装成完整的ChatCompletion
+
+    - add(chunk): 合并一帧，返回本帧新增的文本
+    - pop_ready_tool_calls(): 取出参数JSON已完整、尚未取出过的tool_call（用于提前派发）
+    - to_completion(): 生成与非流式接口相同结构的ChatCompletion对象
+    """
+    def __init__(self):
+        self.id = ""
+        self.model = ""
+        self.created = 0
+        self.content_parts: List[str] = []
+        self.tool_calls: Dict[int, Dict[str, Any]] = {}
+        self.finish_reason: Optional[str] = None
+        self.usage: Optional[Usage] = None
+        self._emitted: set = set()
+
+    def add(self, chunk: ChatCompletionChunk) -> str:
+        self.id = chunk.id or self.id
+        self.model = chunk.model or self.model
+        self.created = chunk.created or self.created
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+
+        new_text = ""
+        for choice in chunk.choices:
+            if choice.index != 0:
+                continue
+            delta = choice.delta
+            if delta.content:
+                self.content_parts.append(delta.content)
+                new_text += delta.content
+            if delta.tool_calls:
+                for tc in delta.tool_calls:
+                    slot = self.tool_calls.setdefault(tc.index, {
+                        "id": "",
+                        "type": "function",
+                        "function": {"name": "", "arguments": ""},
+                    })
+                    if tc.id:
+                        slot["id"] = tc.id
+                    if tc.type:
+                        slot["type"] = tc.type
+                    if tc.function.name:
+                        slot["function"]["name"] += tc.function.name
+                    if tc.function.arguments:
+                        slot["function"]["arguments"] += tc.function.arguments
+            if choice.finish_reason:
+                self.finish_reason = choice.finish_reason
+        return new_text
+
+    @property
+    def content(self) -> str:
+        return "".join(self.content_parts)
+
+    @staticmethod
+    def _ensure_id(index: int, slot: Dict[str, Any]) -> None:
+        # 个别兼容服务不返回id，按index补一个稳定id，保证结果能与调用对应
+        if not slot["id"]:
+            slot["id"] = f"call_{index}"
+
+    def pop_ready_tool_calls(self, final: bool = False) -> List[Dict[str, Any]]:
+        """取出已完整的tool_call（每个只返回一次）
+
+        判定完整：函数名已到达，且 arguments 能解析为JSON对象。
+        参数末尾不是 "}" 时直接跳过解析，避免长参数逐帧重复解析。
+        final=True（流结束）时剩余的调用全部取出，参数错误交给执行阶段报告。
+        """
+        ready = []
+        for index in sorted(self.tool_calls):
+            if index in self._emitted:
+                continue
+            slot = self.tool_calls[index]
+            if not final:
+                arguments = slot["function"]["arguments"]
+                if not slot["function"]["name"] or not arguments.rstrip().endswith("}"):
+                    continue
+                try:
+                    if not isinstance(json_codec.loads(arguments), dict):
+                        continue
+                except ValueError:
+                    continue
+            self._ensure_id(index, slot)
+            self._emitted.add(index)
+            ready.append(slot)
+        return ready
+
+    def to_completion(self) -> ChatCompletion:
+        message: Dict[str, Any] = {"role": "assistant", "content": self.content or None}
+        if self.tool_calls:
+            for index, slot in self.tool_calls.items():
+                self._ensure_id(index, slot)
+            message["tool_calls"] = [self.tool_calls[i] for i in sorted(self.tool_calls)]
+        usage = self.usage
+        completion = ChatCompletion({
+            "id": self.id,
+            "object": "chat.completion",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "message": message,
+                "finish_reason": self.finish_reason or ("tool_calls" if self.tool_calls else "stop"),
+            }],
+        })
+        if usage is not None:
+            completion.usage = usage
+        return completion
 
 
 class ChatCompletions:
@@ -76,9 +300,16 @@ class ChatCompletions:
         temperature: float = 0.2,
         tools: Optional[List[Dict[str, Any]]] = None,
         tool_choice: Optional[str] = None,
+        stream: bool = False,
+        max_attempts: Optional[int] = None,
         **kwargs
-    ) -> ChatCompletion:
-        """创建聊天补全 - 完全兼容OpenAI SDK接口"""
+    ) -> Union[ChatCompletion, AsyncStream]:
+        """创建聊天补全 - 完全兼容OpenAI SDK接口
+
+        stream=True 时返回 AsyncStream，按SSE帧逐个产出 ChatCompletionChunk；
+        重试只发生在收到首字节之前，流开始后的异常直接抛出。
+        max_attempts 覆盖客户端的重试次数（多端点故障转移时设为1，失败立即切换端点）。
+        """
 
         url = f"{self.client.base_url}/chat/completions"
 
@@ -94,44 +325,43 @@ class ChatCompletions:
             if tool_choice:
                 payload["tool_choice"] = tool_choice
 
-        for attempt in range(self.client.max_retries):
-            try:
-                response = await self.client.http_client.post(
-                    url,
-                    headers=self.client.headers,
-                    json=payload
-                )
-
-                if response.status_code == 200:
-                    data = response.json()
-                    return ChatCompletion(data)
-
-                elif response.status_code in [502, 503, 429]:
-                    if attempt < self.client.max_retries - 1:
-                        import asyncio
-                        await asyncio.sleep(2 ** attempt)
-                        continue
-                    else:
-                        raise Exception(f"HTTP {response.status_code}: {response.text}")
+        if stream:
+            payload["stream"] = True
 
-                else:
-                    raise Exception(f"HTTP {response.status_code}: {response.text}")
+        # 请求体只序列化一次，重试时复用；messages 由已缓存的消息片段拼接，只编码新增消息
+        body = json_codec.dumps_payload(payload)
 
-            except httpx.TimeoutException:
-                if attempt < self.client.max_retries - 1:
-                    import asyncio
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                else:
-                    raise Exception("Request timeout")
+        async def _send() -> Union[ChatCompletion, AsyncStream]:
+            if stream:
+                request = self.client.http_client.build_request(
+                    "POST",
+                    url,
+                    headers={**self.client.headers, "Accept": "text/event-stream"},
+                    content=body
+                )
+                response = await self.client.http_client.send(request, stream=True)
+                if response.status_code != 200:
+                    await response.aread()
+                    await response.aclose()
+                    raise LLMHTTPError.from_response(response)
+                return AsyncStream(response)
+
+            response = await self.client.http_client.post(
+                url,
+                headers=self.client.headers,
+                content=body
+            )
+            if response.status_code != 200:
+                raise LLMHTTPError.from_response(response)
+            return ChatCompletion(json_codec.loads(response.content))
 
-            except Exception as e:
-                if attempt < self.client.max_retries - 1:
-                    import asyncio
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-                else:
-                    raise e
+        # 重试策略：仅重试429/5xx/超时/连接错误，遵循Retry-After，按端点熔断
+        # 超时原样抛出（httpx.TimeoutException），由上层据此切换端点；面向用户的提示在 LLMClient 中生成
+        return await retry_policy.call(
+            _send,
+            key=self.client.breaker_key,
+            max_attempts=max_attempts or self.client.max_retries,
+        )
 
 
 class Chat:
@@ -162,6 +392,8 @@ class HttpxAsyncOpenAI:
         self.api_key = api_key
         self.base_url = base_url.rstrip('/')
         self.max_retries = max_retries
+        # 熔断按端点（base_url + key）区分，同一网关的多个 key 互不牵连
+        self.breaker_key = endpoint_key(self.base_url, api_key)
 
         self.headers = {
             "Authorization": f"Bearer {api_key}",
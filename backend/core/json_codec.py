@@ -0,0 +1,179 @@
+"""
+JSON 编解码（可选 orjson 加速）
+
+目标：
+- LLM 请求体（完整上下文）与响应、工具结果的序列化/解析是每轮迭代的固定 CPU 开销
+- 安装了 orjson 时使用 orjson（比标准库快数倍），否则回退到标准库
+- 输出统一为紧凑格式、不转义非 ASCII 字符（等价于 ensure_ascii=False）
+
+- 消息片段缓存：上下文中的每条消息只编码一次，请求体由缓存的片段拼接而成，
+  每轮迭代的编码开销只与新增消息成正比
+
+环境变量：
+- JSON_CODEC: auto（默认，有 orjson 用 orjson）/ json（强制标准库）
+- MESSAGE_FRAGMENT_CACHE_SIZE: 消息片段缓存条数，默认 4096
+- MESSAGE_FRAGMENT_CACHE_MB: 消息片段缓存总字节上限（MB），默认 256
+
+用法：
+    from core import json_codec
+    body = json_codec.dumps_bytes(payload)   # HTTP 请求体
+    text = json_codec.dumps(result)          # 工具结果等字符串
+    data = json_codec.loads(text_or_bytes)
+解析失败统一抛出 json.JSONDecodeError（orjson.JSONDecodeError 是其子类）。
+"""
+from __future__ import annotations
+
+import json
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+try:
+    if os.getenv("JSON_CODEC", "auto").strip().lower() == "json":
+        raise ImportError("JSON_CODEC=json")
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+BACKEND = "orjson" if _orjson is not None else "json"
+
+JSONDecodeError = json.JSONDecodeError
+
+_COMPACT = (",", ":")
+
+
+def _stdlib_dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=_COMPACT)
+
+
+if _orjson is not None:
+    _OPTIONS = _orjson.OPT_NON_STR_KEYS
+
+    def dumps_bytes(obj: Any) -> bytes:
+        """序列化为 UTF-8 字节（用于 HTTP 请求体）"""
+        try:
+            return _orjson.dumps(obj, option=_OPTIONS)
+        except TypeError:
+            # orjson 不支持的类型（如超过64位的整数），交给标准库处理
+            return _stdlib_dumps(obj).encode("utf-8")
+
+    def dumps(obj: Any) -> str:
+        """序列化为字符串"""
+        return dumps_bytes(obj).decode("utf-8")
+
+    def loads(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+        return _orjson.loads(data)
+
+else:
+
+    def dumps_bytes(obj: Any) -> bytes:
+        """序列化为 UTF-8 字节（用于 HTTP 请求体）"""
+        return _stdlib_dumps(obj).encode("utf-8")
+
+    def dumps(obj: Any) -> str:
+        """序列化为字符串"""
+        return _stdlib_dumps(obj)
+
+    def loads(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+
+# ---------------------------------------------------------------------------
+# 消息片段缓存
+# ---------------------------------------------------------------------------
+
+class MessageFragmentCache:
+    """按消息对象缓存编码后的 JSON 字节
+
+    与 TokenCounter 相同的约定：缓存 key 为消息对象的 id()，并持有消息引用避免 id 复用；
+    消息加入上下文后视为不可变（原地修改过的消息需调用 invalidate()），
+    被替换或移出上下文的消息调用 forget() 立即释放。
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None) -> None:
+        if max_entries is None:
+            try:
+                max_entries = int(os.getenv("MESSAGE_FRAGMENT_CACHE_SIZE", "4096"))
+            except Exception:
+                max_entries = 4096
+        if max_bytes is None:
+            try:
+                max_bytes = int(float(os.getenv("MESSAGE_FRAGMENT_CACHE_MB", "256")) * 1024 * 1024)
+            except Exception:
+                max_bytes = 256 * 1024 * 1024
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._cache: "OrderedDict[int, Tuple[Dict[str, Any], bytes]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        """单条消息的 JSON 字节（命中缓存时不重新编码）"""
+        key = id(message)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] is message:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return cached[1]
+        self.misses += 1
+        fragment = dumps_bytes(message)
+        if cached is not None:
+            self._bytes -= len(cached[1])
+        self._cache[key] = (message, fragment)
+        self._bytes += len(fragment)
+        while self._cache and (len(self._cache) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self._bytes -= len(evicted)
+        return fragment
+
+    def encode_list(self, messages: List[Dict[str, Any]]) -> bytes:
+        """消息列表的 JSON 数组字节：拼接各条消息的缓存片段"""
+        return _splice(self, messages, b"[", b"]")
+
+    def invalidate(self, message: Dict[str, Any]) -> None:
+        cached = self._cache.get(id(message))
+        if cached is not None and cached[0] is message:
+            del self._cache[id(message)]
+            self._bytes -= len(cached[1])
+
+    def forget(self, messages: Iterable[Dict[str, Any]]) -> None:
+        """释放已被替换或移出上下文的消息"""
+        for message in messages:
+            self.invalidate(message)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": BACKEND,
+            "cached_messages": len(self._cache),
+            "cached_bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _splice(fragments: MessageFragmentCache, messages: List[Dict[str, Any]], prefix: bytes, suffix: bytes) -> bytes:
+    # 前后缀并入首尾片段，整个请求体只做一次 join（大字节串反复拼接的拷贝开销不可忽略）
+    if not messages:
+        return prefix + suffix
+    parts = [fragments.encode(m) for m in messages]
+    parts[0] = prefix + parts[0]
+    parts[-1] = parts[-1] + suffix
+    return b",".join(parts)
+
+
+def dumps_payload(payload: Dict[str, Any], fragments: Optional[MessageFragmentCache] = None) -> bytes:
+    """序列化 chat/completions 请求体：messages 由消息片段拼接，其余字段正常编码"""
+    fragments = fragments or message_fragments
+    messages = payload.get("messages")
+    if not isinstance(messages, list):
+        return dumps_bytes(payload)
+    rest = dumps_bytes({k: v for k, v in payload.items() if k != "messages"})
+    suffix = b"]}" if rest == b"{}" else b"]," + rest[1:]
+    return _splice(fragments, messages, b'{"messages":[', suffix)
+
+
+# 单例，便于全局使用
+message_fragments = MessageFragmentCache()
@@ -3,23 +3,39 @@
 
 特性：
 - 短期记忆：当前会话消息
-- 中期记忆：当上下文超过阈值（92%）时用主模型生成摘要并替换早期消息
-- 对话持久化：自动保存对话历史到文件系统（data/conversations/）
+- 观测折叠：上下文超过折叠水位（50%）时，先在本地把较早的大型工具结果替换为占位（不调用模型）
+- 中期记忆：折叠后仍超过低水位（70%）时在后台生成摘要，完成后原子替换早期消息；
+  只有先触及硬阈值（92%）时才在前台等待摘要。摘要由分层压缩引擎（core/compaction.py）生成，
+  按轮次切分、不拆开 tool_call/tool 消息组
+- 对话持久化：自动保存对话历史到文件系统（data/conversations/），热会话缓存未命中时从此恢复
+- 历史同步：history_hash 标识服务端已持有的历史版本，前端只需发送增量消息
+- 检查点：轮次进行中加入的消息与完成的工具结果追加写入检查点日志（core/checkpoint.py），
+  进程中途退出后可在快照上重放恢复
+- 图片老化：较早的截图/图片替换为 file_id 文本引用，需要时通过 view_image 工具重新附上
 - 无长期存储与权限校验，符合"去安全复杂性"的要求
 
 参考思想：Kode-main 的 autoCompactCore（阈值与摘要策略）
 """
 from __future__ import annotations
 
+import asyncio
+import logging
 import os
-import json
+import hashlib
 import uuid
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, List, Optional
 
+from . import checkpoint
+from .compaction import compaction_engine, mask_observations, render_summaries
+from . import json_codec
+from .json_codec import message_fragments
 from .model_manager import model_manager
+from .tokenizer import token_counter
 
 
+logger = logging.getLogger(__name__)
+
 # 对话持久化目录
 CONVERSATION_DIR = os.path.join(os.getcwd(), "data", "conversations")
 
@@ -30,13 +46,24 @@ def _ensure_conversation_dir() -> None:
 
 
 def _save_conversation_to_disk(session_id: str, messages: List[Dict[str, Any]],
-                               mid_term_summary: Optional[str] = None) -> None:
+                               mid_term_summary: Optional[str] = None,
+                               image_refs: Optional[Dict[str, Dict[str, str]]] = None,
+                               summaries: Optional[List[Dict[str, Any]]] = None,
+                               history_hash: Optional[str] = None,
+                               snapshot_id: Optional[str] = None) -> bool:
     """保存对话到磁盘
 
     Args:
         session_id: 会话ID
         messages: 对话消息列表
         mid_term_summary: 中期摘要（如果有）
+        image_refs: 图片引用表（图片URL摘要 -> file_id/说明），用于老化时生成引用
+        summaries: 分层摘要列表（mid_term_summary 由其拼接而成）
+        history_hash: 历史版本标识（与前端同步增量消息用）
+        snapshot_id: 快照标识（检查点日志据此判断是否基于该快照）
+
+    Returns:
+        是否保存成功
     """
     _ensure_conversation_dir()
 
@@ -44,16 +71,25 @@ def _save_conversation_to_disk(session_id: str, messages: List[Dict[str, Any]],
         "session_id": session_id,
         "created_at": datetime.now().isoformat(),
         "mid_term_summary": mid_term_summary,
-        "messages": messages
+        "summaries": summaries or [],
+        "messages": messages,
+        "image_refs": image_refs or {},
+        "history_hash": history_hash,
+        "snapshot_id": snapshot_id,
     }
 
     file_path = os.path.join(CONVERSATION_DIR, f"{session_id}.json")
 
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(conversation_data, f, ensure_ascii=False, indent=2)
+        # 紧凑编码 + 先写临时文件再替换：长会话每轮重写的开销更小，中途失败也不会留下半截文件
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json_codec.dumps_bytes(conversation_data))
+        os.replace(tmp_path, file_path)
+        return True
     except Exception as e:
         print(f"⚠️ 保存对话失败: {e}")
+        return False
 
 
 def _load_conversation_from_disk(session_id: str) -> Optional[Dict[str, Any]]:
@@ -71,8 +107,8 @@ def _load_conversation_from_disk(session_id: str) -> Optional[Dict[str, Any]]:
         return None
 
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(file_path, "rb") as f:
+            return json_codec.loads(f.read())
     except Exception as e:
         print(f"⚠️ 加载对话失败: {e}")
         return None
@@ -93,15 +129,61 @@ def _get_auto_compact_ratio() -> float:
         return 0.92
 
 
+def _get_soft_compact_ratio(hard_ratio: float) -> float:
+    """后台预压缩的低水位，默认 0.7，且不高于硬阈值"""
+    try:
+        val = float(os.getenv("AUTO_COMPACT_SOFT_RATIO", "0.7"))
+        if not (0.0 < val < 1.0):
+            val = 0.7
+    except Exception:
+        val = 0.7
+    return min(val, hard_ratio)
+
+
+def _get_mask_ratio(soft_ratio: float) -> float:
+    """观测折叠的水位，默认 0.5，且不高于后台摘要的低水位"""
+    try:
+        val = float(os.getenv("OBSERVATION_MASK_RATIO", "0.5"))
+        if not (0.0 < val < 1.0):
+            val = 0.5
+    except Exception:
+        val = 0.5
+    return min(val, soft_ratio)
+
+
+def _int_env(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _image_key(url: str) -> str:
+    """图片URL（通常是 data URL）的摘要，作为引用表的 key"""
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+def _image_stub(ref: Optional[Dict[str, str]]) -> Dict[str, Any]:
+    """老化后的图片占位文本"""
+    if not ref or not ref.get("file_id"):
+        return {"type": "text", "text": "[较早的图片已移出上下文]"}
+    caption = ref.get("caption") or "图片"
+    return {
+        "type": "text",
+        "text": f"[图片已移出上下文：{caption}（file_id: {ref['file_id']}）。需要再次查看时调用 view_image]",
+    }
+
+
+def forget_messages(messages: Iterable[Dict[str, Any]]) -> None:
+    """消息被替换或移出上下文：从 token 计数与编码片段缓存中释放（两者都持有消息引用）"""
+    messages = list(messages)
+    token_counter.forget(messages)
+    message_fragments.forget(messages)
+
+
 def _estimate_tokens(messages: List[Dict[str, Any]]) -> int:
-    total_chars = 0
-    for m in messages:
-        c = m.get("content", "")
-        if isinstance(c, str):
-            total_chars += len(c)
-        else:
-            total_chars += len(str(c))
-    return max(1, total_chars // 4)
+    """估算消息列表的 token 数（分词器计数，图片按分辨率计价，按消息缓存）"""
+    return max(1, token_counter.count_messages(messages))
 
 
 class MemoryManager:
@@ -115,6 +197,23 @@ class MemoryManager:
         self.session_id = session_id or str(uuid.uuid4())
         self.short_term_memory: List[Dict[str, Any]] = []
         self.mid_term_summary: str | None = None
+        # 分层摘要（按时间顺序，{"level", "text"}），mid_term_summary 为其拼接结果
+        self.summaries: List[Dict[str, Any]] = []
+        self._summary_message: Optional[Dict[str, Any]] = None
+        # 图片引用表：图片URL摘要 -> {"file_id", "caption"}
+        self.image_refs: Dict[str, Dict[str, str]] = {}
+        # 后台预压缩：任务、快照时的结构版本与摘要覆盖的消息区间
+        self._compaction_task: Optional[asyncio.Task] = None
+        self._compaction_span: tuple = (0, 0)
+        self._compaction_generation = 0
+        self._generation = 0
+        # 历史版本标识：每轮成功结束时更新，轮次进行中为 None（前端须整体重发历史）
+        self.history_hash: Optional[str] = None
+        # 检查点：当前磁盘快照标识与进行中的日志
+        self.snapshot_id: Optional[str] = None
+        self._journal: Optional[checkpoint.CheckpointJournal] = None
+        # 本轮最后开始的迭代序号：轮次中途保存快照截断日志后需要重新写入
+        self._checkpoint_iteration: Optional[int] = None
 
         # 尝试加载历史对话
         if load_history and session_id:
@@ -122,52 +221,327 @@ class MemoryManager:
             if conversation_data:
                 self.short_term_memory = conversation_data.get("messages", [])
                 self.mid_term_summary = conversation_data.get("mid_term_summary")
+                self.summaries = conversation_data.get("summaries") or (
+                    [{"level": 0, "text": self.mid_term_summary}] if self.mid_term_summary else []
+                )
+                self.image_refs = conversation_data.get("image_refs") or {}
+                self.history_hash = conversation_data.get("history_hash")
+                self.snapshot_id = conversation_data.get("snapshot_id")
+
+    def reset(self) -> None:
+        """清空会话上下文（前端整体重发历史时重建）"""
+        self.cancel_background_compaction()
+        self.release_caches()
+        self.short_term_memory = []
+        self.mid_term_summary = None
+        self.summaries = []
+        self.history_hash = None
+        self._generation += 1
+
+    def begin_turn(self) -> None:
+        """新一轮开始：上下文即将被修改，作废旧的历史版本标识（上一轮未正常结束时遗留的检查点日志不再追加）"""
+        self.history_hash = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._checkpoint_iteration = None
+
+    def checkpoint_turn(self) -> None:
+        """本轮上下文已就绪、即将进入主循环：写入快照并开始记录检查点（清理上一轮遗留的 SubAgent 检查点）"""
+        if not checkpoint.checkpoint_enabled():
+            return
+        self.save_to_disk()
+        checkpoint.purge(f"{self.session_id}.")
+        self.start_checkpoint(self.session_id)
+
+    def end_turn(self) -> str:
+        """本轮成功结束：生成新的历史版本标识并持久化，检查点不再需要"""
+        self.history_hash = uuid.uuid4().hex
+        self.save_to_disk()
+        self.finish_checkpoint()
+        return self.history_hash
+
+    # ---------------- 检查点 ----------------
+
+    def start_checkpoint(self, key: str) -> None:
+        """开始记录检查点（覆盖同键的旧日志）"""
+        if not checkpoint.checkpoint_enabled():
+            return
+        self._journal = checkpoint.CheckpointJournal(key)
+        self._journal.start(self.snapshot_id)
+        self._checkpoint_iteration = None
+
+    def checkpoint(self, record: Dict[str, Any]) -> None:
+        """追加一条检查点记录（如 {"op": "tool", "message"} / {"op": "iteration", "iteration"}）"""
+        if record.get("op") == "iteration":
+            self._checkpoint_iteration = record.get("iteration")
+        if self._journal is not None:
+            self._journal.append(record)
+
+    def restore_checkpoint(self, key: str) -> Optional[Dict[str, Any]]:
+        """在当前上下文（磁盘快照）上重放检查点，并继续在该日志后追加
+
+        Returns:
+            checkpoint.replay() 的恢复信息；没有可用的检查点（不存在或基于其他快照）时返回 None
+        """
+        journal = checkpoint.CheckpointJournal(key)
+        records = journal.read()
+        if not records or records[0].get("op") != "start" or records[0].get("snapshot_id") != self.snapshot_id:
+            return None
+        info = checkpoint.replay(records, self.short_term_memory)
+        for message in self.short_term_memory[len(self.short_term_memory) - info["restored"]:]:
+            message_fragments.encode(message)
+        self._generation += 1
+        journal.resume()
+        self._journal = journal
+        self._checkpoint_iteration = info.get("iteration") or None
+        return info
+
+    def finish_checkpoint(self) -> None:
+        """正常结束：删除检查点日志"""
+        if self._journal is not None:
+            self._journal.remove()
+            self._journal = None
+        self._checkpoint_iteration = None
+
+    def release_caches(self) -> None:
+        """释放本会话消息在 token 计数与编码片段缓存中的条目（重置上下文、热会话淘汰时调用）"""
+        forget_messages(self.short_term_memory)
+        if self._summary_message is not None:
+            forget_messages([self._summary_message])
+            self._summary_message = None
+
+    def approx_bytes(self) -> int:
+        """上下文占用的近似字节数（按编码后的JSON片段，命中片段缓存时无需重新编码）"""
+        return sum(len(message_fragments.encode(m)) for m in self.short_term_memory) + len(self.mid_term_summary or "")
 
     def load_messages(self, messages: List[Dict[str, Any]]) -> None:
         self.short_term_memory.extend(messages)
 
     def add_message(self, message: Dict[str, Any]) -> None:
         self.short_term_memory.append(message)
+        self.checkpoint({"op": "add", "message": message})
+        # 加入时即编码并缓存JSON片段，之后每轮构造请求体直接拼接，不再重复编码历史消息
+        message_fragments.encode(message)
+
+    def register_image(self, url: str, file_id: Optional[str], caption: str = "") -> None:
+        """登记上下文中图片对应的 file_id 与一句话说明（老化时用于生成引用）"""
+        if file_id:
+            # 同一张图再次附上（如 view_image）时保留最初的说明
+            self.image_refs.setdefault(_image_key(url), {"file_id": file_id, "caption": caption})
+
+    def age_images(self) -> int:
+        """图片老化：把较早的 image_url 替换为 file_id 文本引用，返回本次替换的图片数
+
+        从新到旧遍历，满足任一条件的图片被替换：
+        - 之后已有 IMAGE_MAX_AGE_TURNS 条助手回复（模型已看过多次，默认 2）
+        - 更新的图片已占满 IMAGE_TOKEN_BUDGET（默认 4000 tokens）
+        当前轮次（之后还没有助手回复）的图片始终保留。
+        被替换的消息整体换成新对象，旧对象（含 base64 图片）随即从 token 计数与编码片段缓存中释放。
+        """
+        max_age = _int_env("IMAGE_MAX_AGE_TURNS", 2)
+        budget = _int_env("IMAGE_TOKEN_BUDGET", 4000)
+        replies_after = 0
+        used = 0
+        aged = 0
+        for i in range(len(self.short_term_memory) - 1, -1, -1):
+            message = self.short_term_memory[i]
+            if message.get("role") == "assistant":
+                replies_after += 1
+                continue
+            content = message.get("content")
+            if not isinstance(content, list):
+                continue
+            new_content: Optional[List[Any]] = None
+            for j, part in enumerate(content):
+                if not isinstance(part, dict) or part.get("type") != "image_url":
+                    continue
+                tokens = token_counter.count_part(part)
+                if replies_after > 0 and (replies_after >= max_age or used + tokens > budget):
+                    image = part.get("image_url") or {}
+                    url = image.get("url", "") if isinstance(image, dict) else str(image)
+                    if new_content is None:
+                        new_content = list(content)
+                    new_content[j] = _image_stub(self.image_refs.get(_image_key(url)))
+                    aged += 1
+                else:
+                    used += tokens
+            if new_content is not None:
+                self.short_term_memory[i] = {**message, "content": new_content}
+                forget_messages([message])
+        return aged
 
     def get_context(self) -> List[Dict[str, Any]]:
-        ctx: List[Dict[str, Any]] = []
+        """模型上下文：开头的固定系统提示 → 会话摘要 → 其余消息
+
+        摘要放在固定系统提示之后，逐字节稳定的人格与工具说明始终是请求前缀，摘要重新生成时提供商前缀缓存仍可命中
+        """
+        # 开头连续的 system 消息（固定系统提示）
+        pinned = 0
+        while pinned < len(self.short_term_memory) and self.short_term_memory[pinned].get("role") == "system":
+            pinned += 1
+        ctx: List[Dict[str, Any]] = self.short_term_memory[:pinned]
         if self.mid_term_summary:
-            ctx.append({"role": "system", "content": f"会话摘要：\n{self.mid_term_summary}"})
-        ctx.extend(self.short_term_memory)
+            # 复用同一个摘要消息对象，token 计数可命中缓存
+            if self._summary_message is None or self._summary_message["content"] != f"会话摘要：\n{self.mid_term_summary}":
+                if self._summary_message is not None:
+                    forget_messages([self._summary_message])
+                self._summary_message = {"role": "system", "content": f"会话摘要：\n{self.mid_term_summary}"}
+            ctx.append(self._summary_message)
+        ctx.extend(self.short_term_memory[pinned:])
         return ctx
 
+    def count_tokens(self) -> int:
+        """当前上下文的 token 数（已计数的消息直接取缓存，只计算新增消息）"""
+        return _estimate_tokens(self.get_context())
+
     def save_to_disk(self) -> None:
-        """保存当前对话到磁盘"""
-        _save_conversation_to_disk(
+        """保存当前对话到磁盘（新快照已包含之前的检查点记录，日志随之截断）
+
+        轮次中途保存（如压缩后）时，截断后的日志重新写入当前迭代序号，恢复时仍从该迭代继续。
+        """
+        snapshot_id = uuid.uuid4().hex
+        saved = _save_conversation_to_disk(
             self.session_id,
             self.short_term_memory,
-            self.mid_term_summary
+            self.mid_term_summary,
+            self.image_refs,
+            self.summaries,
+            self.history_hash,
+            snapshot_id,
         )
-
-    async def check_and_compact(self) -> Dict[str, Any]:
-        messages = self.get_context()
-        tokens = _estimate_tokens(messages)
-        main_profile = model_manager.get_profile("main")
+        if saved:
+            self.snapshot_id = snapshot_id
+            if self._journal is not None:
+                self._journal.start(snapshot_id)
+                if self._checkpoint_iteration is not None:
+                    self._journal.append({"op": "iteration", "iteration": self._checkpoint_iteration})
+
+    # ---------------- 压缩 ----------------
+
+    def _thresholds(self) -> tuple:
+        """(折叠水位, 后台摘要低水位, 硬阈值)，单位 token"""
+        context_length = model_manager.get_profile("main").context_length
         ratio = _get_auto_compact_ratio()
-        threshold = int(main_profile.context_length * ratio)
-        if tokens < threshold:
-            return {"compacted": False, "tokens": tokens, "threshold": threshold}
+        soft_ratio = _get_soft_compact_ratio(ratio)
+        mask = int(context_length * _get_mask_ratio(soft_ratio))
+        return mask, int(context_length * soft_ratio), int(context_length * ratio)
 
-        prompt = (
-            "请根据当前对话生成结构化中文摘要，保留：项目背景/关键信息/已完成/待办/注意事项，"
-            "用于继续协作。输出应简洁、要点化。"
-        )
-        # 使用压缩模型进行摘要
-        client = model_manager.get_model("compact")
-        resp = await client.chat(messages + [{"role": "user", "content": prompt}])
-        summary = resp.get("content") if isinstance(resp, dict) else str(resp)
-        if not summary:
-            summary = "(自动压缩失败：未能生成摘要)"
+    def mask_observations(self) -> int:
+        """观测折叠（本地、无模型调用），返回折叠的工具结果条数
 
-        self.mid_term_summary = summary
-        self.short_term_memory = self.short_term_memory[-6:]
+        只在超过折叠水位时由 check_and_compact() 调用，并一次折叠全部较早的结果：
+        改写历史会使提供商前缀缓存失效，集中处理比逐条折叠失效次数少。
+        """
+        previous = self.short_term_memory
+        self.short_term_memory, masked, saved = mask_observations(previous)
+        if masked:
+            forget_messages(old for old, new in zip(previous, self.short_term_memory) if old is not new)
+            logger.info(f"🙈 观测折叠: {masked} 条较早的工具结果已替换为占位，节省约 {saved} 字符")
+        return masked
+
+    def _compaction_plan(self) -> Optional[tuple]:
+        """摘要覆盖的消息区间 [start, end)：固定保留系统提示，最近的段落在预算内原样保留"""
+        return compaction_engine.plan(self.short_term_memory, model_manager.get_profile("main").context_length)
+
+    def _summarize(self, start: int, end: int, hedge: bool = False):
+        # 创建时即取快照，后台任务运行期间新增的消息不受影响
+        return compaction_engine.summarize(list(self.summaries), self.short_term_memory[start:end], hedge=hedge)
+
+    def _swap_in_summary(self, summaries: List[Dict[str, Any]], start: int, end: int) -> None:
+        """原子替换：摘要取代 [start, end) 区间，区间之后（含摘要期间新增）的消息原样保留"""
+        self.summaries = summaries
+        self.mid_term_summary = render_summaries(summaries)
+        forget_messages(self.short_term_memory[start:end])
+        self.short_term_memory = self.short_term_memory[:start] + self.short_term_memory[end:]
+        self._generation += 1
+
+    def maybe_compact_in_background(self) -> bool:
+        """上下文超过低水位时启动后台摘要（已有任务在跑则跳过），返回是否新启动了任务
+
+        适合在等待工具执行等空闲时机调用；摘要完成后由 check_and_compact() 换入。
+        """
+        if self._compaction_task is not None:
+            return False
+        _, soft, _ = self._thresholds()
+        if self.count_tokens() < soft:
+            return False
+        plan = self._compaction_plan()
+        if plan is None:
+            return False
+        self._compaction_span = plan
+        self._compaction_generation = self._generation
+        self._compaction_task = asyncio.create_task(self._summarize(*plan))
+        logger.info(f"🗜️ 上下文超过低水位，后台预压缩已启动 (session={self.session_id})")
+        return True
+
+    def _apply_background_compaction(self) -> bool:
+        """后台摘要已完成时换入，返回是否换入成功"""
+        task = self._compaction_task
+        if task is None or not task.done():
+            return False
+        self._compaction_task = None
+        if task.cancelled() or task.exception() is not None:
+            return False
+        summaries = task.result()
+        # 快照之后上下文结构被改写过（例如已经前台压缩），摘要作废
+        if not summaries or self._generation != self._compaction_generation:
+            return False
+        self._swap_in_summary(summaries, *self._compaction_span)
+        return True
+
+    def cancel_background_compaction(self) -> None:
+        if self._compaction_task is not None and not self._compaction_task.done():
+            self._compaction_task.cancel()
+        self._compaction_task = None
+
+    async def check_and_compact(self) -> Dict[str, Any]:
+        """逐级压缩上下文
+
+        1. 换入已完成的后台摘要
+        2. 超过折叠水位：本地折叠较早的工具结果
+        3. 仍超过低水位：启动后台摘要；仍超过硬阈值：前台等待摘要
+        """
+        applied = self._apply_background_compaction()
+        tokens = self.count_tokens()
+        mask, soft, threshold = self._thresholds()
+        masked = 0
+        if tokens >= mask:
+            masked = self.mask_observations()
+            if masked:
+                tokens = self.count_tokens()
+        if tokens < threshold:
+            background = self.maybe_compact_in_background() if tokens >= soft else False
+            if applied or masked:
+                self.save_to_disk()
+            return {
+                "compacted": applied,
+                "masked": masked,
+                "tokens": tokens,
+                "threshold": threshold,
+                "background": background or self._compaction_task is not None,
+            }
+
+        # 硬阈值：已有后台任务则等它完成，否则前台同步摘要
+        if self._compaction_task is not None:
+            try:
+                await asyncio.shield(self._compaction_task)
+            except Exception:
+                pass
+            if self._apply_background_compaction():
+                self.save_to_disk()
+                return {"compacted": True, "masked": masked, "tokens": tokens, "threshold": threshold, "background": False}
+
+        plan = self._compaction_plan()
+        if plan is None:
+            return {"compacted": False, "masked": masked, "tokens": tokens, "threshold": threshold, "background": False}
+        # 前台压缩阻塞用户轮次：摘要请求启用对冲
+        summaries = await self._summarize(*plan, hedge=True)
+        if not summaries:
+            summaries = self.summaries + [{"level": 0, "text": "(自动压缩失败：未能生成摘要)"}]
+        self._swap_in_summary(summaries, *plan)
 
         # 保存压缩后的对话
         self.save_to_disk()
 
-        return {"compacted": True, "tokens": tokens, "threshold": threshold}
+        return {"compacted": True, "masked": masked, "tokens": tokens, "threshold": threshold, "background": False}
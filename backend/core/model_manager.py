@@ -10,14 +10,52 @@
 """
 from __future__ import annotations
 
+import asyncio
+import logging
 import os
-from dataclasses import dataclass
-from typing import Any, Dict, Optional
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
+import httpx
 from dotenv import load_dotenv
 
+from core.endpoint_balancer import EndpointBalancer, EndpointState, should_failover
+from core.hedging import LatencyHistogram, hedged_call, hedging_enabled
+from core.http_pool import http_client_pool
+from core.rate_limiter import KeyLimiter, RateLease, rate_limiter
+from core.json_codec import message_fragments
+from core.tokenizer import token_counter
+from services.usage_ledger import usage_ledger
+from core.httpx_openai_adapter import HttpxAsyncOpenAI, StreamAccumulator
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _error_text(exc: BaseException) -> str:
+    """面向用户的错误提示（httpx 超时异常本身的文本常为空）"""
+    if isinstance(exc, httpx.TimeoutException):
+        return "[LLM错误] Request timeout"
+    return f"[LLM错误] {exc}"
+
+
+def _estimate_request_tokens(messages: list[dict[str, Any]], tools: list[dict[str, Any]] | None = None) -> int:
+    """估算请求 token 数，仅用于 TPM 预约，响应后按 usage 校正"""
+    total = token_counter.count_messages(messages)
+    if tools:
+        total += len(str(tools)) // 4
+    return max(1, total)
+
 
 @dataclass
 class ModelProfile:
@@ -26,10 +64,11 @@ class ModelProfile:
     - name: 指针名或配置名（如：main/quick/task/reasoning）
     - provider: 提供商标识（openai/azure/other），此处仅作标记
     - model: 实际调用的模型名（如 gpt-4o、gpt-4o-mini、o4-mini 等）
-    - api_key: 对应服务的 API Key
-    - base_url: OpenAI 兼容 API 的 base url，可为空走默认
+    - api_key: 对应服务的 API Key（多端点时为第一个）
+    - base_url: OpenAI 兼容 API 的 base url，可为空走默认（多端点时为第一个）
     - context_length: 上下文窗口大小（token），用于触发压缩
-    - extra: 其他扩展参数（如 reasoning 配置等）
+    - extra: 其他扩展参数（如 reasoning 配置、限流额度等）
+    - endpoints: 全部 (base_url, api_key) 端点，用于负载均衡与故障转移；为空时取 base_url/api_key
     """
 
     name: str
@@ -39,64 +78,49 @@ class ModelProfile:
     base_url: Optional[str] = None
     context_length: int = 200_000
     extra: Dict[str, Any] = None
+    endpoints: List[Tuple[Optional[str], Optional[str]]] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        if not self.endpoints:
+            self.endpoints = [(self.base_url, self.api_key)]
 
 
 class LLMClient:
     """简单的 LLM 客户端封装，适配 OpenAI 兼容接口。
 
-    仅实现最小可用：非流式聊天。
+    支持非流式聊天 chat() 与流式聊天 chat_stream()。
 
     特性：
-    - 速率限制：通过 LLM_MIN_INTERVAL 环境变量控制请求间隔（秒）
+    - 连接复用：底层客户端来自 http_client_pool，按 (base_url, api_key) 共享
+    - 多端点：按在途请求最少选择端点，失败自动切换，见 core/endpoint_balancer.py
+    - 速率限制：按 (base_url, model) 独立的令牌桶（RPM/TPM/并发），见 core/rate_limiter.py
     - 自动重试：通过 API_MAX_RETRIES 环境变量控制重试次数
     - 超时控制：通过 API_REQUEST_TIMEOUT 环境变量控制超时时间
     """
 
-    # 类级别的速率限制器（跨实例共享，避免多个LLMClient绕过限制）
-    _rate_limiter_lock = None  # 延迟初始化，避免事件循环问题
-    _last_call_times: Dict[str, float] = {}  # {model_key: timestamp}
-
-    def __init__(self, profile: ModelProfile):
-        from core.httpx_openai_adapter import HttpxAsyncOpenAI
-        import httpx
-        import asyncio
-
+    def __init__(self, profile: ModelProfile, client: Optional[HttpxAsyncOpenAI] = None):
         self.profile = profile
-        # 如果未提供专用 key/base_url，回退到 OPENAI_*
-        api_key = profile.api_key or os.getenv("OPENAI_API_KEY")
-        base_url = profile.base_url or os.getenv("OPENAI_BASE_URL")
-
-        # 配置超时时间（从环境变量读取，默认5分钟）
-        # 考虑到工具执行可能需要较长时间（例如访问慢速网站），设置较长的超时
-        try:
-            timeout_seconds = float(os.getenv("API_REQUEST_TIMEOUT", "600"))
-        except Exception:
-            timeout_seconds = 600.0
+        # 同一 (base_url, api_key) 共享一个 HTTP/2 连接池，避免每次请求重新握手
+        # 超时与重试配置由连接池统一读取（API_REQUEST_TIMEOUT / API_MAX_RETRIES）
+        if client is not None:
+            endpoints = [EndpointState(profile.base_url, profile.api_key, client=client)]
+        else:
+            endpoints = [EndpointState(url, key) for url, key in profile.endpoints]
+        self.balancer = EndpointBalancer(endpoints)
+        # 非流式请求的延迟直方图，驱动对冲请求的等待时长
+        self.latency = LatencyHistogram(profile.name)
+        # token 用量与前缀缓存命中统计
+        self.usage_totals: Dict[str, int] = {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "completion_tokens": 0,
+        }
 
-        # 配置重试策略（指数退避）
-        # 默认重试3次，对502/503错误特别有效
-        try:
-            max_retries = int(os.getenv("API_MAX_RETRIES", "3"))
-        except Exception:
-            max_retries = 3
-
-        # 创建自定义 httpx 客户端，设置超时和浏览器标识
-        http_client = httpx.AsyncClient(
-            timeout=httpx.Timeout(timeout_seconds),
-            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
-            http2=True,
-            follow_redirects=True
-        )
-
-        # 使用自定义httpx客户端替代OpenAI SDK，绕过CF盾拦截
-        # 完全兼容OpenAI SDK的接口和返回对象结构
-        self.client = HttpxAsyncOpenAI(
-            api_key=api_key,
-            base_url=base_url,
-            http_client=http_client,
-            max_retries=max_retries,
-            timeout=timeout_seconds
-        )
+    @property
+    def client(self) -> HttpxAsyncOpenAI:
+        """首个端点的客户端（兼容单端点用法）"""
+        return self.balancer.endpoints[0].client
 
     async def chat(
         self,
@@ -104,7 +128,8 @@ class LLMClient:
         temperature: float = 0.2,
         override_model: str | None = None,
         tools: list[dict[str, Any]] | None = None,
-        tool_choice: str | None = None
+        tool_choice: str | None = None,
+        hedge: bool = False
     ) -> Dict[str, Any]:
         """调用聊天补全，返回统一结构：{"content": str, "raw": 原始响应}。
 
@@ -114,17 +139,34 @@ class LLMClient:
             override_model: 覆盖模型名称
             tools: OpenAI格式的工具定义列表
             tool_choice: 工具选择策略 ("auto", "required", "none")
+            hedge: 对冲请求（仅用于幂等的短请求）：超过该指针历史延迟分位数未返回时发起备份请求，先成功者胜出
 
         Returns:
             {"content": str, "raw": 原始响应对象}
         """
-        # 速率限制：避免高频调用导致API 502错误
-        await self._apply_rate_limit()
+        if hedge and hedging_enabled():
+            return await hedged_call(
+                lambda sent: self._chat_once(messages, temperature, override_model, tools, tool_choice, sent),
+                self.latency,
+            )
+        return await self._chat_once(messages, temperature, override_model, tools, tool_choice)
 
+    async def _chat_once(
+        self,
+        messages: list[dict[str, Any]],
+        temperature: float,
+        override_model: str | None,
+        tools: list[dict[str, Any]] | None,
+        tool_choice: str | None,
+        sent: asyncio.Event | None = None
+    ) -> Dict[str, Any]:
+        """发起一次非流式请求（chat() 的实际实现）；sent 在拿到限流名额、请求发出时 set（对冲计时用）"""
+        model = override_model or self.profile.model
+        started = time.monotonic()
         try:
             # 构建请求参数
             request_params = {
-                "model": (override_model or self.profile.model),
+                "model": model,
                 "messages": messages,
                 "temperature": temperature,
             }
@@ -136,58 +178,199 @@ class LLMClient:
                 if tool_choice:
                     request_params["tool_choice"] = tool_choice
 
-            resp = await self.client.chat.completions.create(**request_params)
+            async with self._open(request_params, _estimate_request_tokens(messages, tools), sent) as (resp, lease):
+                self._record_usage(resp.usage, lease)
+            self._record_ledger(model, resp.usage, started)
 
             content = resp.choices[0].message.content or ""
             return {"content": content, "raw": resp}
         except Exception as e:
+            self._record_ledger(model, None, started, ok=False)
             # 失败时返回可诊断信息
-            return {"content": f"[LLM错误] {e}", "error": True}
+            return {"content": _error_text(e), "error": True}
 
-    async def _apply_rate_limit(self) -> None:
-        """应用速率限制，避免高频调用API导致502错误
+    async def chat_stream(
+        self,
+        messages: list[dict[str, Any]],
+        temperature: float = 0.2,
+        override_model: str | None = None,
+        tools: list[dict[str, Any]] | None = None,
+        tool_choice: str | None = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """流式聊天补全：边生成边产出文本增量。
 
-        通过环境变量 LLM_MIN_INTERVAL 控制请求间隔（秒），默认0表示不限制。
-        使用类级别的锁和时间戳字典，确保跨实例生效。
-        """
-        import asyncio
-        import time
+        产出事件：
+        - {"type": "content", "data": "增量文本"}   逐token到达
+        - {"type": "tool_call", "data": {...}}    某个tool_call参数已完整（可提前派发执行）
+        - {"type": "final", "content": str, "raw": ChatCompletion, "streamed": bool}
+          最后一帧，raw 与 chat() 的返回结构一致（含拼装好的 tool_calls）；
+          失败时附带 "error": True，content 为可诊断信息
 
-        # 延迟初始化锁（避免在模块加载时创建，可能导致事件循环问题）
-        if LLMClient._rate_limiter_lock is None:
-            LLMClient._rate_limiter_lock = asyncio.Lock()
+        通过环境变量 LLM_STREAM=0 可关闭流式，退化为一次性调用 chat()。
+        """
+        if os.getenv("LLM_STREAM", "1") != "1":
+            resp = await self.chat(messages, temperature, override_model, tools, tool_choice)
+            yield {"type": "final", "streamed": False, **resp}
+            return
 
-        # 读取配置：最小请求间隔（秒）
+        model = override_model or self.profile.model
+        request_params: Dict[str, Any] = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": True,
+        }
+        if tools:
+            request_params["tools"] = tools
+            if tool_choice:
+                request_params["tool_choice"] = tool_choice
+        # 让提供商在最后一帧附带 usage（不支持的提供商可通过环境变量关闭）
+        if os.getenv("LLM_STREAM_INCLUDE_USAGE", "1") == "1":
+            request_params["stream_options"] = {"include_usage": True}
+
+        accumulator = StreamAccumulator()
+        streamed = False
+        started = time.monotonic()
         try:
-            min_interval = float(os.getenv("LLM_MIN_INTERVAL", "0"))
-        except Exception:
-            min_interval = 0
-
-        # 如果不限制，直接返回
-        if min_interval <= 0:
+            # 速率限制与端点名额在整个流期间占用，流结束后按 usage 校正 TPM
+            async with self._open(request_params, _estimate_request_tokens(messages, tools)) as (stream, lease):
+                try:
+                    async for chunk in stream:
+                        new_text = accumulator.add(chunk)
+                        if new_text:
+                            streamed = True
+                            yield {"type": "content", "data": new_text}
+                        for tool_call in accumulator.pop_ready_tool_calls():
+                            yield {"type": "tool_call", "data": tool_call}
+                finally:
+                    # 消费方提前退出时也要释放连接
+                    await stream.close()
+                    self._record_usage(accumulator.usage, lease)
+        except Exception as e:
+            self._record_ledger(model, accumulator.usage, started, ok=False, stream=True)
+            if not streamed:
+                yield {"type": "final", "content": _error_text(e), "error": True, "streamed": False}
+                return
+            # 流已开始：把错误追加到已输出内容之后，保证前端与记忆一致
+            error_text = "\n" + _error_text(e)
+            yield {"type": "content", "data": error_text}
+            yield {
+                "type": "final",
+                "content": accumulator.content + error_text,
+                "error": True,
+                "streamed": True,
+            }
             return
 
-        # 生成模型唯一标识（base_url + model，避免不同API混淆）
-        model_key = f"{self.profile.base_url or 'default'}:{self.profile.model}"
+        self._record_ledger(model, accumulator.usage, started, stream=True)
 
-        async with LLMClient._rate_limiter_lock:
-            last_time = LLMClient._last_call_times.get(model_key, 0)
-            elapsed = time.time() - last_time
+        for tool_call in accumulator.pop_ready_tool_calls(final=True):
+            yield {"type": "tool_call", "data": tool_call}
 
-            # 如果距离上次调用不足最小间隔，等待
-            if elapsed < min_interval:
-                wait_time = min_interval - elapsed
-                await asyncio.sleep(wait_time)
+        yield {
+            "type": "final",
+            "content": accumulator.content,
+            "raw": accumulator.to_completion(),
+            "streamed": streamed,
+        }
 
-            # 更新最后调用时间
-            LLMClient._last_call_times[model_key] = time.time()
+    @asynccontextmanager
+    async def _open(
+        self, request_params: Dict[str, Any], est_tokens: int, sent: asyncio.Event | None = None
+    ) -> AsyncIterator[Tuple[Any, RateLease]]:
+        """选择端点并发起请求，产出 (响应或流, 限流凭证)
+
+        - 按 balancer.candidates() 的顺序尝试；还有备选端点时每个端点只试一次，失败立即切换
+        - 最后一个端点按完整重试策略执行
+        - 限流与在途计数在 async with 块结束（含流式读取完毕）后才释放
+        """
+        candidates = self.balancer.candidates()
+        for i, endpoint in enumerate(candidates):
+            is_last = i == len(candidates) - 1
+            # 速率限制：按 base_url + model + key 独立计算，多个 key 的额度可叠加
+            lease = rate_limiter.acquire(
+                self._get_limiter(request_params["model"], endpoint),
+                est_tokens,
+            )
+            async with lease:
+                if sent is not None:
+                    sent.set()
+                endpoint.outstanding += 1
+                endpoint.requests_total += 1
+                started = time.monotonic()
+                try:
+                    try:
+                        resp = await endpoint.client.chat.completions.create(
+                            **request_params,
+                            max_attempts=None if is_last else 1,
+                        )
+                    except Exception as e:
+                        self.balancer.record_failure(endpoint, e)
+                        if is_last or not should_failover(e):
+                            raise
+                        logger.warning(f"🔀 端点请求失败，切换到下一个端点: {endpoint.label} - {e}")
+                        continue
+                    latency = time.monotonic() - started
+                    self.balancer.record_success(endpoint, latency)
+                    if not request_params.get("stream"):
+                        self.latency.record(latency)
+                    yield resp, lease
+                    return
+                finally:
+                    endpoint.outstanding -= 1
+
+    def _record_usage(self, usage: Any, lease: RateLease) -> None:
+        """记录响应 usage：校正 TPM 预约，并累计 token 与缓存命中统计"""
+        if usage is None or not usage.total_tokens:
+            return
+        lease.record_usage(usage.total_tokens)
+        totals = self.usage_totals
+        totals["requests"] += 1
+        totals["prompt_tokens"] += usage.prompt_tokens or 0
+        totals["cached_tokens"] += usage.cached_tokens or 0
+        totals["completion_tokens"] += usage.completion_tokens or 0
+
+    def _record_ledger(self, model: str, usage: Any, started: float, ok: bool = True, stream: bool = False) -> None:
+        """写入用量账本（会话/Agent/迭代归属由 usage_ledger 从上下文读取）"""
+        usage_ledger.record(
+            pointer=self.profile.name,
+            model=model,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0),
+            completion_tokens=getattr(usage, "completion_tokens", 0),
+            cached_tokens=getattr(usage, "cached_tokens", 0),
+            latency=time.monotonic() - started,
+            ok=ok,
+            stream=stream,
+            price=(self.profile.extra or {}).get("price"),
+        )
+
+    def usage_stats(self) -> Dict[str, Any]:
+        """token 用量与前缀缓存命中率"""
+        totals = self.usage_totals
+        hit_rate = totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+        return {**totals, "cache_hit_rate": round(hit_rate, 4)}
+
+    def _get_limiter(self, model: str, endpoint: EndpointState) -> KeyLimiter:
+        """获取端点 + 模型对应的限流器，限额来自 profile.extra（由 env 加载）"""
+        extra = self.profile.extra or {}
+        key = rate_limiter.make_key(endpoint.base_url, model)
+        if len(self.balancer) > 1:
+            key = f"{key}#{endpoint.fingerprint}"
+        return rate_limiter.get(
+            key,
+            rpm=extra.get("rpm", 0),
+            tpm=extra.get("tpm", 0),
+            max_inflight=extra.get("max_inflight", 0),
+            min_interval=_float_env("LLM_MIN_INTERVAL", 0.0),
+            source=self.profile.name,
+        )
 
 
 class ModelManager:
     """多模型管理器。
 
     - 通过 env 加载四类指针模型：main/quick/task/reasoning
-    - 提供 get_model(pointer) 返回 LLMClient
+    - 提供 get_model(pointer) 返回 LLMClient（按指针缓存，底层连接池共享）
     - 提供 get_profile(pointer) 以便读取 context_length 等参数
     - 内置指针回退逻辑：未知指针 → main
     """
@@ -205,6 +388,7 @@ class ModelManager:
             "browser_agent": "browser_agent",
             "windows_agent": "windows_agent",
         }
+        self._clients: Dict[str, LLMClient] = {}
 
     def _load_profiles_from_env(self) -> Dict[str, ModelProfile]:
         def _int_env(name: str, default: int) -> int:
@@ -213,13 +397,45 @@ class ModelManager:
             except Exception:
                 return default
 
+        def _is_float(value: Optional[str]) -> bool:
+            try:
+                float(value)
+                return True
+            except (TypeError, ValueError):
+                return False
+
+        def _split_env(name: str) -> List[Optional[str]]:
+            values = [v.strip() for v in (os.getenv(name) or "").split(",") if v.strip()]
+            return values or [None]
+
         # Helper: 读取单个 profile 组
         def read_group(prefix: str, fallback_model: str) -> ModelProfile:
             provider = os.getenv(f"{prefix}_PROVIDER", "openai").strip()
             model = os.getenv(f"{prefix}_MODEL", fallback_model).strip()
-            api_key = os.getenv(f"{prefix}_API_KEY")
-            base_url = os.getenv(f"{prefix}_BASE_URL")
+            # 多端点：BASE_URL / API_KEY 均可逗号分隔
+            # 数量相同时一一配对，否则两两组合（如一个网关 + 多个 key）
+            base_urls = _split_env(f"{prefix}_BASE_URL")
+            api_keys = _split_env(f"{prefix}_API_KEY")
+            if len(base_urls) == len(api_keys):
+                endpoints = list(zip(base_urls, api_keys))
+            else:
+                endpoints = [(url, key) for url in base_urls for key in api_keys]
+            base_url, api_key = endpoints[0]
             context_length = _int_env(f"{prefix}_CONTEXT_LENGTH", 200_000)
+            # 限流额度：{PREFIX}_RPM / _TPM / _MAX_INFLIGHT 覆盖全局 LLM_RPM / LLM_TPM / LLM_MAX_INFLIGHT
+            extra: Dict[str, Any] = {
+                "rpm": _int_env(f"{prefix}_RPM", _int_env("LLM_RPM", 0)),
+                "tpm": _int_env(f"{prefix}_TPM", _int_env("LLM_TPM", 0)),
+                "max_inflight": _int_env(f"{prefix}_MAX_INFLIGHT", _int_env("LLM_MAX_INFLIGHT", 0)),
+            }
+            # 成本（可选）：每百万 token 价格
+            price = {
+                kind: float(os.getenv(f"{prefix}_PRICE_{kind.upper()}"))
+                for kind in ("input", "cached", "output")
+                if _is_float(os.getenv(f"{prefix}_PRICE_{kind.upper()}"))
+            }
+            if price:
+                extra["price"] = price
             return ModelProfile(
                 name=prefix.lower(),
                 provider=provider,
@@ -227,7 +443,8 @@ class ModelManager:
                 api_key=api_key,
                 base_url=base_url,
                 context_length=context_length,
-                extra={},
+                extra=extra,
+                endpoints=endpoints,
             )
 
         profiles = {
@@ -249,7 +466,35 @@ class ModelManager:
 
     def get_model(self, pointer: str) -> LLMClient:
         profile = self.get_profile(pointer)
-        return LLMClient(profile)
+        client = self._clients.get(profile.name)
+        if client is None:
+            client = LLMClient(profile)
+            self._clients[profile.name] = client
+        return client
+
+    async def warmup(self) -> Dict[str, Any]:
+        """预热所有已配置模型的连接（启动时调用）"""
+        return await http_client_pool.warmup(
+            endpoint for p in self.profiles.values() for endpoint in p.endpoints
+        )
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """连接池统计信息（含每个已使用指针的端点健康状态、延迟分布与缓存命中率）"""
+        stats = http_client_pool.stats()
+        stats["endpoints"] = {name: client.balancer.stats() for name, client in self._clients.items()}
+        stats["latency"] = {name: client.latency.stats() for name, client in self._clients.items()}
+        stats["usage"] = {name: client.usage_stats() for name, client in self._clients.items()}
+        stats["fragments"] = message_fragments.stats()
+        return stats
+
+    def rate_limit_stats(self) -> Dict[str, Any]:
+        """限流统计信息（每个 base_url + model 的排队深度、在途数与等待时长）"""
+        return rate_limiter.stats()
+
+    async def aclose(self) -> None:
+        """关闭所有共享连接（FastAPI 关闭时调用）"""
+        self._clients.clear()
+        await http_client_pool.aclose()
 
 
 # 单例，便于全局使用
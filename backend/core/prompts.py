@@ -4,11 +4,15 @@
 - 整合七海人格设定
 - 提供高精度时间戳
 - 管理工具使用说明
+
+布局（利于提供商前缀缓存）：
+- 稳定前缀：人格设定 + 工具使用说明（get_system_message），每次请求逐字节相同
+- 易变尾部：当前时间 / 长期记忆 / TODO提醒（get_volatile_message），追加在用户消息之后
 """
 from __future__ import annotations
 
 from datetime import datetime
-from typing import Dict, Any
+from typing import Any, Dict, Optional
 
 
 # 七海人格设定（基于七海设定.txt）
@@ -173,7 +177,7 @@ def get_current_timestamp() -> str:
 
 
 def build_system_prompt(tool_descriptions: str = "") -> str:
-    """构建完整的系统提示词
+    """构建稳定的系统提示词（不含时间等易变内容，保证前缀缓存可命中）
 
     Args:
         tool_descriptions: 工具描述列表（由工具管理器生成）
@@ -181,13 +185,8 @@ def build_system_prompt(tool_descriptions: str = "") -> str:
     Returns:
         完整的系统提示词
     """
-    timestamp = get_current_timestamp()
-
     # 基础提示词
-    prompt_parts = [
-        f"# 当前时间\n\n{timestamp}\n",
-        NANAMI_PERSONALITY,
-    ]
+    prompt_parts = [NANAMI_PERSONALITY]
 
     # 如果有工具，添加工具说明
     if tool_descriptions:
@@ -197,6 +196,26 @@ def build_system_prompt(tool_descriptions: str = "") -> str:
     return "\n\n".join(prompt_parts)
 
 
+VOLATILE_HEADER = "# 当前时间"
+
+
+def build_volatile_context(ltm_content: str = "", todo_reminder: str = "") -> str:
+    """构建易变上下文：当前时间、长期记忆、TODO提醒
+
+    这些内容每次请求都可能变化，放在消息列表末尾，避免破坏前面的缓存前缀。
+
+    Args:
+        ltm_content: 长期记忆 Markdown（为空则不注入）
+        todo_reminder: 未完成TODO提醒（为空则不注入）
+    """
+    parts = [f"{VOLATILE_HEADER}\n\n{get_current_timestamp()}"]
+    if ltm_content and ltm_content.strip():
+        parts.append(f"## 哥哥的长期偏好（从历史对话中提炼）\n\n{ltm_content}")
+    if todo_reminder:
+        parts.append(todo_reminder)
+    return "\n\n".join(parts)
+
+
 def get_system_message(tool_descriptions: str = "") -> Dict[str, Any]:
     """获取系统消息（OpenAI格式）
 
@@ -210,3 +229,26 @@ def get_system_message(tool_descriptions: str = "") -> Dict[str, Any]:
         "role": "system",
         "content": build_system_prompt(tool_descriptions)
     }
+
+
+def get_volatile_message(ltm_content: str = "", todo_reminder: str = "") -> Dict[str, Any]:
+    """获取易变上下文消息（OpenAI格式），应追加在当前用户消息之后"""
+    return {
+        "role": "system",
+        "content": build_volatile_context(ltm_content, todo_reminder)
+    }
+
+
+def retire_volatile_message(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """上一轮的易变上下文在新一轮中只保留时间（长期记忆/TODO提醒已由新一轮重新注入）
+
+    Returns:
+        精简后的消息；不是易变上下文或已经精简过时返回 None
+    """
+    content = message.get("content")
+    if message.get("role") != "system" or not isinstance(content, str) or not content.startswith(VOLATILE_HEADER):
+        return None
+    head = "\n\n".join(content.split("\n\n", 2)[:2])
+    if head == content:
+        return None
+    return {"role": "system", "content": head}
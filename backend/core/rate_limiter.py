@@ -0,0 +1,277 @@
+"""
+LLM 请求限流器（按 base_url + model 独立限流）
+
+目标：
+- 取代 LLMClient 中的全局锁：不同提供商/模型之间互不阻塞（main 不再被 search_agent 拖慢）
+- 令牌桶同时约束 RPM（每分钟请求数）与 TPM（每分钟 token 数）
+- 预约式扣减：扣减在同步代码中完成，等待期间不持有任何锁
+- 每个 key 可配置最大并发在途请求数
+- 多个指针（如 main/task）共用同一 key 时按最严格的额度合并；配置变化时就地更新，桶内余量不回满
+- 暴露排队深度、等待时长等实时统计
+
+环境变量（全局默认，可被 {PREFIX}_RPM / {PREFIX}_TPM / {PREFIX}_MAX_INFLIGHT 按模型覆盖）：
+- LLM_RPM: 每分钟最大请求数，默认 0（不限制）
+- LLM_TPM: 每分钟最大 token 数（按请求估算、响应 usage 校正），默认 0（不限制）
+- LLM_MAX_INFLIGHT: 每个 key 同时在途的最大请求数，默认 0（不限制）
+- LLM_MIN_INTERVAL: 同一 key 两次请求的最小间隔（秒），默认 0；保留以兼容旧配置
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _TokenBucket:
+    """令牌桶：容量 = 每分钟额度，按秒匀速回填，允许透支（透支部分即需要等待的时长）"""
+
+    __slots__ = ("capacity", "rate", "level", "updated_at")
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount: float, now: float) -> Tuple[float, float]:
+        """预约 amount 个令牌，返回 (需要等待的秒数（0 表示立即可用）, 实际扣除的令牌数)"""
+        self._refill(now)
+        # 单次请求超过桶容量时按容量计，避免永远等不到；归还与校正都以实际扣除数为准
+        taken = min(amount, self.capacity)
+        self.level -= taken
+        if self.level >= 0:
+            return 0.0, taken
+        return -self.level / self.rate, taken
+
+    def refund(self, amount: float) -> None:
+        """归还（或在 amount<0 时追加扣除）令牌"""
+        self.level = min(self.capacity, self.level + amount)
+
+    def resize(self, per_minute: float, now: float) -> None:
+        """调整每分钟额度，保留当前余量（超过新容量时截断），透支部分继续计入等待"""
+        self._refill(now)
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = min(self.capacity, self.level)
+
+
+class KeyLimiter:
+    """单个 (base_url, model) 的限流状态"""
+
+    def __init__(self, key: str, rpm: float, tpm: float, max_inflight: int, min_interval: float) -> None:
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_inflight = max_inflight
+        self.min_interval = min_interval
+        self.requests = _TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = _TokenBucket(tpm) if tpm > 0 else None
+        self.semaphore = asyncio.Semaphore(max_inflight) if max_inflight > 0 else None
+        # 并发上限变化时，等空闲后再替换 semaphore（避免在途请求释放到新 semaphore）
+        self._pending_inflight: Optional[int] = None
+        self._next_slot = 0.0
+
+        # 统计
+        self.waiting = 0
+        self.in_flight = 0
+        self.total_requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    @staticmethod
+    def _resize_bucket(bucket: Optional[_TokenBucket], per_minute: float, now: float) -> Optional[_TokenBucket]:
+        if per_minute <= 0:
+            return None
+        if bucket is None:
+            return _TokenBucket(per_minute)
+        if bucket.capacity != per_minute:
+            bucket.resize(per_minute, now)
+        return bucket
+
+    def configure(self, rpm: float, tpm: float, max_inflight: int, min_interval: float) -> None:
+        """就地更新限额：令牌桶保留当前余量（不因配置变化回满），并发上限在空闲时才替换"""
+        now = time.monotonic()
+        self.rpm, self.tpm, self.min_interval = rpm, tpm, min_interval
+        self.requests = self._resize_bucket(self.requests, rpm, now)
+        self.tokens = self._resize_bucket(self.tokens, tpm, now)
+        self._pending_inflight = max_inflight if max_inflight != self.max_inflight else None
+        self._apply_pending_inflight()
+
+    def _apply_pending_inflight(self) -> None:
+        if self._pending_inflight is None or self.in_flight or self.waiting:
+            return
+        self.max_inflight = self._pending_inflight
+        self.semaphore = asyncio.Semaphore(self.max_inflight) if self.max_inflight > 0 else None
+        self._pending_inflight = None
+
+    def _reserve(self, est_tokens: int) -> Tuple[float, Optional[float], float]:
+        """同步完成所有预约扣减，返回 (需要等待的秒数, 预约的最小间隔时间槽, 实际预约的 token 数)"""
+        now = time.monotonic()
+        wait = 0.0
+        slot: Optional[float] = None
+        reserved = 0.0
+        if self.min_interval > 0:
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval
+            wait = max(wait, slot - now)
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1, now)[0])
+        if self.tokens is not None:
+            token_wait, reserved = self.tokens.reserve(est_tokens, now)
+            wait = max(wait, token_wait)
+        return wait, slot, reserved
+
+    def _release_reservation(self, reserved_tokens: float, slot: Optional[float]) -> None:
+        """请求发出前被取消：归还已预约的额度，并撤回时间槽
+
+        时间槽只在仍是最后一个预约时撤回；之后已有请求预约时，它们的时间槽已经确定，
+        空出的间隔只影响这些已排队的请求，不会继续推迟后续请求
+        """
+        if self.requests is not None:
+            self.requests.refund(1)
+        if self.tokens is not None:
+            self.tokens.refund(reserved_tokens)
+        if slot is not None and self._next_slot == slot + self.min_interval:
+            self._next_slot = slot
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "key": self.key,
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "max_inflight": self.max_inflight,
+            "min_interval": self.min_interval,
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "total_requests": self.total_requests,
+            "avg_wait": round(self.total_wait / self.total_requests, 3) if self.total_requests else 0.0,
+            "max_wait": round(self.max_wait, 3),
+            "last_wait": round(self.last_wait, 3),
+            "requests_available": round(self.requests.level, 2) if self.requests is not None else None,
+            "tokens_available": round(self.tokens.level) if self.tokens is not None else None,
+        }
+
+
+class RateLease:
+    """一次请求的限流凭证（async with 使用），退出时释放并发名额并按实际 usage 校正 TPM"""
+
+    def __init__(self, limiter: KeyLimiter, est_tokens: int) -> None:
+        self.limiter = limiter
+        self.est_tokens = est_tokens
+        # 实际从 TPM 桶扣除的 token 数（预估超过桶容量时按容量扣除）
+        self.reserved_tokens = 0.0
+        self.actual_tokens: Optional[int] = None
+        self.wait_time = 0.0
+
+    def record_usage(self, total_tokens: Optional[int]) -> None:
+        """记录响应中的实际 token 用量（用于校正 TPM 预估）"""
+        if total_tokens:
+            self.actual_tokens = int(total_tokens)
+
+    async def __aenter__(self) -> "RateLease":
+        limiter = self.limiter
+        started = time.monotonic()
+        limiter.waiting += 1
+        wait, slot, self.reserved_tokens = limiter._reserve(self.est_tokens)
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if limiter.semaphore is not None:
+                await limiter.semaphore.acquire()
+        except asyncio.CancelledError:
+            # 节流等待或等待并发名额期间被取消（如对冲请求落败、轮次停止）：请求未发出，归还预约
+            limiter._release_reservation(self.reserved_tokens, slot)
+            raise
+        finally:
+            limiter.waiting -= 1
+
+        self.wait_time = time.monotonic() - started
+        limiter.in_flight += 1
+        limiter.total_requests += 1
+        limiter.total_wait += self.wait_time
+        limiter.last_wait = self.wait_time
+        limiter.max_wait = max(limiter.max_wait, self.wait_time)
+        if self.wait_time >= 1:
+            logger.info(f"⏳ 限流等待 {self.wait_time:.2f}s: {limiter.key}")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        limiter = self.limiter
+        limiter.in_flight -= 1
+        if limiter.semaphore is not None:
+            limiter.semaphore.release()
+        limiter._apply_pending_inflight()
+        if limiter.tokens is not None and self.actual_tokens is not None:
+            limiter.tokens.refund(self.reserved_tokens - self.actual_tokens)
+
+
+class RateLimiter:
+    """限流器注册表：每个 (base_url, model) 一个独立的 KeyLimiter
+
+    同一 key 可能被多个指针使用（如 main 与 task 配置了同一个模型），各自的额度按来源记录，
+    生效额度取最严格的组合：RPM/TPM/并发上限取正值中的最小值，最小间隔取最大值。
+    """
+
+    def __init__(self) -> None:
+        self._limiters: Dict[str, KeyLimiter] = {}
+        # key -> {来源（指针名）: (rpm, tpm, max_inflight, min_interval)}
+        self._configs: Dict[str, Dict[str, Tuple[float, float, int, float]]] = {}
+
+    @staticmethod
+    def make_key(base_url: Optional[str], model: str) -> str:
+        return f"{(base_url or 'default').rstrip('/')}:{model}"
+
+    @staticmethod
+    def _strictest(configs: Any) -> Tuple[float, float, int, float]:
+        def _min_positive(values: Any) -> Any:
+            positive = [v for v in values if v > 0]
+            return min(positive) if positive else 0
+
+        configs = list(configs)
+        return (
+            _min_positive(c[0] for c in configs),
+            _min_positive(c[1] for c in configs),
+            _min_positive(c[2] for c in configs),
+            max(c[3] for c in configs),
+        )
+
+    def get(
+        self,
+        key: str,
+        rpm: float = 0,
+        tpm: float = 0,
+        max_inflight: int = 0,
+        min_interval: float = 0,
+        source: str = "default",
+    ) -> KeyLimiter:
+        """获取 key 对应的限流器；source（指针名）的配置变化（如 .env 热更新）时就地更新限额"""
+        sources = self._configs.setdefault(key, {})
+        sources[source] = (rpm, tpm, max_inflight, min_interval)
+        config = self._strictest(sources.values())
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = KeyLimiter(key, *config)
+            self._limiters[key] = limiter
+        elif (limiter.rpm, limiter.tpm, limiter.max_inflight, limiter.min_interval) != config:
+            limiter.configure(*config)
+        else:
+            limiter._apply_pending_inflight()
+        return limiter
+
+    def acquire(self, limiter: KeyLimiter, est_tokens: int = 0) -> RateLease:
+        return RateLease(limiter, est_tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"limiters": [limiter.stats() for limiter in self._limiters.values()]}
+
+
+# 单例，便于全局使用
+rate_limiter = RateLimiter()
@@ -0,0 +1,317 @@
+"""
+LLM 请求重试策略与熔断器（httpx_openai_adapter 与 httpx_client 共用）
+
+目标：
+- 区分可重试错误（429/5xx/超时/连接错误）与致命错误（400/401/403/404 等），致命错误立即抛出
+- 遵循服务端退避提示：retry-after-ms / Retry-After / x-ratelimit-reset-*
+- 退避使用 decorrelated jitter，避免多个会话同时重试造成惊群
+- 按端点（base_url + API Key 指纹）熔断：同一网关的多个 key 各自熔断，连续失败达到阈值后短时间内直接失败，不再每个会话各自白等
+
+环境变量：
+- LLM_RETRY_BASE_DELAY: 退避基础时长（秒），默认 0.5
+- LLM_RETRY_MAX_DELAY: 单次退避上限（秒），默认 20
+- LLM_RETRY_MAX_SERVER_DELAY: 服务端要求等待超过该值（秒）时不再重试，默认 60
+- LLM_CIRCUIT_FAILURE_THRESHOLD: 连续失败多少次后熔断，默认 5（0 关闭熔断）
+- LLM_CIRCUIT_RESET_TIMEOUT: 熔断持续时长（秒），到期后放行一个探测请求，默认 30
+"""
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import hashlib
+import logging
+import os
+import random
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, TypeVar
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 可重试的HTTP状态码（限流、网关错误、服务端过载）
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524, 529}
+
+
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+class LLMHTTPError(Exception):
+    """LLM 接口返回非 200 状态码"""
+
+    def __init__(self, status_code: int, text: str, headers: Optional[Mapping[str, str]] = None) -> None:
+        super().__init__(f"HTTP {status_code}: {text}")
+        self.status_code = status_code
+        self.text = text
+        self.retry_after = parse_retry_after(headers or {})
+
+    @classmethod
+    def from_response(cls, response: httpx.Response) -> "LLMHTTPError":
+        try:
+            text = response.text
+        except Exception:
+            text = ""
+        return cls(response.status_code, text, response.headers)
+
+
+class CircuitOpenError(Exception):
+    """熔断中：提供商近期连续失败，直接拒绝请求"""
+
+
+# ---------------------------------------------------------------------------
+# 服务端退避提示解析
+# ---------------------------------------------------------------------------
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """解析 "1.5"、"20ms"、"6m0s" 等格式为秒"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(num) * _DURATION_UNITS[unit] for num, unit in parts)
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """从响应头读取服务端建议的等待秒数，没有提示时返回 None"""
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000.0)
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value:
+        seconds = _parse_duration(value)
+        if seconds is None:
+            # HTTP-date 格式
+            try:
+                seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+            except Exception:
+                seconds = None
+        if seconds is not None:
+            return max(0.0, seconds)
+
+    # OpenAI 风格：额度耗尽时等待对应的重置时间
+    waits = []
+    for kind in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+            reset = headers.get(f"x-ratelimit-reset-{kind}")
+            seconds = _parse_duration(reset) if reset else None
+            if seconds is not None:
+                waits.append(seconds)
+    if waits:
+        return max(waits)
+
+    # 通用格式：x-ratelimit-reset 为秒数或 Unix 时间戳
+    value = headers.get("x-ratelimit-reset")
+    if value:
+        try:
+            seconds = float(value)
+        except ValueError:
+            return None
+        if seconds > 1e9:
+            seconds -= time.time()
+        return max(0.0, seconds)
+    return None
+
+
+def key_fingerprint(api_key: Optional[str]) -> str:
+    """API Key 指纹（仅用于日志与统计，避免泄露明文）"""
+    if not api_key:
+        return "none"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+
+def endpoint_key(base_url: Optional[str], api_key: Optional[str]) -> str:
+    """端点标识（base_url + API Key 指纹），用作熔断器 key"""
+    return f"{(base_url or 'default').rstrip('/')}#{key_fingerprint(api_key)}"
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """判断异常是否值得重试"""
+    if isinstance(exc, LLMHTTPError):
+        return exc.status_code in RETRYABLE_STATUS
+    if isinstance(exc, CircuitOpenError):
+        return False
+    # 超时、连接失败、连接被重置等传输层错误
+    return isinstance(exc, httpx.TransportError)
+
+
+def _counts_as_failure(exc: BaseException) -> bool:
+    """是否计入熔断失败次数：只统计提供商不可用类错误，429（限流）说明服务仍在线"""
+    if isinstance(exc, LLMHTTPError):
+        return exc.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+# ---------------------------------------------------------------------------
+# 熔断器
+# ---------------------------------------------------------------------------
+
+class CircuitBreaker:
+    """单个 base_url 的熔断器：closed → open（拒绝请求）→ half_open（放行一个探测）→ closed"""
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.total_trips = 0
+
+    @staticmethod
+    def _threshold() -> int:
+        return int(_float_env("LLM_CIRCUIT_FAILURE_THRESHOLD", 5))
+
+    @staticmethod
+    def _reset_timeout() -> float:
+        return _float_env("LLM_CIRCUIT_RESET_TIMEOUT", 30.0)
+
+    def before_request(self) -> None:
+        """请求前检查，熔断中则抛出 CircuitOpenError"""
+        if self.state == "closed":
+            return
+        remaining = self.opened_at + self._reset_timeout() - time.monotonic()
+        if self.state == "open" and remaining <= 0:
+            self.state = "half_open"
+            self.probing = False
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return
+        raise CircuitOpenError(
+            f"{self.key} 连续失败 {self.failures} 次，熔断中（约 {max(0.0, remaining):.0f}s 后重试）"
+        )
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info(f"✅ 熔断恢复: {self.key}")
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self, exc: BaseException) -> None:
+        if not _counts_as_failure(exc):
+            # 非提供商故障（如400/429）：探测请求结束，但不改变熔断计数
+            self.probing = False
+            return
+        self.failures += 1
+        threshold = self._threshold()
+        if self.state == "half_open" or (threshold > 0 and self.failures >= threshold):
+            if self.state != "open":
+                self.total_trips += 1
+                logger.warning(f"🔌 熔断开启: {self.key}（连续失败 {self.failures} 次）")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "key": self.key,
+            "state": self.state,
+            "failures": self.failures,
+            "total_trips": self.total_trips,
+        }
+
+
+class CircuitBreakerRegistry:
+    """按端点 key（见 endpoint_key）管理熔断器"""
+
+    def __init__(self) -> None:
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, key: str) -> CircuitBreaker:
+        key = key.rstrip("/")
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(key)
+            self._breakers[key] = breaker
+        return breaker
+
+    def stats(self) -> Dict[str, Any]:
+        return {"breakers": [b.stats() for b in self._breakers.values()]}
+
+
+# ---------------------------------------------------------------------------
+# 重试执行
+# ---------------------------------------------------------------------------
+
+class RetryPolicy:
+    """带服务端提示与 decorrelated jitter 的重试执行器"""
+
+    def __init__(self, breakers: CircuitBreakerRegistry) -> None:
+        self.breakers = breakers
+
+    @staticmethod
+    def next_delay(previous: float, hint: Optional[float] = None) -> float:
+        """计算下一次退避时长
+
+        decorrelated jitter: sleep = min(cap, uniform(base, previous * 3))；
+        服务端给出提示时至少等待提示时长（再加少量抖动错开各会话）。
+        """
+        base = _float_env("LLM_RETRY_BASE_DELAY", 0.5)
+        cap = _float_env("LLM_RETRY_MAX_DELAY", 20.0)
+        delay = min(cap, random.uniform(base, max(base, previous * 3)))
+        if hint is not None:
+            delay = hint + random.uniform(0, base)
+        return delay
+
+    async def call(
+        self,
+        func: Callable[[], Awaitable[T]],
+        key: str,
+        max_attempts: int = 3,
+    ) -> T:
+        """执行 func，失败时按策略重试
+
+        Args:
+            func: 发起一次请求的协程函数；非 200 响应应抛出 LLMHTTPError
+            key: 熔断器 key（端点标识，见 endpoint_key）
+            max_attempts: 最大尝试次数（含首次）
+        """
+        breaker = self.breakers.get(key)
+        max_server_delay = _float_env("LLM_RETRY_MAX_SERVER_DELAY", 60.0)
+        delay = 0.0
+        attempt = 0
+        while True:
+            attempt += 1
+            breaker.before_request()
+            try:
+                result = await func()
+            except asyncio.CancelledError:
+                breaker.probing = False
+                raise
+            except Exception as e:
+                breaker.record_failure(e)
+                if not is_retryable(e) or attempt >= max_attempts or breaker.state == "open":
+                    raise
+                hint = e.retry_after if isinstance(e, LLMHTTPError) else None
+                if hint is not None and hint > max_server_delay:
+                    logger.warning(f"⚠️ 服务端要求等待 {hint:.0f}s，超过上限 {max_server_delay:.0f}s，放弃重试: {key}")
+                    raise
+                delay = self.next_delay(delay, hint)
+                logger.warning(f"🔁 LLM请求失败（第{attempt}次）: {e}；{delay:.2f}s 后重试")
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+
+
+# 单例，便于全局使用
+circuit_breakers = CircuitBreakerRegistry()
+retry_policy = RetryPolicy(circuit_breakers)
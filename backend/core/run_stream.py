@@ -0,0 +1,335 @@
+"""
+可续传的 Agent 运行事件流
+
+目标：
+- 连接中断（网络抖动、客户端重启）时，长时间的 search_subagent 等运行不丢失、不必重新付费执行
+- 每次运行（run）在独立任务中执行，协议事件按序编号后写入有界内存环形缓冲；从环形缓冲淘汰的事件
+  追加写入 data/runs/{run_id}.ndjson（缓冲写，定时或补发读取前刷盘）；客户端只是订阅者
+- 事件与落盘文件只服务于本进程内的重连：启动时清理上次进程遗留的落盘文件
+- 重连：GET /chat/runs/{run_id}/events 携带最后收到的事件编号（Last-Event-ID 请求头或 after 参数），
+  先补发之后的事件（环形缓冲中已淘汰的从磁盘读取），再继续接收实时事件
+- 断开：订阅者全部断开后运行继续，超过宽限期仍无人重连才取消（显式停止仍立即取消）
+- 背压：订阅者落后时，连续的文本增量合并为一个事件发送（编号取最后一个）
+
+环境变量：
+- RUN_BUFFER_EVENTS: 每次运行在内存中保留的事件数，默认 1000
+- RUN_DETACH_GRACE: 订阅者全部断开后继续运行的宽限期（秒），默认 120；0 表示断开即取消
+- RUN_RETENTION: 运行结束后保留事件供重连的时间（秒），默认 600
+- RUN_SPILL_FLUSH: 落盘文件的定时刷盘间隔（秒），默认 1.0
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from . import chat_protocol, json_codec
+from .cancellation import turn_registry
+
+logger = logging.getLogger(__name__)
+
+# 事件落盘目录
+RUNS_DIR = os.path.join(os.getcwd(), "data", "runs")
+
+
+def _int_env(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _coalesce(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """合并连续的文本增量（编号取最后一个）"""
+    merged: List[Dict[str, Any]] = []
+    for event in events:
+        if event["type"] == "content" and merged and merged[-1]["type"] == "content":
+            merged[-1] = {"type": "content", "delta": merged[-1]["delta"] + event["delta"], "id": event["id"]}
+        else:
+            merged.append(event)
+    return merged
+
+
+class AgentRun:
+    """一次 Agent 运行：驱动事件流、编号、缓冲、落盘，供多个订阅者按编号读取"""
+
+    def __init__(self, run_id: str, session_id: Optional[str], max_events: int) -> None:
+        self.run_id = run_id
+        self.session_id = session_id
+        self.events: Deque[Tuple[int, Dict[str, Any]]] = deque(maxlen=max(1, max_events))
+        self.seq = 0
+        self.finished = False
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._detach_timer: Optional[asyncio.TimerHandle] = None
+        self.spill_path = os.path.join(RUNS_DIR, f"{run_id}.ndjson")
+        # 落盘文件在首次有事件被淘汰时才创建；短运行的事件全部留在内存中
+        self._spill = None
+        self._spill_failed = False
+        self._flush_timer: Optional[asyncio.TimerHandle] = None
+
+    # ---------------- 生产 ----------------
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        self.seq += 1
+        event = {**event, "id": self.seq}
+        if len(self.events) == self.events.maxlen:
+            self._spill_event(self.events[0][1])
+        self.events.append((self.seq, event))
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _spill_event(self, event: Dict[str, Any]) -> None:
+        """即将从环形缓冲淘汰的事件写入落盘文件（缓冲写，由定时器或读取方刷盘）"""
+        if self._spill is None:
+            if self._spill_failed:
+                return
+            try:
+                os.makedirs(RUNS_DIR, exist_ok=True)
+                self._spill = open(self.spill_path, "wb")
+            except Exception as e:
+                self._spill_failed = True
+                logger.warning(f"⚠️ 无法创建事件落盘文件，已淘汰的事件不再可补发: {e}")
+                return
+        try:
+            self._spill.write(json_codec.dumps_bytes(event) + b"\n")
+        except Exception as e:
+            logger.warning(f"⚠️ 事件落盘失败: {e}")
+            return
+        if self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(
+                max(0.05, _float_env("RUN_SPILL_FLUSH", 1.0)), self._flush_spill
+            )
+
+    def _flush_spill(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._spill is not None:
+            try:
+                self._spill.flush()
+            except Exception as e:
+                logger.warning(f"⚠️ 事件落盘失败: {e}")
+
+    def _close_spill(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    async def drive(self, events: AsyncIterator[Dict[str, Any]]) -> None:
+        """消费 Agent 事件流（在独立任务中执行）"""
+        self.publish({"type": "start", "v": chat_protocol.PROTOCOL_VERSION, "session_id": self.session_id, "run_id": self.run_id})
+        try:
+            async for chunk in events:
+                event = await chat_protocol.to_wire_event(chunk)
+                if event is None:
+                    continue
+                if event["type"] == "done":
+                    break
+                self.publish(event)
+        except asyncio.CancelledError:
+            reason = turn_registry.reason(asyncio.current_task()) or "cancelled"
+            self.publish({"type": "cancelled", "reason": reason})
+            raise
+        except Exception as e:
+            import traceback
+            logger.error(f"❌ Agent循环异常: {e}\n{traceback.format_exc()}")
+            self.publish({"type": "error", "message": f"Agent循环异常: {e}"})
+        finally:
+            self.publish({"type": "done"})
+            self.finished = True
+            self.finished_at = time.monotonic()
+            self._cancel_detach_timer()
+            self._close_spill()
+
+    # ---------------- 订阅 ----------------
+
+    def _read_spilled(self, after: int, before: int) -> List[Dict[str, Any]]:
+        """从落盘文件读取编号在 (after, before) 之间的事件（已从内存缓冲淘汰的部分）"""
+        events: List[Dict[str, Any]] = []
+        self._flush_spill()
+        try:
+            with open(self.spill_path, "rb") as f:
+                for line in f:
+                    try:
+                        event = json_codec.loads(line)
+                    except json_codec.JSONDecodeError:
+                        break
+                    if event["id"] >= before:
+                        break
+                    if event["id"] > after:
+                        events.append(event)
+        except FileNotFoundError:
+            pass
+        return events
+
+    async def subscribe(
+        self,
+        after: int = 0,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """从编号 after 之后开始产出事件，直到运行结束；订阅者断开不影响运行本身"""
+        self._attach()
+        poll = _float_env("CLIENT_DISCONNECT_POLL", 1.0)
+        try:
+            while True:
+                first = self.events[0][0] if self.events else self.seq + 1
+                if after + 1 < first:
+                    for event in self._read_spilled(after, first):
+                        yield event
+                        after = event["id"]
+                    after = max(after, first - 1)
+                    # 补发期间可能有更多事件被淘汰：重新确定缓冲起点，避免跳过
+                    continue
+                pending = [event for seq, event in list(self.events) if seq > after]
+                if pending:
+                    for event in _coalesce(pending):
+                        yield event
+                        after = event["id"]
+                    continue
+                if self.finished:
+                    return
+                changed = self._changed
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=max(0.1, poll))
+                except asyncio.TimeoutError:
+                    if is_disconnected is not None and await is_disconnected():
+                        logger.info(f"🔌 订阅者已断开: run_id={self.run_id}（运行继续，可重连续传）")
+                        return
+        finally:
+            self._detach()
+
+    def _attach(self) -> None:
+        self.subscribers += 1
+        self._cancel_detach_timer()
+
+    def _detach(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers > 0 or self.finished or self.task is None:
+            return
+        grace = _float_env("RUN_DETACH_GRACE", 120)
+        if grace <= 0:
+            turn_registry.cancel_task(self.task, "disconnect")
+            return
+        self._detach_timer = asyncio.get_running_loop().call_later(grace, self._expire)
+
+    def _expire(self) -> None:
+        self._detach_timer = None
+        if self.subscribers == 0 and self.task is not None and not self.finished:
+            logger.info(f"⏹️ 运行无人重连，已取消: run_id={self.run_id}")
+            turn_registry.cancel_task(self.task, "disconnect")
+
+    def _cancel_detach_timer(self) -> None:
+        if self._detach_timer is not None:
+            self._detach_timer.cancel()
+            self._detach_timer = None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "run_id": self.run_id,
+            "session_id": self.session_id,
+            "last_event_id": self.seq,
+            "buffered_from": self.events[0][0] if self.events else None,
+            "finished": self.finished,
+            "subscribers": self.subscribers,
+        }
+
+    def discard(self) -> None:
+        self._close_spill()
+        try:
+            os.remove(self.spill_path)
+        except FileNotFoundError:
+            pass
+
+
+class RunRegistry:
+    """run_id -> AgentRun；运行结束后保留一段时间供重连"""
+
+    def __init__(self) -> None:
+        self._runs: Dict[str, AgentRun] = {}
+        self._latest: Dict[str, str] = {}
+
+    def start(self, events: AsyncIterator[Dict[str, Any]], session_id: Optional[str]) -> AgentRun:
+        """在独立任务中启动一次运行（登记到 turn_registry，可被显式停止）"""
+        self._prune()
+        run = AgentRun(uuid.uuid4().hex, session_id, _int_env("RUN_BUFFER_EVENTS", 1000))
+        run.task = asyncio.create_task(run.drive(events))
+        if session_id:
+            turn_registry.register(session_id, run.task)
+            self._latest[session_id] = run.run_id
+        self._runs[run.run_id] = run
+        return run
+
+    def sweep(self) -> int:
+        """删除上次进程遗留的落盘文件（运行只在内存中登记，重启后无法续传）；启动时调用"""
+        removed = 0
+        try:
+            names = os.listdir(RUNS_DIR)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            if not name.endswith(".ndjson") or name[: -len(".ndjson")] in self._runs:
+                continue
+            try:
+                os.remove(os.path.join(RUNS_DIR, name))
+                removed += 1
+            except Exception as e:
+                logger.warning(f"⚠️ 清理事件落盘文件失败: {name} - {e}")
+        if removed:
+            logger.info(f"🧹 已清理遗留的事件落盘文件: {removed} 个")
+        return removed
+
+    def get(self, run_id: str) -> Optional[AgentRun]:
+        return self._runs.get(run_id)
+
+    def latest(self, session_id: str) -> Optional[AgentRun]:
+        return self._runs.get(self._latest.get(session_id, ""))
+
+    def _prune(self) -> None:
+        retention = _float_env("RUN_RETENTION", 600)
+        now = time.monotonic()
+        for run_id, run in list(self._runs.items()):
+            if run.finished and run.subscribers == 0 and now - (run.finished_at or now) > retention:
+                run.discard()
+                self._runs.pop(run_id, None)
+                if run.session_id and self._latest.get(run.session_id) == run_id:
+                    self._latest.pop(run.session_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        self._prune()
+        return {
+            "runs": len(self._runs),
+            "running": sum(1 for r in self._runs.values() if not r.finished),
+            "subscribers": sum(r.subscribers for r in self._runs.values()),
+        }
+
+
+# 单例，便于全局使用
+run_registry = RunRegistry()
+
+
+async def stream_run(
+    run: AgentRun,
+    fmt: str,
+    after: int = 0,
+    is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+) -> AsyncIterator[bytes]:
+    """订阅一次运行并按协议编码（NDJSON / SSE）"""
+    async for event in run.subscribe(after, is_disconnected):
+        yield chat_protocol.encode(event, fmt)
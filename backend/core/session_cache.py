@@ -0,0 +1,141 @@
+"""
+热会话缓存
+
+目标：
+- 按 session_id 缓存活跃的 MemoryManager，每轮对话不再由前端整体重发历史、服务端重新解析重建
+- LRU 淘汰，按上下文总字节数（编码后的JSON片段大小）与会话数双重限制
+- 未命中时从 data/conversations/{session_id}.json 恢复（服务重启后仍可增量同步）
+- 每个会话一把锁：同一会话的多个请求按顺序执行（hold()）；正在执行或等待锁的会话不会被淘汰，
+  其锁也不会被丢弃（否则等待中的请求会在已淘汰的上下文上执行，新请求却拿到另一把锁，同一会话并发执行）
+
+环境变量：
+- SESSION_CACHE_SIZE: 最多缓存的会话数，默认 64
+- SESSION_CACHE_MB: 缓存会话的上下文总字节上限（MB），默认 256
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+from .memory import MemoryManager
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache:
+    """session_id -> MemoryManager 的 LRU 缓存"""
+
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None) -> None:
+        if max_entries is None:
+            try:
+                max_entries = int(os.getenv("SESSION_CACHE_SIZE", "64"))
+            except Exception:
+                max_entries = 64
+        if max_bytes is None:
+            try:
+                max_bytes = int(float(os.getenv("SESSION_CACHE_MB", "256")) * 1024 * 1024)
+            except Exception:
+                max_bytes = 256 * 1024 * 1024
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self._sessions: "OrderedDict[str, MemoryManager]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # 持有或正在等待会话锁的请求数
+        self._users: Dict[str, int] = {}
+        self.hits = 0
+        self.disk_loads = 0
+        self.evictions = 0
+
+    def get(self, session_id: str) -> MemoryManager:
+        """取会话记忆：优先热缓存，其次磁盘，都没有时新建"""
+        memory = self._sessions.get(session_id)
+        if memory is not None:
+            self.hits += 1
+            self._sessions.move_to_end(session_id)
+            return memory
+        memory = MemoryManager(session_id=session_id, load_history=True)
+        if memory.short_term_memory:
+            self.disk_loads += 1
+        self._sessions[session_id] = memory
+        self._sizes[session_id] = memory.approx_bytes()
+        self._evict()
+        return memory
+
+    def reload(self, session_id: str) -> MemoryManager:
+        """丢弃缓存中的上下文，重新从磁盘加载（从检查点恢复前使用，调用方持有会话锁）"""
+        memory = self._sessions.pop(session_id, None)
+        if memory is not None:
+            memory.cancel_background_compaction()
+            memory.release_caches()
+        self._sizes.pop(session_id, None)
+        return self.get(session_id)
+
+    def lock(self, session_id: str) -> asyncio.Lock:
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def hold(self, session_id: str) -> AsyncIterator[MemoryManager]:
+        """持有会话锁并取会话记忆（取锁之后读取，拿到的总是当前缓存中的对象）
+
+        从开始等待锁到释放，会话与其锁都不会被淘汰。
+        """
+        self._users[session_id] = self._users.get(session_id, 0) + 1
+        try:
+            async with self.lock(session_id):
+                yield self.get(session_id)
+        finally:
+            self._users[session_id] -= 1
+            if self._users[session_id] <= 0:
+                self._users.pop(session_id, None)
+
+    def matches(self, session_id: str, history_hash: Optional[str]) -> bool:
+        """前端持有的历史版本是否与服务端一致（一致时前端只需发送增量消息）"""
+        return bool(history_hash) and self.get(session_id).history_hash == history_hash
+
+    def release(self, session_id: str) -> None:
+        """一轮结束：更新该会话的占用并按需淘汰"""
+        memory = self._sessions.get(session_id)
+        if memory is None:
+            return
+        self._sizes[session_id] = memory.approx_bytes()
+        self._evict()
+
+    def _evict(self) -> None:
+        total = sum(self._sizes.values())
+        for session_id in list(self._sessions):
+            if len(self._sessions) <= self.max_entries and total <= self.max_bytes:
+                break
+            lock = self._locks.get(session_id)
+            if self._users.get(session_id) or (lock is not None and lock.locked()):
+                continue  # 正在执行或等待执行的会话不淘汰
+            memory = self._sessions.pop(session_id)
+            total -= self._sizes.pop(session_id, 0)
+            self._locks.pop(session_id, None)
+            memory.cancel_background_compaction()
+            # 淘汰的会话下次从磁盘恢复：释放其消息在 token 计数与编码片段缓存中的引用
+            memory.release_caches()
+            self.evictions += 1
+            logger.info(f"♻️ 热会话淘汰: session_id={session_id}（下次从磁盘恢复）")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": sum(self._sizes.values()),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_loads": self.disk_loads,
+            "evictions": self.evictions,
+        }
+
+
+# 单例，便于全局使用
+session_cache = SessionCache()
@@ -15,12 +15,19 @@ SubAgent架构 - 参考Claude Code的I2A函数设计，集成TODO规划能力
 """
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
-from typing import Any, Dict, List, Optional
+import os
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+from core import checkpoint
 from core.model_manager import model_manager
+from core.subagent_jobs import report_progress
 from core.memory import MemoryManager
+from services.usage_ledger import bind_usage_context, usage_scope
+from tools.result_cache import execute_cached
 
 logger = logging.getLogger(__name__)
 
@@ -268,7 +275,7 @@ class SubAgent:
                             "role": "user",
                             "content": f"请用200字以内总结以下SubAgent执行结果：\n\n{final_content[:2000]}"
                         }
-                    ])
+                    ], hedge=True)
                     summary = summary_resp.get("content", final_content[:200])
                 except Exception as e:
                     logger.warning(f"摘要生成失败，使用截断: {e}")
@@ -378,6 +385,7 @@ class SubAgent:
                         session_id=self.session_id
                     )
                     t["_todo_id"] = created.id
+                report_progress({"type": "todo", "todos": [{"title": t["title"], "status": t["status"]} for t in self.todos]})
 
                 return {
                     "error": False,
@@ -396,6 +404,7 @@ class SubAgent:
 
                 if 0 <= index < len(self.todos):
                     self.todos[index]["status"] = status
+                    report_progress({"type": "todo", "index": index, "title": self.todos[index].get("title", ""), "status": status})
 
                     # ✅ 同步更新到主存储（传递session_id）
                     if "_todo_id" in self.todos[index]:
@@ -420,8 +429,14 @@ class SubAgent:
 
             # 处理SubAgent专用工具
             elif tool_name in self.tools:
+                from tools.manager import tool_manager
+
                 tool = self.tools[tool_name]
-                result = await tool.execute(**arguments)
+                # 与主循环共用资源名额（如 tavily 并发上限）；外层 SubAgent 已持有的资源不重复获取
+                timeout = tool_manager.tool_timeout()
+                async with tool_manager.resource_slots(tool, timeout if timeout > 0 else None):
+                    # 与主循环共享会话内的工具结果缓存（同一检索不重复消耗额度）
+                    result = await execute_cached(tool, self.session_id, arguments, lambda: tool.execute(**arguments))
                 return result
 
             else:
@@ -439,6 +454,65 @@ class SubAgent:
                 "message": f"工具执行异常: {str(e)}"
             }
 
+    def _can_dispatch_early(self, tool_name: str) -> bool:
+        """流式阶段可提前执行的调用：只读的专用工具（提前执行后无法撤销副作用）"""
+        tool = self.tools.get(tool_name)
+        return tool is not None and bool(getattr(tool, "read_only", False))
+
+    @staticmethod
+    def _is_heavy_tool(tool_name: str) -> bool:
+        """重型网络工具（每轮限制数量）：tavily_* 与嵌套的 *_subagent"""
+        return tool_name.startswith("tavily_") or tool_name.endswith("_subagent")
+
+    @staticmethod
+    def _max_heavy_calls_per_iter() -> int:
+        try:
+            max_heavy = int(os.getenv("SUBAGENT_MAX_HEAVY_CALLS_PER_ITER", "1"))
+        except Exception:
+            max_heavy = 1
+        return max(1, max_heavy)
+
+    async def _run_tool_call(self, tool_call: Dict[str, Any], after: Optional[asyncio.Task] = None) -> Dict[str, Any]:
+        """执行单个tool_call并返回 role=tool 消息
+
+        after: 前一个调用的任务；等它结束后再开始，保持SubAgent内工具串行执行的语义
+        """
+        if after is not None:
+            await asyncio.wait([after])
+
+        function = tool_call.get("function", {})
+        tool_name = function.get("name", "")
+        try:
+            tool_args = json.loads(function.get("arguments") or "{}")
+        except json.JSONDecodeError:
+            exec_result = {"error": True, "message": "参数解析失败：无效的JSON格式"}
+        else:
+            # 后台作业模式下上报工具调用进度（同步调用时忽略）
+            report_progress({"type": "tool", "tool": tool_name, "status": "running"})
+            started = time.monotonic()
+            with usage_scope(tool=tool_name):
+                exec_result = await self._execute_tool(tool_name, tool_args)
+            report_progress({
+                "type": "tool",
+                "tool": tool_name,
+                "status": "error" if exec_result.get("error") else "done",
+                "elapsed": round(time.monotonic() - started, 2),
+            })
+
+        return {
+            "tool_call_id": tool_call.get("id"),
+            "role": "tool",
+            "name": tool_name,
+            "content": json.dumps(exec_result, ensure_ascii=False)
+        }
+
+    def _checkpoint_key(self) -> Optional[str]:
+        """检查点键：同一次工具调用（主循环恢复时补跑）续接同一个 SubAgent 的进度"""
+        tool_call_id = checkpoint.current_tool_call_id.get()
+        if not tool_call_id or not checkpoint.checkpoint_enabled():
+            return None
+        return f"{self.session_id}.{self.name}.{tool_call_id}"
+
     async def execute(self, task_description: str, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """执行SubAgent任务
 
@@ -449,6 +523,7 @@ class SubAgent:
         Returns:
             执行结果：{"error": bool, "data": any, "message": str}
         """
+        keep_checkpoint = False
         try:
             logger.info(f"🤖 SubAgent [{self.name}] 开始执行任务")
 
@@ -487,44 +562,91 @@ class SubAgent:
                     }
                     for t in subagent_todos
                 ]
-
-            # 1. 注入系统提示
-            system_prompt = self._get_system_prompt()
-            self.memory.add_message({"role": "system", "content": system_prompt})
-
-            # 2. 注入上下文信息（如果有）
-            if context:
-                context_str = json.dumps(context, ensure_ascii=False, indent=2)
+                report_progress({"type": "todo", "todos": [{"title": t["title"], "status": t["status"]} for t in self.todos]})
+
+            # 0. 检查点：同一次工具调用之前中断过时，从检查点续接（已完成的工具调用不再重跑）
+            checkpoint_key = self._checkpoint_key()
+            restored = self.memory.restore_checkpoint(checkpoint_key) if checkpoint_key else None
+            if restored is None:
+                if checkpoint_key:
+                    self.memory.start_checkpoint(checkpoint_key)
+
+                # 1. 注入系统提示
+                system_prompt = self._get_system_prompt()
+                self.memory.add_message({"role": "system", "content": system_prompt})
+
+                # 2. 注入上下文信息（如果有）
+                if context:
+                    context_str = json.dumps(context, ensure_ascii=False, indent=2)
+                    self.memory.add_message({
+                        "role": "system",
+                        "content": f"**上下文信息**:\n```json\n{context_str}\n```"
+                    })
+
+                # 3. 添加任务描述
                 self.memory.add_message({
-                    "role": "system",
-                    "content": f"**上下文信息**:\n```json\n{context_str}\n```"
+                    "role": "user",
+                    "content": task_description
                 })
-
-            # 3. 添加任务描述
-            self.memory.add_message({
-                "role": "user",
-                "content": task_description
-            })
+            else:
+                logger.info(
+                    f"♻️ SubAgent [{self.name}] 从检查点恢复: 第 {restored['iteration']} 轮，"
+                    f"{len(self.memory.short_term_memory)} 条消息，待补跑 {len(restored['pending_tool_calls'])} 个工具调用"
+                )
+                for tc in restored["pending_tool_calls"]:
+                    self.memory.add_message(await self._run_tool_call(tc))
+                if restored["finished"]:
+                    final = self.memory.short_term_memory[-1].get("content") or ""
+                    return await self._generate_compact_report(final, restored["iteration"])
 
             # 4. SubAgent主循环（类似nO循环）
             client = model_manager.get_model(self.model_pointer)  # 使用SubAgent独立的模型配置
             openai_tools = self._get_openai_tools()
 
-            iteration = 0
-            has_planned = False
-            has_used_tavily = False
+            iteration = restored["iteration"] if restored else 0
+            called = {m.get("name") or "" for m in self.memory.short_term_memory if m.get("role") == "tool"}
+            has_planned = "create_subagent_todo" in called
+            has_used_tavily = any(name.startswith("tavily_") for name in called)
             while iteration < self.max_iterations:
                 iteration += 1
                 logger.info(f"📍 SubAgent [{self.name}] Iteration {iteration}/{self.max_iterations}")
-
-                # 4.1 获取上下文并调用模型
+                self.memory.checkpoint({"op": "iteration", "iteration": iteration})
+                report_progress({"type": "iteration", "iteration": iteration})
+                # 用量账本归属（工具任务内设置，不影响主循环）
+                bind_usage_context(agent=self.name, iteration=iteration)
+
+                # 4.1 获取上下文并流式调用模型
+                # 只读工具的 tool_call 参数一完整就提前开始执行（按到达顺序串行），模型同时继续输出后续调用；
+                # 有副作用的调用（TODO 管理、浏览器/桌面操作等）及其后的调用等完整回复确定后再执行
                 context_messages = self.memory.get_context()
                 # 前两轮强制工具调用，促使先规划 TODO 并实际检索；之后允许模型输出总结
                 tool_choice = "required" if iteration <= 2 else "auto"
+                max_heavy = self._max_heavy_calls_per_iter()
+                # 提前派发的 (调用, 任务)，按到达顺序；不按 id 索引（id 可能为空或重复）
+                early: List[Tuple[Dict[str, Any], asyncio.Task]] = []
+                previous: Optional[asyncio.Task] = None
+                heavy_dispatched = 0
+                deferred = False
+                resp: Dict[str, Any] = {}
                 try:
-                    resp = await client.chat(context_messages, tools=openai_tools, tool_choice=tool_choice)
-                except TypeError:
-                    resp = await client.chat(context_messages)
+                    async for event in client.chat_stream(context_messages, tools=openai_tools, tool_choice=tool_choice):
+                        if event["type"] == "tool_call":
+                            tc = event["data"]
+                            if deferred or not self._can_dispatch_early(tc["function"]["name"]):
+                                deferred = True
+                                continue
+                            if self._is_heavy_tool(tc["function"]["name"]):
+                                if heavy_dispatched >= max_heavy:
+                                    continue
+                                heavy_dispatched += 1
+                            previous = asyncio.create_task(self._run_tool_call(tc, after=previous))
+                            early.append((tc, previous))
+                        elif event["type"] == "final":
+                            resp = event
+                except BaseException:
+                    for _, task in early:
+                        task.cancel()
+                    raise
 
                 content = resp.get("content", "")
                 raw_response = resp.get("raw")
@@ -540,18 +662,31 @@ class SubAgent:
                         light = []
                         for tc in tool_calls_all:
                             n = getattr(tc.function, "name", "")
-                            if n.startswith("tavily_") or n.endswith("_subagent"):
+                            if self._is_heavy_tool(n):
                                 heavy.append(tc)
                             else:
                                 light.append(tc)
 
-                        try:
-                            import os as _os
-                            max_heavy = int(_os.getenv("SUBAGENT_MAX_HEAVY_CALLS_PER_ITER", "1"))
-                        except Exception:
-                            max_heavy = 1
+                        tool_calls = light + heavy[:max_heavy]
 
-                        tool_calls = light + heavy[: max(1, max_heavy) if heavy else 0]
+                from tools.manager import same_tool_call
+
+                # 按位置认领提前派发的同一调用（与 ToolCallDispatcher 一致），模型最终未采用的直接取消
+                tool_call_dicts = [
+                    {"id": tc.id, "function": {"name": tc.function.name, "arguments": tc.function.arguments}}
+                    for tc in tool_calls or []
+                ]
+                pending: Dict[int, asyncio.Task] = {}
+                claimed: Set[int] = set()
+                for position, call in enumerate(tool_call_dicts):
+                    for i, (early_call, task) in enumerate(early):
+                        if i not in claimed and same_tool_call(early_call, call):
+                            claimed.add(i)
+                            pending[position] = task
+                            break
+                for i, (_, task) in enumerate(early):
+                    if i not in claimed:
+                        task.cancel()
 
                 # 4.3 如果没有工具调用，返回最终结果
                 if not tool_calls:
@@ -590,34 +725,34 @@ class SubAgent:
                 }
                 self.memory.add_message(assistant_msg)
 
-                # 执行工具
-                for tc in tool_calls:
-                    tool_name = tc.function.name
-                    tool_args = json.loads(tc.function.arguments)
-
-                    # 执行工具
-                    exec_result = await self._execute_tool(tool_name, tool_args)
-
-                    result = {
-                        "tool_call_id": tc.id,
-                        "role": "tool",
-                        "name": tool_name,
-                        "content": json.dumps(exec_result, ensure_ascii=False)
-                    }
-
-                    self.memory.add_message(result)
-                    # 记录已规划/已检索信号，配合前两轮强制工具调用一起工作
-                    if tool_name == "create_subagent_todo":
-                        has_planned = True
-                    if tool_name.startswith("tavily_"):
-                        has_used_tavily = True
+                # 执行工具（已提前派发的直接等待结果，其余在此按顺序补交）
+                try:
+                    for position, call in enumerate(tool_call_dicts):
+                        task = pending.pop(position, None)
+                        if task is None:
+                            previous = asyncio.create_task(self._run_tool_call(call, after=previous))
+                            task = previous
+                        result = await task
+                        tool_name = result["name"]
+
+                        self.memory.add_message(result)
+                        # 记录已规划/已检索信号，配合前两轮强制工具调用一起工作
+                        if tool_name == "create_subagent_todo":
+                            has_planned = True
+                        if tool_name.startswith("tavily_"):
+                            has_used_tavily = True
+                except BaseException:
+                    # 被取消（主循环停止/客户端断开）时，已派发但未等待的工具调用一并取消
+                    for task in pending.values():
+                        task.cancel()
+                    if previous is not None:
+                        previous.cancel()
+                    raise
 
                 # 迭代延迟：避免高频调用API导致限流（可选，通过环境变量配置）
                 if iteration < self.max_iterations:
                     try:
-                        import os as _os
-                        import asyncio
-                        delay = float(_os.getenv("SUBAGENT_ITERATION_DELAY", "0"))
+                        delay = float(os.getenv("SUBAGENT_ITERATION_DELAY", "0"))
                         if delay > 0:
                             await asyncio.sleep(delay)
                     except Exception:
@@ -635,6 +770,11 @@ class SubAgent:
                 }
             }
 
+        except asyncio.CancelledError:
+            # 保留检查点：主循环恢复时补跑该工具调用，从中断处续接
+            keep_checkpoint = True
+            logger.info(f"⏹️ SubAgent [{self.name}] 已取消")
+            raise
         except Exception as e:
             import traceback
             logger.error(f"❌ SubAgent [{self.name}] 执行异常: {str(e)}")
@@ -643,6 +783,9 @@ class SubAgent:
                 "error": True,
                 "message": f"SubAgent [{self.name}] 执行异常: {str(e)}"
             }
+        finally:
+            if not keep_checkpoint:
+                self.memory.finish_checkpoint()
 
 
 # SubAgent工厂函数（类似Claude Code的I2A函数）
@@ -0,0 +1,337 @@
+"""
+SubAgent 后台作业（有界工作池 + 进度事件流）
+
+目标：
+- search_subagent / browser_subagent 等 SubAgent 同步执行时占满 TOOL_EXECUTION_TIMEOUT，
+  主循环被阻塞、用户几分钟内看不到任何输出；带 background=true 调用时改为提交后台作业，
+  工具立即返回 job_id，主 Agent 可以继续对话，之后用 subagent_job 工具查询、等待，用 cancel_subagent_job 取消
+- 全进程共享的有界工作池：同时运行的作业数不超过 SUBAGENT_JOB_WORKERS，其余排队，
+  排队数超过 SUBAGENT_JOB_QUEUE 时拒绝提交（工具返回错误，模型可改为同步调用或稍后再试）
+- 作业与对话轮次解耦：停止/断开当前轮次不会取消作业，只能通过 cancel_subagent_job 工具或
+  POST /jobs/{job_id}/cancel 取消
+- 进度：SubAgent 的迭代、工具调用与 TODO 状态变化按序编号写入作业的有界事件缓冲，
+  GET /jobs/{job_id}/events（NDJSON/SSE，支持 Last-Event-ID 续传）或
+  GET /jobs/stream?session_id=（会话内全部作业）实时推送给客户端
+
+作业只保存在内存中，进程重启后不恢复（因此作业内的 SubAgent 不写检查点）。
+
+事件（所有事件都有 "type"、"id"、"job_id"）：
+- status:    {"status": queued|running|done|error|cancelled}
+- iteration: {"iteration"}
+- tool:      {"tool", "status": running|done|error, "elapsed"?}
+- todo:      {"index", "title", "status"} 或 {"todos": [{"title", "status"}]}（规划/重新加载时）
+- result:    {"error", "summary"? , "message"?}
+- done:      {}
+
+环境变量：
+- SUBAGENT_JOB_WORKERS: 同时运行的作业数上限，默认 2
+- SUBAGENT_JOB_QUEUE: 排队作业数上限，默认 16
+- SUBAGENT_JOB_TIMEOUT: 单个作业的最长执行时间（秒），默认 1800；0 表示不限
+- SUBAGENT_JOB_WAIT: subagent_job(wait) 的默认等待时间（秒），默认 60
+- SUBAGENT_JOB_EVENTS: 每个作业在内存中保留的事件数，默认 500
+- SUBAGENT_JOB_RETENTION: 作业结束后保留结果的时间（秒），默认 3600
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from . import checkpoint
+
+logger = logging.getLogger(__name__)
+
+# 已结束的作业状态
+FINISHED_STATUSES = ("done", "error", "cancelled")
+
+
+def _int_env(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+class SubAgentJob:
+    """一个后台 SubAgent 作业：状态、结果与按序编号的进度事件"""
+
+    def __init__(self, job_id: str, session_id: str, tool: str, task_description: str, max_events: int) -> None:
+        self.job_id = job_id
+        self.session_id = session_id
+        self.tool = tool
+        self.task_description = task_description
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.iteration = 0
+        self.current_tool: Optional[str] = None
+        self.events: Deque[Tuple[int, Dict[str, Any]]] = deque(maxlen=max(1, max_events))
+        self.seq = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._on_publish: Optional[Callable[[], None]] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        self.seq += 1
+        event = {**event, "id": self.seq, "job_id": self.job_id}
+        kind = event.get("type")
+        if kind == "iteration":
+            self.iteration = event.get("iteration", self.iteration)
+        elif kind == "tool":
+            self.current_tool = event.get("tool") if event.get("status") == "running" else None
+        self.events.append((self.seq, event))
+        self._changed.set()
+        self._changed = asyncio.Event()
+        if self._on_publish is not None:
+            self._on_publish()
+
+    def _set_status(self, status: str) -> None:
+        self.status = status
+        self.publish({"type": "status", "status": status})
+
+    def events_after(self, after: int) -> List[Dict[str, Any]]:
+        return [event for seq, event in list(self.events) if seq > after]
+
+    async def subscribe(
+        self,
+        after: int = 0,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """从编号 after 之后开始产出事件，直到作业结束（已淘汰的早期事件不再补发）"""
+        poll = _float_env("CLIENT_DISCONNECT_POLL", 1.0)
+        while True:
+            pending = self.events_after(after)
+            if pending:
+                for event in pending:
+                    yield event
+                    after = event["id"]
+                continue
+            if self.finished:
+                return
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=max(0.1, poll))
+            except asyncio.TimeoutError:
+                if is_disconnected is not None and await is_disconnected():
+                    return
+
+    async def wait(self, timeout: Optional[float]) -> bool:
+        """等待作业结束（不会因等待方被取消而取消作业），返回是否已结束"""
+        if self.task is not None and not self.finished:
+            await asyncio.wait({self.task}, timeout=timeout)
+        return self.finished
+
+    def outcome(self) -> Dict[str, Any]:
+        """供 subagent_job 工具返回：已结束时为 SubAgent 报告（附作业状态），否则为当前状态"""
+        job = self.info()
+        if self.status == "cancelled":
+            return {"error": True, "message": f"作业已取消: {self.job_id}", "job": job}
+        if self.finished:
+            return {**(self.result or {"error": True, "message": "作业没有结果"}), "job": job}
+        message = "作业排队中，等待空闲的工作槽" if self.status == "queued" else (
+            f"作业运行中（第 {self.iteration} 轮" + (f"，正在执行 {self.current_tool}" if self.current_tool else "") + "）"
+        )
+        return {"error": False, "message": message, "job": job}
+
+    def info(self) -> Dict[str, Any]:
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.job_id,
+            "session_id": self.session_id,
+            "tool": self.tool,
+            "task": self.task_description[:200],
+            "status": self.status,
+            "iteration": self.iteration,
+            "current_tool": self.current_tool,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed": round(end - self.started_at, 2) if self.started_at else 0.0,
+            "last_event_id": self.seq,
+        }
+
+
+# 当前正在执行的作业（作业任务内设置，SubAgent 据此上报进度）
+current_job: contextvars.ContextVar[Optional[SubAgentJob]] = contextvars.ContextVar("current_subagent_job", default=None)
+
+
+def report_progress(event: Dict[str, Any]) -> None:
+    """上报进度事件到当前作业；不在后台作业中执行（同步调用）时忽略"""
+    job = current_job.get()
+    if job is not None:
+        job.publish(event)
+
+
+class SubAgentJobManager:
+    """job_id -> SubAgentJob；有界工作池执行，结束后保留一段时间供查询"""
+
+    def __init__(self) -> None:
+        self._jobs: Dict[str, SubAgentJob] = {}
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._changed: Optional[asyncio.Event] = None
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(max(1, _int_env("SUBAGENT_JOB_WORKERS", 2)))
+        return self._sem
+
+    def _notify(self) -> None:
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def submit(
+        self,
+        tool: str,
+        session_id: str,
+        task_description: str,
+        run: Callable[[], Awaitable[Dict[str, Any]]],
+    ) -> Dict[str, Any]:
+        """提交后台作业，立即返回作业回执（排队已满时返回错误）"""
+        self._prune()
+        # 排队数只计等待工作槽的作业（空闲工作槽会立即接走的不算）
+        workers = max(1, _int_env("SUBAGENT_JOB_WORKERS", 2))
+        active = sum(1 for job in self._jobs.values() if job.status in ("queued", "running"))
+        queued = max(0, active - workers)
+        limit = _int_env("SUBAGENT_JOB_QUEUE", 16)
+        if active >= workers and queued >= limit:
+            return {
+                "error": True,
+                "message": f"后台作业队列已满（排队 {queued}/{limit}），请稍后再试或改为同步调用",
+            }
+        job = SubAgentJob(uuid.uuid4().hex[:12], session_id, tool, task_description, _int_env("SUBAGENT_JOB_EVENTS", 500))
+        job._on_publish = self._notify
+        self._jobs[job.job_id] = job
+        job.publish({"type": "status", "status": "queued"})
+        job.task = asyncio.create_task(self._run(job, run))
+        logger.info(f"📮 已提交后台作业: {tool} job_id={job.job_id} (进行中 {active + 1}/{workers})")
+        return {
+            "error": False,
+            "message": f"已提交后台作业 {job.job_id}，可继续对话；用 subagent_job 工具查询进度或等待，用 cancel_subagent_job 取消",
+            "job": job.info(),
+        }
+
+    async def _run(self, job: SubAgentJob, run: Callable[[], Awaitable[Dict[str, Any]]]) -> None:
+        # 作业只在内存中，不可跨进程恢复：不写 SubAgent 检查点，也不沿用提交时的 tool_call_id
+        checkpoint.current_tool_call_id.set(None)
+        current_job.set(job)
+        timeout = _float_env("SUBAGENT_JOB_TIMEOUT", 1800)
+        try:
+            async with self._semaphore():
+                job.started_at = time.time()
+                job._set_status("running")
+                logger.info(f"🚀 后台作业开始: {job.tool} job_id={job.job_id}")
+                result = await asyncio.wait_for(run(), timeout=timeout if timeout > 0 else None)
+            job.result = result if isinstance(result, dict) else {"error": False, "data": result}
+            status = "error" if job.result.get("error") else "done"
+        except asyncio.CancelledError:
+            status = "cancelled"
+        except asyncio.TimeoutError:
+            job.result = {"error": True, "message": f"后台作业超时 ({timeout:.0f}秒): {job.tool}"}
+            status = "error"
+        except Exception as e:
+            logger.error(f"❌ 后台作业异常: {job.tool} job_id={job.job_id} - {e}")
+            job.result = {"error": True, "message": f"后台作业异常: {e}"}
+            status = "error"
+        job.finished_at = time.time()
+        job.current_tool = None
+        if job.result is not None:
+            summary = {"type": "result", "error": bool(job.result.get("error"))}
+            for field in ("summary", "message"):
+                if job.result.get(field):
+                    summary[field] = job.result[field]
+            job.publish(summary)
+        job._set_status(status)
+        job.publish({"type": "done"})
+        logger.info(f"🏁 后台作业结束: {job.tool} job_id={job.job_id} status={status}")
+
+    def get(self, job_id: str, session_id: Optional[str] = None) -> Optional[SubAgentJob]:
+        """按 job_id 查找；指定 session_id 时只返回该会话的作业"""
+        job = self._jobs.get(job_id or "")
+        if job is None or (session_id is not None and job.session_id != session_id):
+            return None
+        return job
+
+    def list(self, session_id: Optional[str] = None) -> List[SubAgentJob]:
+        self._prune()
+        return [job for job in self._jobs.values() if session_id is None or job.session_id == session_id]
+
+    def cancel(self, job: SubAgentJob) -> bool:
+        if job.finished or job.task is None:
+            return False
+        job.task.cancel()
+        logger.info(f"⏹️ 取消后台作业: {job.tool} job_id={job.job_id}")
+        return True
+
+    async def subscribe_session(
+        self,
+        session_id: str,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """会话内全部作业的事件：先发送当前作业列表，之后只推送新事件"""
+        jobs = self.list(session_id)
+        yield {"type": "jobs", "jobs": [job.info() for job in jobs]}
+        cursors = {job.job_id: job.seq for job in jobs}
+        poll = _float_env("CLIENT_DISCONNECT_POLL", 1.0)
+        while True:
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            changed = self._changed
+            for job in self.list(session_id):
+                for event in job.events_after(cursors.get(job.job_id, 0)):
+                    yield event
+                    cursors[job.job_id] = event["id"]
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=max(0.1, poll))
+            except asyncio.TimeoutError:
+                if is_disconnected is not None and await is_disconnected():
+                    return
+
+    def _prune(self) -> None:
+        retention = _float_env("SUBAGENT_JOB_RETENTION", 3600)
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and now - (job.finished_at or now) > retention:
+                self._jobs.pop(job_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        self._prune()
+        counts = {status: 0 for status in ("queued", "running", *FINISHED_STATUSES)}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "workers": max(1, _int_env("SUBAGENT_JOB_WORKERS", 2)),
+            "queue_limit": _int_env("SUBAGENT_JOB_QUEUE", 16),
+            "jobs": len(self._jobs),
+            **counts,
+        }
+
+    async def shutdown(self) -> None:
+        """应用关闭时取消仍在执行的作业"""
+        tasks = [job.task for job in self._jobs.values() if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# 单例，便于全局使用
+subagent_jobs = SubAgentJobManager()
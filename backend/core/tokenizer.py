@@ -0,0 +1,298 @@
+"""
+Token 计数（可插拔分词器 + 按消息缓存）
+
+目标：
+- 优先使用 tiktoken（已安装且编码文件可离线加载时），否则使用按字符类别校准的启发式估算
+- 图片按分辨率计价（OpenAI vision 规则：512px 切片，每片 170 + 基础 85），而不是按 base64 长度
+- 按消息对象缓存计数结果：每轮迭代只需计算新增消息
+
+环境变量：
+- TOKENIZER: auto（默认，有 tiktoken 用 tiktoken）/ tiktoken / heuristic
+- TIKTOKEN_ENCODING: tiktoken 编码名，默认 o200k_base
+- TOKEN_CACHE_SIZE: 消息计数缓存条数，默认 4096
+"""
+from __future__ import annotations
+
+import base64
+import logging
+import math
+import os
+import re
+import struct
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 每条消息的固定开销（role、分隔符等）
+MESSAGE_OVERHEAD = 4
+# 无法识别分辨率时的图片估价（约等于 1024x1024 高清图）
+DEFAULT_IMAGE_TOKENS = 765
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+# 中日韩文字（含假名、谚文、全角标点）
+_CJK_RE = re.compile(
+    r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+_NON_ASCII_RE = re.compile(r"[^\x00-\x7f]")
+
+
+class HeuristicTokenizer:
+    """启发式估算：CJK 约 1 token/字，其余非 ASCII 字符约 1 token/字，ASCII 约 4 字符/token"""
+
+    name = "heuristic"
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        cjk = len(_CJK_RE.findall(text))
+        non_ascii = len(_NON_ASCII_RE.findall(text)) - cjk
+        ascii_chars = len(text) - cjk - non_ascii
+        return cjk + non_ascii + math.ceil(ascii_chars / 4)
+
+
+class TiktokenTokenizer:
+    """tiktoken 精确计数"""
+
+    name = "tiktoken"
+
+    def __init__(self, encoding_name: str) -> None:
+        import tiktoken
+
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.name = f"tiktoken:{encoding_name}"
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+def _load_tokenizer():
+    mode = os.getenv("TOKENIZER", "auto").strip().lower()
+    if mode in ("auto", "tiktoken"):
+        try:
+            return TiktokenTokenizer(os.getenv("TIKTOKEN_ENCODING", "o200k_base"))
+        except Exception as e:
+            # 未安装或离线环境无法下载编码文件
+            if mode == "tiktoken":
+                logger.warning(f"⚠️ tiktoken 不可用，改用启发式估算: {e}")
+    return HeuristicTokenizer()
+
+
+# ---------------------------------------------------------------------------
+# 图片计价
+# ---------------------------------------------------------------------------
+
+def _image_size_from_bytes(data: bytes) -> Optional[Tuple[int, int]]:
+    """从图片头部解析宽高（支持 PNG/GIF/JPEG/WEBP），解析失败返回 None"""
+    try:
+        if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+            return struct.unpack(">II", data[16:24])
+        if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+            return struct.unpack("<HH", data[6:10])
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            chunk = data[12:16]
+            if chunk == b"VP8X" and len(data) >= 30:
+                w = int.from_bytes(data[24:27], "little") + 1
+                h = int.from_bytes(data[27:30], "little") + 1
+                return w, h
+            if chunk == b"VP8 " and len(data) >= 30:
+                w, h = struct.unpack("<HH", data[26:30])
+                return w & 0x3FFF, h & 0x3FFF
+            if chunk == b"VP8L" and len(data) >= 25:
+                bits = int.from_bytes(data[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            return None
+        if data[:2] == b"\xff\xd8":
+            # 逐段扫描到 SOF 标记
+            i = 2
+            while i + 9 < len(data):
+                if data[i] != 0xFF:
+                    i += 1
+                    continue
+                marker = data[i + 1]
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                    i += 2
+                    continue
+                length = struct.unpack(">H", data[i + 2:i + 4])[0]
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    h, w = struct.unpack(">HH", data[i + 5:i + 9])
+                    return w, h
+                i += 2 + length
+    except Exception:
+        return None
+    return None
+
+
+def image_size_from_data_url(url: str) -> Optional[Tuple[int, int]]:
+    """从 data URL 解析图片分辨率（只解码头部，不解码整张图）"""
+    if not url.startswith("data:"):
+        return None
+    comma = url.find(",")
+    if comma == -1 or ";base64" not in url[:comma]:
+        return None
+    # JPEG 的 SOF 可能位于 EXIF 之后，多取一些
+    head = url[comma + 1:comma + 1 + 87384]
+    head = head[: len(head) - len(head) % 4]
+    try:
+        data = base64.b64decode(head)
+    except Exception:
+        return None
+    return _image_size_from_bytes(data)
+
+
+def image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """按 OpenAI vision 规则计算图片 token
+
+    高清：先缩放到 2048x2048 以内，再把短边缩放到 768，按 512px 切片，每片 170 + 基础 85
+    """
+    if detail == "low":
+        return LOW_DETAIL_IMAGE_TOKENS
+    if width <= 0 or height <= 0:
+        return DEFAULT_IMAGE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    tiles = math.ceil(w / 512) * math.ceil(h / 512)
+    return 170 * tiles + 85
+
+
+# ---------------------------------------------------------------------------
+# 消息计数（带缓存）
+# ---------------------------------------------------------------------------
+
+def _message_bytes(message: Dict[str, Any]) -> int:
+    """消息占用内存的粗略估计（文本与图片 data URL 的字符数），用于缓存的字节上限"""
+    content = message.get("content")
+    size = 0
+    if isinstance(content, str):
+        size += len(content)
+    elif isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict):
+                image = part.get("image_url")
+                size += len(part.get("text") or "")
+                size += len(image.get("url") or "") if isinstance(image, dict) else len(str(image or ""))
+            else:
+                size += len(str(part))
+    for tc in message.get("tool_calls") or []:
+        if isinstance(tc, dict):
+            size += len((tc.get("function") or {}).get("arguments") or "")
+    return size
+
+
+class TokenCounter:
+    """按消息对象缓存的 token 计数器
+
+    缓存 key 为消息对象的 id()，并持有消息引用，避免对象回收后 id 被复用；
+    消息加入上下文后视为不可变（原地修改过的消息需调用 invalidate()）。
+    被持有的消息按条数与估算字节数双重限制；消息被替换或移出上下文时调用 forget()
+    立即释放（图片老化、观测折叠、摘要换入、热会话淘汰），不必等 LRU 淘汰。
+    """
+
+    def __init__(self, tokenizer=None, max_entries: Optional[int] = None, max_bytes: Optional[int] = None) -> None:
+        self.tokenizer = tokenizer or _load_tokenizer()
+        if max_entries is None:
+            try:
+                max_entries = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+            except Exception:
+                max_entries = 4096
+        if max_bytes is None:
+            try:
+                max_bytes = int(float(os.getenv("TOKEN_CACHE_MB", "64")) * 1024 * 1024)
+            except Exception:
+                max_bytes = 64 * 1024 * 1024
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # id(消息) -> (消息, token 数, 估算字节数)
+        self._cache: "OrderedDict[int, Tuple[Dict[str, Any], int, int]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def count_text(self, text: str) -> int:
+        return self.tokenizer.count(text)
+
+    def count_part(self, part: Any) -> int:
+        if isinstance(part, str):
+            return self.count_text(part)
+        if not isinstance(part, dict):
+            return self.count_text(str(part))
+        part_type = part.get("type")
+        if part_type == "text":
+            return self.count_text(part.get("text", ""))
+        if part_type == "image_url":
+            image = part.get("image_url") or {}
+            url = image.get("url", "") if isinstance(image, dict) else str(image)
+            detail = image.get("detail", "auto") if isinstance(image, dict) else "auto"
+            size = image_size_from_data_url(url)
+            if size is None:
+                return DEFAULT_IMAGE_TOKENS if detail != "low" else LOW_DETAIL_IMAGE_TOKENS
+            return image_tokens(size[0], size[1], detail)
+        return self.count_text(str(part))
+
+    def _count_uncached(self, message: Dict[str, Any]) -> int:
+        total = MESSAGE_OVERHEAD
+        content = message.get("content")
+        if isinstance(content, str):
+            total += self.count_text(content)
+        elif isinstance(content, list):
+            total += sum(self.count_part(p) for p in content)
+        elif content is not None:
+            total += self.count_text(str(content))
+        if message.get("name"):
+            total += self.count_text(message["name"])
+        for tc in message.get("tool_calls") or []:
+            function = tc.get("function", {}) if isinstance(tc, dict) else {}
+            total += MESSAGE_OVERHEAD
+            total += self.count_text(function.get("name", ""))
+            total += self.count_text(function.get("arguments", ""))
+        return total
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        key = id(message)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] is message:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return cached[1]
+        self.misses += 1
+        tokens = self._count_uncached(message)
+        if cached is not None:
+            self._bytes -= cached[2]
+        size = _message_bytes(message)
+        self._cache[key] = (message, tokens, size)
+        self._bytes += size
+        while self._cache and (len(self._cache) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, _, evicted) = self._cache.popitem(last=False)
+            self._bytes -= evicted
+        return tokens
+
+    def count_messages(self, messages: List[Dict[str, Any]]) -> int:
+        return sum(self.count_message(m) for m in messages)
+
+    def invalidate(self, message: Dict[str, Any]) -> None:
+        cached = self._cache.get(id(message))
+        if cached is not None and cached[0] is message:
+            del self._cache[id(message)]
+            self._bytes -= cached[2]
+
+    def forget(self, messages: Iterable[Dict[str, Any]]) -> None:
+        """释放已被替换或移出上下文的消息"""
+        for message in messages:
+            self.invalidate(message)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tokenizer": self.tokenizer.name,
+            "cached_messages": len(self._cache),
+            "cached_bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# 单例，便于全局使用
+token_counter = TokenCounter()
@@ -3,7 +3,10 @@ FastAPI 应用入口。
 
 提供：
 - GET /health       健康检查
-- POST /chat        触发 Agent 主循环（StreamingResponse）
+- POST /chat        触发 Agent 主循环（StreamingResponse；NDJSON/SSE 事件流见 core/chat_protocol.py）
+- POST /chat/{session_id}/resume  从检查点恢复中断的一轮
+- GET /chat/runs/{run_id}/events  连接中断后从最后收到的事件续传
+- GET /jobs/{job_id}/events      后台 SubAgent 作业的进度事件流（见 core/subagent_jobs.py）
 
 运行方式：
     uvicorn main:app --host 0.0.0.0 --port 7878 --reload
@@ -16,16 +19,24 @@ import asyncio
 import json
 import os
 import sys
+from contextlib import asynccontextmanager
 from typing import Any, AsyncGenerator, Dict, List, Optional
 
 from dotenv import load_dotenv, set_key, dotenv_values
-from fastapi import FastAPI, File, Form, UploadFile, Body, HTTPException, Query
+from fastapi import FastAPI, File, Form, UploadFile, Body, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 
+from core import json_codec
+from core import chat_protocol
 from core.agent_loop import agent_main_loop
+from core.cancellation import run_cancellable, turn_registry
+from core.checkpoint import CheckpointJournal
+from core.run_stream import run_registry, stream_run
+from core.subagent_jobs import subagent_jobs
 from core.memory import MemoryManager
 from core.model_manager import model_manager
+from core.session_cache import session_cache
 from schemas.openai import ChatCompletionRequest
 from schemas.todo import TodoCreate, TodoUpdate
 from schemas.preferences import ExtractPreferencesRequest
@@ -36,11 +47,34 @@ from services.todo_store import (
     delete_todo,
     reorder_todos,
 )
-from services.file_store import save_upload, get_file_content_by_id
+from services.file_store import save_upload, get_file_content_by_id, get_file_path_by_id
+from services.usage_ledger import usage_ledger
+from tools.result_cache import tool_result_cache
 
 load_dotenv()
 
-app = FastAPI(title="七海-后端", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """应用生命周期：启动时预热LLM连接，关闭时释放共享连接池"""
+    # 预热放到后台，不阻塞服务启动
+    warmup_task = asyncio.create_task(model_manager.warmup())
+    # 用量账本的历史回放在线程中执行，同样不阻塞启动
+    ledger_task = asyncio.create_task(usage_ledger.load())
+    # 清理上次进程遗留的运行事件落盘文件
+    await asyncio.to_thread(run_registry.sweep)
+    try:
+        yield
+    finally:
+        for task in (warmup_task, ledger_task):
+            if not task.done():
+                task.cancel()
+        await subagent_jobs.shutdown()
+        await model_manager.aclose()
+        await usage_ledger.aclose()
+
+
+app = FastAPI(title="七海-后端", version="1.0.0", lifespan=lifespan)
 
 
 # CORS 配置
@@ -60,18 +94,157 @@ async def health() -> Dict[str, Any]:
     return {"status": "ok"}
 
 
+@app.get("/api/llm/pool")
+async def llm_pool_stats() -> Dict[str, Any]:
+    """LLM共享连接池统计（每个提供商的请求数与连接状态）"""
+    return model_manager.pool_stats()
+
+
+@app.get("/api/usage")
+async def usage_summary(session_id: Optional[str] = Query(None, description="会话ID；为空返回全局汇总")) -> Dict[str, Any]:
+    """LLM用量与成本汇总（按会话 / 模型指针 / Agent / 迭代轮次）"""
+    await usage_ledger.load()
+    return usage_ledger.summary(session_id)
+
+
+@app.get("/metrics")
+async def metrics() -> PlainTextResponse:
+    """Prometheus 格式的LLM用量指标"""
+    await usage_ledger.load()
+    return PlainTextResponse(usage_ledger.prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/llm/limits")
+async def llm_rate_limit_stats() -> Dict[str, Any]:
+    """LLM限流统计（每个 base_url + model 的排队深度、在途请求数与等待时长）"""
+    return model_manager.rate_limit_stats()
+
+
+@app.get("/api/sessions/cache")
+async def session_cache_stats() -> Dict[str, Any]:
+    """热会话缓存统计（缓存会话数、占用字节、命中/磁盘恢复/淘汰次数）"""
+    return session_cache.stats()
+
+
+@app.get("/api/runs")
+async def run_stats() -> Dict[str, Any]:
+    """可续传运行统计（保留中的运行数、执行中的运行数、当前订阅者数）"""
+    return run_registry.stats()
+
+
+@app.get("/api/tools/cache")
+async def tool_cache_stats() -> Dict[str, Any]:
+    """工具结果缓存统计（条目数、占用字节、命中/未命中、淘汰与失效次数，按工具细分）"""
+    return tool_result_cache.stats()
+
+
+@app.post("/chat/{session_id}/cancel")
+async def cancel_chat(session_id: str) -> Dict[str, Any]:
+    """停止该会话正在执行的对话轮次（主循环、在途工具/SubAgent 与 LLM 请求一并取消）"""
+    return {"session_id": session_id, "cancelled": turn_registry.cancel(session_id, reason="user")}
+
+
+async def _stream_agent_events(events: AsyncGenerator[Dict[str, Any], None]) -> AsyncGenerator[bytes, None]:
+    """把 Agent 事件流格式化为旧版文本流（未声明事件流格式的客户端）"""
+    try:
+        async for chunk in events:
+            chunk_type = chunk.get("type")
+
+            if chunk_type == "content":
+                yield chunk["data"].encode("utf-8")
+
+            elif chunk_type == "meta":
+                # 元信息以前缀形式输出（JSON，前端据此解析压缩状态与历史同步版本）
+                meta = chunk.get("data")
+                yield (f"\n[meta] {json_codec.dumps(meta)}\n").encode("utf-8")
+
+            elif chunk_type == "tool_call":
+                # 输出工具调用信息
+                tool_info = chunk.get("data", {})
+                yield (f"\n[🔧 {tool_info.get('message', '工具调用')}]\n").encode("utf-8")
+
+            elif chunk_type == "tool_progress":
+                # 单个工具的开始/完成状态（前端据此显示实时进度）
+                yield (f"\n[⏳ tool_progress] {json_codec.dumps(chunk.get('data', {}))}\n").encode("utf-8")
+
+            elif chunk_type == "tool_result":
+                # 输出工具执行结果（截断过长的结果）
+                data = chunk.get("data", {})
+                tool_name = data.get("tool", "unknown")
+                result = data.get("result", "")
+                result_preview = result[:2000] + "..." if len(result) > 2000 else result
+                yield (f"\n[✓ {tool_name}]: {result_preview}\n").encode("utf-8")
+
+            elif chunk_type == "cancelled":
+                yield "\n\n⏹️ 已停止\n".encode("utf-8")
+
+            elif chunk_type == "error":
+                yield f"\n\n❌ {(chunk.get('data') or {}).get('message', '错误')}\n".encode("utf-8")
+
+            elif chunk_type == "done":
+                break
+
+            await asyncio.sleep(0)  # 让出事件循环
+    except Exception as e:
+        # 捕获并输出异常信息
+        import traceback
+        error_msg = f"\n\n❌ Agent循环异常: {str(e)}\n{traceback.format_exc()}\n"
+        print(error_msg)  # 打印到控制台
+        yield error_msg.encode("utf-8")
+
+
+def _agent_stream_response(
+    request: Request,
+    events: AsyncGenerator[Dict[str, Any], None],
+    fmt: Optional[str],
+    session_id: Optional[str],
+) -> StreamingResponse:
+    """在独立任务中执行一轮 Agent，按协商的格式返回事件流
+
+    - NDJSON / SSE：作为可续传的运行执行（core/run_stream.py），连接中断后运行继续，
+      客户端可通过 /chat/runs/{run_id}/events 从最后收到的事件续传
+    - 未声明格式（旧版文本流）：客户端断开即取消整轮
+    """
+    if fmt is None:
+        events = run_cancellable(events, session_id, request.is_disconnected)
+        return StreamingResponse(_stream_agent_events(events), media_type="text/plain; charset=utf-8")
+    run = run_registry.start(events, session_id)
+    headers = {**chat_protocol.response_headers(fmt), "X-Run-Id": run.run_id}
+    return StreamingResponse(
+        stream_run(run, fmt, 0, request.is_disconnected),
+        media_type=chat_protocol.MEDIA_TYPES[fmt],
+        headers=headers,
+    )
+
+
 @app.post("/chat")
 async def chat_endpoint(
+    request: Request,
     input: str = Form(..., description="用户输入"),
     files: Optional[List[UploadFile]] = None,
     save_ltm: bool = Form(False, description="是否保存长期记忆（用户偏好）"),
     messages: Optional[str] = Form(None, description="历史消息JSON字符串（前端传递）"),
-    session_id: Optional[str] = Form(None, description="会话ID（前端对话窗口ID，用于TODO和记忆隔离）")
+    session_id: Optional[str] = Form(None, description="会话ID（前端对话窗口ID，用于TODO和记忆隔离）"),
+    history_hash: Optional[str] = Form(None, description="前端持有的历史版本（上一轮 history_sync 返回）；提供时 messages 只需包含增量消息"),
+    stream_format: Optional[str] = Form(None, description="事件流格式：ndjson | sse（也可通过 Accept 请求头声明）；缺省为旧版文本流"),
 ) -> StreamingResponse:
     """触发 Agent 主循环，返回流式文本。
 
     核心修改：接收前端传递的 session_id，实现对话窗口级别的上下文持久化
+
+    历史同步：服务端按 session_id 保留热会话上下文。前端带上 history_hash 时只发送增量消息；
+    版本不一致（服务端已淘汰且磁盘版本不同、上一轮中断等）时返回 409，前端应改为发送完整历史；
+    排队等待会话锁期间历史被另一轮推进时，事件流中返回 code=history_mismatch 的 error 事件，处理方式相同。
     """
+    # 快速检查：明显不一致时直接 409；取得会话锁后主循环会再次核对（见 agent_main_loop）
+    if history_hash and session_id:
+        if not session_cache.matches(session_id, history_hash):
+            return JSONResponse(
+                status_code=409,
+                content={"error": "history_mismatch", "message": "服务端会话历史版本不一致，请发送完整历史"},
+            )
+    else:
+        history_hash = None
 
     # 将上传文件暂存并传递文件路径列表
     file_ids: List[str] = []
@@ -82,6 +255,8 @@ async def chat_endpoint(
             content = await f.read()
             fid = save_upload(f.filename, content)
             file_ids.append(fid)
+        # 新文件写入 file_store：list_cached_files / storage_stats 等缓存结果随之失效
+        tool_result_cache.invalidate_all(("file_store",))
 
     # 解析历史消息
     history_messages: Optional[List[Dict[str, Any]]] = None
@@ -93,59 +268,163 @@ async def chat_endpoint(
             print(f"⚠️ 解析历史消息失败: {e}")
             history_messages = None
 
-    async def event_stream() -> AsyncGenerator[bytes, None]:
+    # 核心修改：传递 session_id 给 agent_main_loop，实现对话窗口级别的上下文持久化
+    # 主循环在独立任务中执行：调用 /chat/{session_id}/cancel 时整轮取消
+    events = agent_main_loop(
+        input,
+        file_ids or None,
+        save_ltm=save_ltm,
+        history_messages=history_messages,
+        session_id=session_id,  # 传递会话ID
+        history_hash=history_hash,
+    )
+    fmt = chat_protocol.negotiate(request.headers.get("accept"), stream_format)
+    return _agent_stream_response(request, events, fmt, session_id)
+
+
+@app.get("/chat/runs/{run_id}/events")
+async def chat_run_events(
+    request: Request,
+    run_id: str,
+    after: Optional[int] = Query(None, description="最后收到的事件编号（也可通过 Last-Event-ID 请求头传递）"),
+    stream_format: Optional[str] = Query(None, description="事件流格式：ndjson | sse（缺省按 Accept，均未声明时为 ndjson）"),
+) -> StreamingResponse:
+    """重连一次运行：先补发编号 after 之后的事件，再继续接收实时事件（不会重新执行）"""
+    run = run_registry.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="运行不存在或已过期")
+    if after is None:
         try:
-            # 核心修改：传递 session_id 给 agent_main_loop，实现对话窗口级别的上下文持久化
-            async for chunk in agent_main_loop(
-                input,
-                file_ids or None,
-                save_ltm=save_ltm,
-                history_messages=history_messages,
-                session_id=session_id  # 传递会话ID
-            ):
-                chunk_type = chunk.get("type")
-
-                if chunk_type == "content":
-                    yield chunk["data"].encode("utf-8")
-
-                elif chunk_type == "meta":
-                    # 可根据需要，将元信息以前缀形式输出
-                    meta = chunk.get("data")
-                    yield (f"\n[meta] {meta}\n").encode("utf-8")
-
-                elif chunk_type == "tool_call":
-                    # 输出工具调用信息
-                    tool_info = chunk.get("data", {})
-                    yield (f"\n[🔧 {tool_info.get('message', '工具调用')}]\n").encode("utf-8")
-
-                elif chunk_type == "tool_result":
-                    # 输出工具执行结果
-                    data = chunk.get("data", {})
-                    tool_name = data.get("tool", "unknown")
-                    result = data.get("result", "")
-                    # 追加一份规范格式的工具结果行，确保前端能解析并保留换行
-                    try:
-                        result_preview = result[:2000] + "..." if len(result) > 2000 else result
-                        _formatted = f"\n[✓ {tool_name}]: {result_preview}\n"
-                        yield _formatted.encode("utf-8")
-                    except Exception:
-                        pass
-                    # 截断过长的结果
-                    result_preview = result[:2000] + "..." if len(result) > 2000 else result
-                    yield (f"\n[✓ {tool_name}]: {result_preview}\n").encode("utf-8")
-
-                elif chunk_type == "done":
-                    break
-
-                await asyncio.sleep(0)  # 让出事件循环
-        except Exception as e:
-            # 捕获并输出异常信息
-            import traceback
-            error_msg = f"\n\n❌ Agent循环异常: {str(e)}\n{traceback.format_exc()}\n"
-            print(error_msg)  # 打印到控制台
-            yield error_msg.encode("utf-8")
+            after = int(request.headers.get("last-event-id") or 0)
+        except ValueError:
+            after = 0
+    fmt = chat_protocol.negotiate(request.headers.get("accept"), stream_format) or "ndjson"
+    return StreamingResponse(
+        stream_run(run, fmt, after, request.is_disconnected),
+        media_type=chat_protocol.MEDIA_TYPES[fmt],
+        headers={**chat_protocol.response_headers(fmt), "X-Run-Id": run.run_id},
+    )
+
+
+@app.get("/chat/{session_id}/run")
+async def chat_latest_run(session_id: str) -> Dict[str, Any]:
+    """该会话最近一次运行的状态（客户端重启后据此决定是否重连）"""
+    run = run_registry.latest(session_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="没有可重连的运行")
+    return run.status()
+
+
+@app.get("/chat/{session_id}/checkpoint")
+async def chat_checkpoint(session_id: str) -> Dict[str, Any]:
+    """该会话是否有可恢复的检查点（上一轮中断：进程退出、执行异常或被停止）"""
+    records = CheckpointJournal(session_id).read()
+    header = records[0] if records and records[0].get("op") == "start" else {}
+    iterations = [r.get("iteration", 0) for r in records if r.get("op") == "iteration"]
+    return {
+        "session_id": session_id,
+        "available": bool(header) and not turn_registry.running(session_id),
+        "running": turn_registry.running(session_id),
+        "iteration": iterations[-1] if iterations else 0,
+        "records": max(0, len(records) - 1),
+        "started_at": header.get("ts"),
+    }
+
+
+@app.post("/chat/{session_id}/resume")
+async def resume_chat(
+    request: Request,
+    session_id: str,
+    save_ltm: bool = Form(False, description="是否保存长期记忆（用户偏好）"),
+    stream_format: Optional[str] = Form(None, description="事件流格式：ndjson | sse；缺省为旧版文本流"),
+) -> StreamingResponse:
+    """从检查点恢复该会话中断的一轮：重放已完成的 LLM 回复与工具结果，只补跑未完成的工具调用后继续
+
+    与 /chat 相同的流式格式；结束时返回新的 history_sync 版本。
+    """
+    if turn_registry.running(session_id):
+        return JSONResponse(status_code=409, content={"error": "turn_running", "message": "该会话正在执行中"})
+    events = agent_main_loop("", session_id=session_id, save_ltm=save_ltm, resume=True)
+    fmt = chat_protocol.negotiate(request.headers.get("accept"), stream_format)
+    return _agent_stream_response(request, events, fmt, session_id)
+
+
+@app.get("/jobs")
+async def list_jobs(session_id: Optional[str] = Query(None, description="会话ID；为空返回全部作业")) -> Dict[str, Any]:
+    """后台 SubAgent 作业列表与工作池统计"""
+    return {
+        "jobs": [job.info() for job in subagent_jobs.list(session_id)],
+        "pool": subagent_jobs.stats(),
+    }
+
+
+@app.get("/jobs/stream")
+async def jobs_stream(
+    request: Request,
+    session_id: str = Query(..., description="会话ID"),
+    stream_format: Optional[str] = Query(None, description="事件流格式：ndjson | sse（缺省按 Accept，均未声明时为 sse）"),
+) -> StreamingResponse:
+    """会话内全部后台作业的进度：先发送 jobs 快照事件，之后推送各作业的新事件（带 job_id）"""
+    fmt = chat_protocol.negotiate(request.headers.get("accept"), stream_format) or "sse"
+
+    async def events() -> AsyncGenerator[bytes, None]:
+        async for event in subagent_jobs.subscribe_session(session_id, request.is_disconnected):
+            # 各作业独立编号，会话流不写 SSE id（重连时以 jobs 快照为准）
+            yield chat_protocol.encode({k: v for k, v in event.items() if k != "id"}, fmt)
+
+    return StreamingResponse(events(), media_type=chat_protocol.MEDIA_TYPES[fmt], headers=chat_protocol.response_headers(fmt))
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> Dict[str, Any]:
+    """后台作业状态；已结束时附带 SubAgent 报告"""
+    job = subagent_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="作业不存在或已过期")
+    return {**job.info(), "result": job.result}
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(
+    request: Request,
+    job_id: str,
+    after: Optional[int] = Query(None, description="最后收到的事件编号（也可通过 Last-Event-ID 请求头传递）"),
+    stream_format: Optional[str] = Query(None, description="事件流格式：ndjson | sse（缺省按 Accept，均未声明时为 ndjson）"),
+) -> StreamingResponse:
+    """后台作业的进度事件流（迭代、工具调用、TODO 状态变化），作业结束后以 done 事件收尾"""
+    job = subagent_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="作业不存在或已过期")
+    if after is None:
+        try:
+            after = int(request.headers.get("last-event-id") or 0)
+        except ValueError:
+            after = 0
+    fmt = chat_protocol.negotiate(request.headers.get("accept"), stream_format) or "ndjson"
+
+    async def events() -> AsyncGenerator[bytes, None]:
+        async for event in job.subscribe(after, request.is_disconnected):
+            yield chat_protocol.encode(event, fmt)
+
+    return StreamingResponse(events(), media_type=chat_protocol.MEDIA_TYPES[fmt], headers=chat_protocol.response_headers(fmt))
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str) -> Dict[str, Any]:
+    """取消后台作业（排队中或运行中）"""
+    job = subagent_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="作业不存在或已过期")
+    return {"job_id": job_id, "cancelled": subagent_jobs.cancel(job)}
+
 
-    return StreamingResponse(event_stream(), media_type="text/plain; charset=utf-8")
+@app.get("/files/{file_id}")
+async def get_file(file_id: str) -> FileResponse:
+    """按 file_id 下载缓存文件（事件流中以引用发送的大型工具结果等）"""
+    path = get_file_path_by_id(file_id)
+    if not path or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return FileResponse(path)
 
 
 # OpenAI Chat Completions 兼容端点
@@ -211,6 +490,7 @@ async def upload_endpoint(files: List[UploadFile] = File(...)):
         content = await f.read()
         fid = save_upload(f.filename, content)
         ids.append(fid)
+    tool_result_cache.invalidate_all(("file_store",))
     return {"ids": ids}
 
 
@@ -664,7 +944,7 @@ async def generate_title(messages: List[Dict[str, str]] = Body(...)):
             "content": f"请为以下对话生成标题：\n{conversation_text}"
         })
 
-        resp = await compact_client.chat(prompt_messages)
+        resp = await compact_client.chat(prompt_messages, hedge=True)
         title = resp.get("content", "").strip() if isinstance(resp, dict) else str(resp).strip()
 
         if not title:
@@ -0,0 +1,369 @@
+"""LLM 用量与成本账本
+
+功能：
+- 记录每次 LLM 调用的 prompt/completion/cached tokens、延迟、模型与成本
+- 按会话 / 模型指针 / Agent（主Agent或SubAgent）/ 迭代轮次聚合
+- 提供 /api/usage 查询与 /metrics（Prometheus 文本格式）
+
+设计理念：
+- 追加写 JSONL（data/usage/YYYY-MM-DD.jsonl），一行一条记录；写入由后台任务批量落盘（线程中执行），
+  记录调用本身不做磁盘 IO
+- 聚合结果常驻内存；历史账本在线程中回放（启动时预加载，查询时等待加载完成），不阻塞事件循环
+- 会话明细按最近使用保留 USAGE_MAX_SESSIONS 个（默认 1000），每个会话保留最近 USAGE_MAX_ITERATIONS 个
+  迭代明细（默认 200）；被淘汰的明细仍计入全局 / 指针 / Agent 汇总
+- 归属信息通过 contextvars 传递：主循环设置 session/iteration，工具与 SubAgent 在各自任务中覆盖，
+  LLMClient 记录时自动带上，无需层层传参
+
+成本计算（可选）：{PREFIX}_PRICE_INPUT / {PREFIX}_PRICE_CACHED / {PREFIX}_PRICE_OUTPUT，单位：每百万 token 的价格
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import os
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from core import json_codec
+
+USAGE_DIR = os.path.join(os.getcwd(), "data", "usage")
+
+# 当前调用的归属信息：session_id / agent / iteration / tool
+_usage_context: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar("usage_context", default={})
+
+_METRIC_FIELDS = ("requests", "errors", "prompt_tokens", "completion_tokens", "cached_tokens", "latency", "cost")
+
+
+def bind_usage_context(**fields: Any) -> None:
+    """在当前上下文（当前任务）中设置归属字段，不自动恢复
+
+    适用于异步生成器等无法可靠恢复上下文的场景；子任务创建时会复制当前值。
+    """
+    _usage_context.set({**_usage_context.get(), **fields})
+
+
+@contextmanager
+def usage_scope(**fields: Any) -> Iterator[None]:
+    """临时覆盖归属字段，退出时恢复"""
+    token = _usage_context.set({**_usage_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _usage_context.reset(token)
+
+
+def current_usage_context() -> Dict[str, Any]:
+    return dict(_usage_context.get())
+
+
+def _new_bucket() -> Dict[str, float]:
+    return {field: 0 for field in _METRIC_FIELDS}
+
+
+def _add(bucket: Dict[str, float], record: Dict[str, Any]) -> None:
+    bucket["requests"] += 1
+    bucket["errors"] += 0 if record.get("ok", True) else 1
+    bucket["prompt_tokens"] += record.get("prompt_tokens", 0)
+    bucket["completion_tokens"] += record.get("completion_tokens", 0)
+    bucket["cached_tokens"] += record.get("cached_tokens", 0)
+    bucket["latency"] += record.get("latency", 0.0)
+    bucket["cost"] += record.get("cost", 0.0)
+
+
+def _merge_bucket(bucket: Dict[str, float], other: Dict[str, float]) -> None:
+    for field in _METRIC_FIELDS:
+        bucket[field] += other.get(field, 0)
+
+
+def _int_env(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _round_bucket(bucket: Dict[str, float]) -> Dict[str, Any]:
+    result = dict(bucket)
+    result["latency"] = round(result["latency"], 3)
+    result["cost"] = round(result["cost"], 6)
+    return result
+
+
+class UsageLedger:
+    """追加写账本 + 内存聚合"""
+
+    def __init__(self, directory: str = USAGE_DIR) -> None:
+        self.directory = directory
+        # 本进程记录的账本行 ts 不小于该值：回放历史时跳过，避免与内存中的实时聚合重复计数
+        self._since = round(time.time(), 3)
+        self._loaded = False
+        self._load_task: Optional[asyncio.Task] = None
+        self._file = None
+        self._file_date: Optional[str] = None
+        self._pending: List[str] = []
+        self._writer: Optional[asyncio.Task] = None
+        self.max_sessions = max(1, _int_env("USAGE_MAX_SESSIONS", 1000))
+        self.max_iterations = max(1, _int_env("USAGE_MAX_ITERATIONS", 200))
+        self.totals = _new_bucket()
+        self.by_pointer: Dict[str, Dict[str, float]] = defaultdict(_new_bucket)
+        self.by_agent: Dict[str, Dict[str, float]] = defaultdict(_new_bucket)
+        self.sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    # ---------------- 写入 ----------------
+
+    def _open_file(self):
+        today = datetime.now().strftime("%Y-%m-%d")
+        if self._file is None or self._file_date != today:
+            if self._file is not None:
+                self._file.close()
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(os.path.join(self.directory, f"{today}.jsonl"), "a", encoding="utf-8")
+            self._file_date = today
+        return self._file
+
+    def record(
+        self,
+        pointer: str,
+        model: str,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        cached_tokens: int = 0,
+        latency: float = 0.0,
+        ok: bool = True,
+        stream: bool = False,
+        price: Optional[Dict[str, float]] = None,
+    ) -> Dict[str, Any]:
+        """记录一次 LLM 调用（归属字段取自当前上下文）；落盘由后台写入任务完成"""
+        record: Dict[str, Any] = {
+            "ts": round(time.time(), 3),
+            "pointer": pointer,
+            "model": model,
+            "prompt_tokens": int(prompt_tokens or 0),
+            "completion_tokens": int(completion_tokens or 0),
+            "cached_tokens": int(cached_tokens or 0),
+            "latency": round(latency, 3),
+            "ok": ok,
+            "stream": stream,
+            **current_usage_context(),
+        }
+        if price:
+            uncached = max(0, record["prompt_tokens"] - record["cached_tokens"])
+            record["cost"] = round((
+                uncached * price.get("input", 0)
+                + record["cached_tokens"] * price.get("cached", price.get("input", 0))
+                + record["completion_tokens"] * price.get("output", 0)
+            ) / 1_000_000, 8)
+
+        self._pending.append(json_codec.dumps(record) + "\n")
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # 没有事件循环（脚本/测试中同步调用）：直接写入
+            self._write_pending()
+        else:
+            if self._writer is None or self._writer.done():
+                self._writer = asyncio.create_task(self._drain())
+
+        self._aggregate(record)
+        return record
+
+    def _write_pending(self) -> None:
+        lines, self._pending = self._pending, []
+        if lines:
+            self._write_lines(lines)
+
+    def _write_lines(self, lines: List[str]) -> None:
+        try:
+            f = self._open_file()
+            f.write("".join(lines))
+            f.flush()
+        except Exception as e:
+            print(f"⚠️ 写入用量账本失败: {e}")
+
+    async def _drain(self) -> None:
+        """后台写入：把积攒的记录整批交给线程落盘，直到没有待写记录"""
+        while self._pending:
+            lines, self._pending = self._pending, []
+            await asyncio.to_thread(self._write_lines, lines)
+
+    # ---------------- 聚合 ----------------
+
+    def _aggregate(self, record: Dict[str, Any]) -> None:
+        agent = record.get("agent") or "main"
+        _add(self.totals, record)
+        _add(self.by_pointer[record.get("pointer", "unknown")], record)
+        _add(self.by_agent[agent], record)
+
+        session_id = record.get("session_id")
+        if not session_id:
+            return
+        session = self._session(session_id)
+        _add(session["total"], record)
+        _add(session["pointers"][record.get("pointer", "unknown")], record)
+        _add(session["agents"][agent], record)
+        if record.get("iteration") is not None:
+            iterations = session["iterations"]
+            _add(iterations[f"{agent}#{record['iteration']}"], record)
+            while len(iterations) > self.max_iterations:
+                iterations.pop(next(iter(iterations)))
+
+    def _session(self, session_id: str) -> Dict[str, Any]:
+        """取会话明细（标记为最近使用），超出 max_sessions 时淘汰最久未使用的会话"""
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = {
+                "total": _new_bucket(),
+                "pointers": defaultdict(_new_bucket),
+                "agents": defaultdict(_new_bucket),
+                "iterations": defaultdict(_new_bucket),
+            }
+            self.sessions[session_id] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        else:
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def _replay(self) -> "UsageLedger":
+        """（线程中执行）回放本进程启动前的历史账本，聚合到独立的账本对象中"""
+        history = UsageLedger(self.directory)
+        history.max_sessions = self.max_sessions
+        history.max_iterations = self.max_iterations
+        if not os.path.isdir(self.directory):
+            return history
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".jsonl"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "rb") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            record = json_codec.loads(line)
+                        except json_codec.JSONDecodeError:
+                            continue
+                        if record.get("ts", 0) < self._since:
+                            history._aggregate(record)
+            except Exception as e:
+                print(f"⚠️ 读取用量账本失败: {name} - {e}")
+        return history
+
+    def _merge(self, history: "UsageLedger") -> None:
+        """把历史聚合并入实时聚合；历史会话视为比本进程的会话更早使用"""
+        _merge_bucket(self.totals, history.totals)
+        for pointer, bucket in history.by_pointer.items():
+            _merge_bucket(self.by_pointer[pointer], bucket)
+        for agent, bucket in history.by_agent.items():
+            _merge_bucket(self.by_agent[agent], bucket)
+        for session_id, old in reversed(history.sessions.items()):
+            session = self.sessions.get(session_id)
+            if session is None:
+                self.sessions[session_id] = old
+                self.sessions.move_to_end(session_id, last=False)
+                continue
+            _merge_bucket(session["total"], old["total"])
+            for key in ("pointers", "agents"):
+                for name, bucket in old[key].items():
+                    _merge_bucket(session[key][name], bucket)
+            # 历史迭代排在前面，便于按插入顺序淘汰最早的迭代
+            iterations = old["iterations"]
+            for name, bucket in session["iterations"].items():
+                _merge_bucket(iterations[name], bucket)
+            while len(iterations) > self.max_iterations:
+                iterations.pop(next(iter(iterations)))
+            session["iterations"] = iterations
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    async def load(self) -> None:
+        """回放历史账本（只执行一次；并发调用等待同一次加载）"""
+        if self._loaded:
+            return
+        if self._load_task is None:
+            self._load_task = asyncio.create_task(self._load())
+        await asyncio.shield(self._load_task)
+
+    async def _load(self) -> None:
+        try:
+            history = await asyncio.to_thread(self._replay)
+            self._merge(history)
+        finally:
+            self._loaded = True
+
+    # ---------------- 查询 ----------------
+
+    def summary(self, session_id: Optional[str] = None) -> Dict[str, Any]:
+        """聚合视图：不传 session_id 返回全局视图，否则返回该会话按指针/Agent/迭代的明细
+
+        历史账本尚未加载完成时只包含本进程的记录（接口层先 await load()）。
+        """
+        if session_id:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return {"session_id": session_id, "total": _new_bucket(), "pointers": {}, "agents": {}, "iterations": {}}
+            return {
+                "session_id": session_id,
+                "total": _round_bucket(session["total"]),
+                "pointers": {k: _round_bucket(v) for k, v in session["pointers"].items()},
+                "agents": {k: _round_bucket(v) for k, v in session["agents"].items()},
+                "iterations": {k: _round_bucket(v) for k, v in session["iterations"].items()},
+            }
+        top_sessions = sorted(
+            self.sessions.items(),
+            key=lambda item: item[1]["total"]["prompt_tokens"] + item[1]["total"]["completion_tokens"],
+            reverse=True,
+        )[:20]
+        return {
+            "total": _round_bucket(self.totals),
+            "pointers": {k: _round_bucket(v) for k, v in self.by_pointer.items()},
+            "agents": {k: _round_bucket(v) for k, v in self.by_agent.items()},
+            "top_sessions": {k: _round_bucket(v["total"]) for k, v in top_sessions},
+        }
+
+    def prometheus(self) -> str:
+        """Prometheus 文本格式指标"""
+        lines: List[str] = [
+            "# HELP nanami_llm_requests_total LLM 调用次数",
+            "# TYPE nanami_llm_requests_total counter",
+        ]
+        for pointer, bucket in self.by_pointer.items():
+            lines.append(f'nanami_llm_requests_total{{pointer="{pointer}",status="ok"}} {bucket["requests"] - bucket["errors"]}')
+            lines.append(f'nanami_llm_requests_total{{pointer="{pointer}",status="error"}} {bucket["errors"]}')
+        lines += ["# HELP nanami_llm_tokens_total LLM token 用量", "# TYPE nanami_llm_tokens_total counter"]
+        for pointer, bucket in self.by_pointer.items():
+            for kind in ("prompt", "completion", "cached"):
+                lines.append(f'nanami_llm_tokens_total{{pointer="{pointer}",kind="{kind}"}} {bucket[kind + "_tokens"]}')
+        lines += ["# HELP nanami_llm_agent_tokens_total 按 Agent 统计的 token 用量", "# TYPE nanami_llm_agent_tokens_total counter"]
+        for agent, bucket in self.by_agent.items():
+            lines.append(f'nanami_llm_agent_tokens_total{{agent="{agent}"}} {bucket["prompt_tokens"] + bucket["completion_tokens"]}')
+        lines += ["# HELP nanami_llm_latency_seconds LLM 调用延迟", "# TYPE nanami_llm_latency_seconds summary"]
+        for pointer, bucket in self.by_pointer.items():
+            lines.append(f'nanami_llm_latency_seconds_sum{{pointer="{pointer}"}} {round(bucket["latency"], 3)}')
+            lines.append(f'nanami_llm_latency_seconds_count{{pointer="{pointer}"}} {bucket["requests"]}')
+        lines += ["# HELP nanami_llm_cost_total LLM 估算成本", "# TYPE nanami_llm_cost_total counter"]
+        for pointer, bucket in self.by_pointer.items():
+            lines.append(f'nanami_llm_cost_total{{pointer="{pointer}"}} {round(bucket["cost"], 6)}')
+        return "\n".join(lines) + "\n"
+
+    async def aclose(self) -> None:
+        """等待后台写入完成并关闭文件（应用关闭时调用）"""
+        if self._load_task is not None and not self._load_task.done():
+            self._load_task.cancel()
+        if self._writer is not None and not self._writer.done():
+            await asyncio.gather(self._writer, return_exceptions=True)
+        self.close()
+
+    def close(self) -> None:
+        self._write_pending()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# 单例，便于全局使用
+usage_ledger = UsageLedger()
@@ -1,16 +1,55 @@
 """工具基类定义。"""
+import os
 from abc import ABC, abstractmethod
-from typing import Any, Dict
+from typing import Any, Dict, Tuple
+
+
+# 外部资源的默认并发上限（进程级，跨会话共享）
+# 可通过环境变量 TOOL_RESOURCE_LIMIT_<资源名大写> 覆盖，如 TOOL_RESOURCE_LIMIT_TAVILY=2
+RESOURCE_LIMITS: Dict[str, int] = {
+    "tavily": 4,        # Tavily API
+    "playwright": 1,    # 进程内唯一的 Playwright 浏览器（_PW_SINGLETON）
+    "desktop": 1,       # 鼠标键盘输入与屏幕截图
+    "todo_store": 4,    # data/todos
+    "file_store": 2,    # 缓存文件与本地保存
+    "report_store": 4,  # SearchSubAgent 报告
+    "subagent_jobs": 16,  # 后台作业表（查询/等待可并行，取消与之按提交顺序执行）
+}
+
+
+def resource_limit(resource: str) -> int:
+    """资源并发上限（环境变量优先，未登记的资源默认 1）"""
+    default = RESOURCE_LIMITS.get(resource, 1)
+    try:
+        limit = int(os.getenv(f"TOOL_RESOURCE_LIMIT_{resource.upper()}", str(default)))
+    except Exception:
+        return default
+    return max(1, limit)
 
 
 class BaseTool(ABC):
-    """所有外部工具需实现的统一接口。"""
+    """所有外部工具需实现的统一接口。
+
+    调度属性（供 ToolCallDispatcher 判断哪些调用可以并行）：
+    - read_only: 只读工具之间互不影响；默认 False（有副作用，保守处理）
+    - resources: 使用的外部资源名（见 RESOURCE_LIMITS），共享资源的读写/写写调用按提交顺序串行；
+      有副作用且未声明资源的工具视为与同批次所有调用冲突
+    - hold_resources: 执行期间是否占用 resources 的并发名额（默认 True）；为 False 时 resources 只用于
+      调度排序与缓存失效，名额由内部的嵌套工具调用各自获取（如 search_subagent 内的 tavily_*）
+
+    缓存属性（见 tools/result_cache.py）：
+    - cache_ttl: 结果在会话内的缓存时间（秒），0 表示不缓存（默认）；只应在无副作用、
+      相同参数结果稳定的工具上声明。有副作用（read_only=False）的工具执行后会清除同会话中共享资源的缓存
+    """
 
     name: str
     description: str
+    read_only: bool = False
+    resources: Tuple[str, ...] = ()
+    hold_resources: bool = True
+    cache_ttl: float = 0
 
     @abstractmethod
     async def execute(self, **kwargs) -> Dict[str, Any]:
         """执行工具，返回统一结构的结果字典。"""
         raise NotImplementedError
-
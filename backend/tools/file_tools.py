@@ -5,6 +5,7 @@
 2. ListCachedFilesTool - 列出所有缓存的文件
 3. StorageStatsTool - 查看存储统计信息
 4. CleanupStorageTool - 清理旧文件
+5. ViewImageTool - 按file_id重新查看已移出上下文的图片
 """
 from __future__ import annotations
 
@@ -13,7 +14,13 @@ import shutil
 from typing import Any, Dict
 
 from .base import BaseTool
-from services.file_store import get_cached_data, get_storage_stats, cleanup_old_files
+from services.file_store import (
+    get_cached_data,
+    get_storage_stats,
+    cleanup_old_files,
+    get_file_path_by_id,
+    is_image_file,
+)
 
 
 class SaveCachedFileTool(BaseTool):
@@ -25,6 +32,8 @@ class SaveCachedFileTool(BaseTool):
     - 支持覆盖现有文件
     """
     name = "save_cached_file"
+    read_only = False
+    resources = ("file_store",)
     description = "将缓存的文件（通过file_id引用）保存到本地路径。用于保存截图、PDF等工具生成的文件。"
 
     async def execute(self, **kwargs) -> Dict[str, Any]:
@@ -90,6 +99,9 @@ class ListCachedFilesTool(BaseTool):
     - 包含file_id、类型、大小等信息
     """
     name = "list_cached_files"
+    read_only = True
+    resources = ("file_store",)
+    cache_ttl = 30
     description = "列出所有缓存的临时文件，显示file_id、类型、大小等信息。"
 
     async def execute(self, **kwargs) -> Dict[str, Any]:
@@ -135,6 +147,9 @@ class StorageStatsTool(BaseTool):
     - 显示最旧和最新文件信息
     """
     name = "storage_stats"
+    read_only = True
+    resources = ("file_store",)
+    cache_ttl = 30
     description = "查看文件存储统计信息，包括总大小、文件类型分布、最旧/最新文件等。用于监控存储使用情况。"
 
     async def execute(self, **kwargs) -> Dict[str, Any]:
@@ -169,6 +184,8 @@ class CleanupStorageTool(BaseTool):
     - 自动重建索引
     """
     name = "cleanup_storage"
+    read_only = False
+    resources = ("file_store",)
     description = """清理旧的缓存文件以释放空间。支持按时间和大小清理。
 
     使用场景：
@@ -201,3 +218,35 @@ class CleanupStorageTool(BaseTool):
                 "message": f"清理文件失败: {e}\n{traceback.format_exc()}"
             }
 
+
+
+class ViewImageTool(BaseTool):
+    """重新查看图片
+
+    功能：
+    - 较早的截图/图片会从上下文中移出，只保留 file_id 引用（见 MemoryManager.age_images）
+    - 需要再次查看时按 file_id 调用本工具，图片会在下一轮重新附到对话中
+    """
+    name = "view_image"
+    read_only = True
+    resources = ("file_store",)
+    description = "按file_id重新查看图片。上下文中已移出的截图会显示为 file_id 引用，需要再次查看图片细节时调用，图片将在下一轮附上。"
+
+    async def execute(self, file_id: str = "", **kwargs) -> Dict[str, Any]:
+        if not file_id:
+            return {"error": True, "message": "缺少参数 file_id"}
+
+        file_path = get_file_path_by_id(file_id)
+        if not file_path or not os.path.exists(file_path):
+            return {"error": True, "message": f"未找到file_id: {file_id}。可能文件已过期或ID无效。"}
+        if not is_image_file(file_path):
+            return {"error": True, "message": f"file_id 不是图片文件: {file_id}"}
+
+        # 返回 data.file_id，主循环检测到图片后会在下一轮注入
+        return {
+            "error": False,
+            "data": {
+                "file_id": file_id,
+                "message": "✅ 图片将在下一轮附到对话中"
+            }
+        }
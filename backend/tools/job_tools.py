@@ -0,0 +1,119 @@
+"""SubAgent后台作业工具
+
+功能：
+- 查询后台SubAgent作业的状态与进度
+- 等待作业完成并取回报告、列出本会话的作业（subagent_job，只读）
+- 取消作业（cancel_subagent_job，有副作用，与同批次的查询/等待按提交顺序执行）
+
+使用场景：
+- 以 background=true 调用 search_subagent / browser_subagent 等之后，跟进作业结果
+"""
+from __future__ import annotations
+
+import os
+from typing import Any, Dict, Optional
+
+from tools.base import BaseTool
+
+
+def _wait_timeout(timeout: Optional[float]) -> float:
+    """等待时间：默认 SUBAGENT_JOB_WAIT，且不超过工具执行超时（留出返回结果的余量）"""
+    try:
+        wait = float(timeout) if timeout is not None else float(os.getenv("SUBAGENT_JOB_WAIT", "60"))
+    except Exception:
+        wait = 60.0
+    try:
+        limit = float(os.getenv("TOOL_EXECUTION_TIMEOUT", "120"))
+    except Exception:
+        limit = 120.0
+    if limit > 0:
+        wait = min(wait, limit * 0.9)
+    return max(0.0, wait)
+
+
+class SubAgentJobTool(BaseTool):
+    """SubAgent后台作业管理工具"""
+
+    name = "subagent_job"
+    read_only = True
+    resources = ("subagent_jobs",)
+    description = """查询或等待后台SubAgent作业（取消作业使用 cancel_subagent_job）。
+
+以 background=true 调用 *_subagent 工具时会立即返回 job_id，SubAgent 在后台执行。
+
+操作：
+- status: 查询作业状态（已结束时返回SubAgent报告）
+- wait: 等待作业结束（最多 timeout 秒），结束时返回SubAgent报告，否则返回当前进度
+- list: 列出本会话的全部作业
+
+使用示例：
+- subagent_job(action="wait", job_id="3f2a9c1d7e4b", timeout=60)
+"""
+
+    async def execute(
+        self,
+        action: str = "status",
+        job_id: Optional[str] = None,
+        timeout: Optional[float] = None,
+        session_id: str = "default",
+        **kwargs,
+    ) -> Dict[str, Any]:
+        """执行作业操作
+
+        Args:
+            action: status | wait | list
+            job_id: 作业ID（list 时可省略）
+            timeout: wait 的最长等待时间（秒）
+            session_id: 会话ID（只能操作本会话的作业）
+        """
+        from core.subagent_jobs import subagent_jobs
+
+        if action == "list":
+            jobs = [job.info() for job in subagent_jobs.list(session_id)]
+            return {
+                "error": False,
+                "data": {"jobs": jobs},
+                "message": f"✅ 本会话共有 {len(jobs)} 个后台作业",
+            }
+
+        job = subagent_jobs.get(job_id or "", session_id)
+        if job is None:
+            return {"error": True, "message": f"作业不存在或已过期: {job_id}", "data": None}
+
+        if action == "wait":
+            await job.wait(_wait_timeout(timeout))
+        elif action == "cancel":
+            return {"error": True, "message": "取消作业请使用 cancel_subagent_job 工具", "data": None}
+        elif action != "status":
+            return {"error": True, "message": f"不支持的操作: {action}", "data": None}
+
+        return job.outcome()
+
+
+class SubAgentJobCancelTool(BaseTool):
+    """取消后台SubAgent作业"""
+
+    name = "cancel_subagent_job"
+    read_only = False
+    resources = ("subagent_jobs",)
+    description = """取消后台SubAgent作业（只能取消本会话的作业，已结束的作业不受影响）。
+
+使用示例：
+- cancel_subagent_job(job_id="3f2a9c1d7e4b")
+"""
+
+    async def execute(self, job_id: Optional[str] = None, session_id: str = "default", **kwargs) -> Dict[str, Any]:
+        """取消作业并等待其结束（最多 5 秒）
+
+        Args:
+            job_id: 作业ID
+            session_id: 会话ID（只能操作本会话的作业）
+        """
+        from core.subagent_jobs import subagent_jobs
+
+        job = subagent_jobs.get(job_id or "", session_id)
+        if job is None:
+            return {"error": True, "message": f"作业不存在或已过期: {job_id}", "data": None}
+        if subagent_jobs.cancel(job):
+            await job.wait(5)
+        return job.outcome()
@@ -4,8 +4,12 @@
 """
 from __future__ import annotations
 
-import json
-from typing import Any, Dict, List, Optional
+import asyncio
+import contextvars
+import os as _os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
 
 from .tavily_wrapper import (
     TavilySearchTool,
@@ -28,6 +32,7 @@ from .file_tools import (
     ListCachedFilesTool,
     StorageStatsTool,
     CleanupStorageTool,
+    ViewImageTool,
 )
 from .vision_screenshot_tools import (
     ScreenshotTool,
@@ -43,8 +48,27 @@ from .report_tools import (
 from .subagent_windows import WindowsSubAgentTool
 from .subagent_browser import BrowserSubAgentTool
 from .subagent_search import SearchSubAgentTool  # 🆕 深度搜索SubAgent
+from .job_tools import SubAgentJobCancelTool, SubAgentJobTool
 
-from .base import BaseTool
+from .base import BaseTool, resource_limit
+from .result_cache import execute_cached
+from core import json_codec
+from core.checkpoint import current_tool_call_id
+from core.subagent_jobs import current_job, subagent_jobs
+from services.usage_ledger import usage_scope
+
+# 当前调用链已持有的资源名额（如 browser_subagent 持有 desktop）：嵌套的工具调用不再重复获取，避免自锁
+_held_resources: contextvars.ContextVar[frozenset] = contextvars.ContextVar("held_tool_resources", default=frozenset())
+
+
+def same_tool_call(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    """两个 OpenAI 格式的 tool_call 是否为同一调用（id、函数名与参数都一致）"""
+    fa, fb = a.get("function") or {}, b.get("function") or {}
+    return (
+        a.get("id") == b.get("id")
+        and fa.get("name") == fb.get("name")
+        and fa.get("arguments") == fb.get("arguments")
+    )
 
 
 class ToolManager:
@@ -52,6 +76,10 @@ class ToolManager:
 
     def __init__(self) -> None:
         self.tools: Dict[str, BaseTool] = {}
+        # 外部资源的并发闸门（进程级，按 RESOURCE_LIMITS 懒创建）
+        self._resource_sems: Dict[str, asyncio.Semaphore] = {}
+        # 被后台作业长期占用的资源 -> job_id（前台调用遇到时直接报忙，不排队等待）
+        self._resource_jobs: Dict[str, str] = {}
         self._register_all_tools()
 
     def _register_all_tools(self) -> None:
@@ -71,6 +99,10 @@ class ToolManager:
         self.tools["windows_subagent"] = WindowsSubAgentTool()
         self.tools["browser_subagent"] = BrowserSubAgentTool()
 
+        # SubAgent后台作业工具（2个）- 查询/等待、取消 background=true 提交的作业
+        self.tools["subagent_job"] = SubAgentJobTool()
+        self.tools["cancel_subagent_job"] = SubAgentJobCancelTool()
+
         # ToDo管理工具集（5个）
         self.tools["list_todos"] = TodoListTool()
         self.tools["create_todo"] = TodoCreateTool()
@@ -78,11 +110,12 @@ class ToolManager:
         self.tools["delete_todo"] = TodoDeleteTool()
         self.tools["reorder_todos"] = TodoReorderTool()
 
-        # 文件操作工具集（4个）
+        # 文件操作工具集（5个）
         self.tools["save_cached_file"] = SaveCachedFileTool()
         self.tools["list_cached_files"] = ListCachedFilesTool()
         self.tools["storage_stats"] = StorageStatsTool()
         self.tools["cleanup_storage"] = CleanupStorageTool()
+        self.tools["view_image"] = ViewImageTool()
 
         # 报告管理工具集（3个）- 用于读取SearchSubAgent报告
         self.tools["read_report"] = ReadReportTool()
@@ -436,6 +469,24 @@ SubAgent可用工具：
             }
         })
 
+        tools.append({
+            "type": "function",
+            "function": {
+                "name": "view_image",
+                "description": "按file_id重新查看图片。较早的截图会从上下文移出并显示为 file_id 引用，需要再次查看图片细节时调用，图片将在下一轮附上。",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "file_id": {
+                            "type": "string",
+                            "description": "图片的file_id（来自截图工具返回或上下文中的图片引用）"
+                        }
+                    },
+                    "required": ["file_id"]
+                }
+            }
+        })
+
         # 报告管理工具
         tools.append({
             "type": "function",
@@ -491,10 +542,70 @@ SubAgent可用工具：
             }
         })
 
+        # SubAgent后台作业
+        tools.append({
+            "type": "function",
+            "function": {
+                "name": "subagent_job",
+                "description": self.tools["subagent_job"].description,
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "action": {
+                            "type": "string",
+                            "enum": ["status", "wait", "list"],
+                            "description": "操作类型（默认 status）",
+                            "default": "status"
+                        },
+                        "job_id": {
+                            "type": "string",
+                            "description": "作业ID（后台调用 *_subagent 时返回；list 时可省略）"
+                        },
+                        "timeout": {
+                            "type": "number",
+                            "description": "wait 的最长等待时间（秒），超时仍未结束时返回当前进度"
+                        }
+                    },
+                    "required": ["action"]
+                }
+            }
+        })
+        tools.append({
+            "type": "function",
+            "function": {
+                "name": "cancel_subagent_job",
+                "description": self.tools["cancel_subagent_job"].description,
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "job_id": {
+                            "type": "string",
+                            "description": "要取消的作业ID"
+                        }
+                    },
+                    "required": ["job_id"]
+                }
+            }
+        })
+
+        # 所有 SubAgent 工具都支持后台作业模式
+        for definition in tools:
+            function = definition["function"]
+            if function["name"].endswith("_subagent"):
+                function["parameters"]["properties"]["background"] = {
+                    "type": "boolean",
+                    "description": "后台执行（可选，默认 false）。为 true 时立即返回 job_id 而不等待结果，"
+                                   "之后用 subagent_job 工具查询进度或等待、用 cancel_subagent_job 取消；适合耗时较长、无需立即得到结果的任务"
+                }
+
         return tools
 
     async def execute_tool(
-        self, tool_name: str, arguments: Dict[str, Any], session_id: str = "default"  # ✅ 新增：session_id参数
+        self,
+        tool_name: str,
+        arguments: Dict[str, Any],
+        session_id: str = "default",  # ✅ 新增：session_id参数
+        timeout: Optional[float] = None,
     ) -> Dict[str, Any]:
         """执行工具调用（带超时控制）
 
@@ -507,7 +618,6 @@ SubAgent可用工具：
             统一格式的执行结果：{"error": bool, "data": any, "message": str}
         """
         import asyncio
-        import os as _os
         import logging
 
         logger = logging.getLogger(__name__)
@@ -523,13 +633,10 @@ SubAgent可用工具：
         tool = self.tools[tool_name]
 
         # 阶段2：获取超时配置
-        # 优先级：工具参数 > 环境变量 > 默认值（120秒）
+        # 优先级：工具参数 > 调用方传入的剩余时间（派发器已扣除等待资源的时间）> 环境变量 > 默认值（120秒）
         timeout_seconds = arguments.get("_timeout", None)
         if timeout_seconds is None:
-            try:
-                timeout_seconds = int(_os.getenv("TOOL_EXECUTION_TIMEOUT", "120"))
-            except Exception:
-                timeout_seconds = 120
+            timeout_seconds = timeout if timeout is not None else self.tool_timeout()
         # 允许通过 0 或 负数表示“无限超时”——此处转为极大值以兼容 wait_for
         try:
             if int(timeout_seconds) <= 0:
@@ -540,7 +647,6 @@ SubAgent可用工具：
         # 阶段3：执行工具（带超时控制）
         try:
             logger.info(f"🔧 开始执行工具: {tool_name} (超时: {timeout_seconds}秒)")
-            import time
             start_time = time.time()
 
             # ✅ 如果是SubAgent工具或TODO工具，自动注入session_id
@@ -548,15 +654,28 @@ SubAgent可用工具：
                 if "session_id" not in arguments:
                     arguments["session_id"] = session_id
                     logger.info(f"✅ 自动注入session_id给SubAgent: {session_id}")
+                # 后台作业模式：提交到有界工作池后立即返回 job_id，不受 TOOL_EXECUTION_TIMEOUT 限制
+                if arguments.pop("background", False):
+                    return subagent_jobs.submit(
+                        tool_name,
+                        session_id,
+                        str(arguments.get("task_description", "")),
+                        lambda: self._run_background(tool, session_id, arguments),
+                    )
             elif tool_name in ["list_todos", "create_todo", "update_todo", "delete_todo", "reorder_todos"]:  # TODO工具
                 if "session_id" not in arguments:
                     arguments["session_id"] = session_id
                     logger.info(f"✅ 自动注入session_id给TODO工具: {session_id}")
+            elif tool_name in ["subagent_job", "cancel_subagent_job"]:  # 作业工具：只能操作本会话的作业
+                arguments["session_id"] = session_id
 
             # 使用 asyncio.wait_for 添加超时保护
-            result = await asyncio.wait_for(
-                tool.execute(**arguments),
-                timeout=timeout_seconds
+            # 无副作用的工具（声明 cache_ttl）在会话内按参数缓存结果，重复调用直接返回
+            result = await execute_cached(
+                tool,
+                session_id,
+                arguments,
+                lambda: asyncio.wait_for(tool.execute(**arguments), timeout=timeout_seconds),
             )
 
             elapsed = time.time() - start_time
@@ -564,6 +683,11 @@ SubAgent可用工具：
 
             return result
 
+        except asyncio.CancelledError:
+            # 主循环停止/客户端断开：wait_for 已取消工具协程，向上传播
+            logger.info(f"⏹️ 工具执行已取消: {tool_name}")
+            raise
+
         except asyncio.TimeoutError:
             elapsed = time.time() - start_time
             logger.error(f"⏰ 工具执行超时: {tool_name} ({elapsed:.2f}秒 / {timeout_seconds}秒)")
@@ -582,60 +706,359 @@ SubAgent可用工具：
                 "data": None
             }
 
-    async def execute_tool_calls(
-        self, tool_calls: List[Dict[str, Any]], session_id: str = "default"  # ✅ 新增：session_id参数
-    ) -> List[Dict[str, Any]]:
-        """批量执行工具调用（限流并发）
+    async def _run_background(self, tool: BaseTool, session_id: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        """在后台作业中执行SubAgent工具
 
-        - 使用 asyncio.Semaphore 控制最大并发数
-        - 通过 env `MAX_TOOL_CONCURRENCY` 配置并发度（默认 5）
-        - 返回顺序与传入的 tool_calls 顺序一致
-        - session_id: 会话ID，用于TODO隔离和SubAgent上下文传递
+        提交时工具调用已立即返回，派发器持有的资源名额随之释放；作业执行期间在此重新占用
+        工具声明的资源（如唯一的 Playwright 浏览器），避免与其他调用/作业同时操作
         """
-        import asyncio
-        import os as _os
+        acquired: List[asyncio.Semaphore] = []
+        job = current_job.get()
+        held: List[str] = []
+        token = _held_resources.set(_held_resources.get() | frozenset(tool.resources if tool.hold_resources else ()))
+        try:
+            for resource in sorted(tool.resources) if tool.hold_resources else []:
+                sem = self.resource_semaphore(resource)
+                await sem.acquire()
+                acquired.append(sem)
+                # 只登记独占资源：共享名额的资源（如 tavily）前台调用仍可正常排队
+                if job is not None and resource_limit(resource) == 1:
+                    self._resource_jobs[resource] = job.job_id
+                    held.append(resource)
+            return await execute_cached(tool, session_id, arguments, lambda: tool.execute(**arguments))
+        finally:
+            _held_resources.reset(token)
+            for resource in held:
+                self._resource_jobs.pop(resource, None)
+            for sem in acquired:
+                sem.release()
+
+    def tool_timeout(self) -> float:
+        """工具执行超时（秒）：TOOL_EXECUTION_TIMEOUT，默认 120；0 或负数表示不限"""
+        try:
+            return float(_os.getenv("TOOL_EXECUTION_TIMEOUT", "120"))
+        except Exception:
+            return 120.0
+
+    async def acquire_resources(self, tool: Optional[BaseTool], timeout: Optional[float]) -> List[asyncio.Semaphore]:
+        """按固定顺序获取工具的资源名额（避免多资源工具之间互相等待）
 
+        - 资源被后台作业占用时立即报忙（作业可能运行到 SUBAGENT_JOB_TIMEOUT），不排队
+        - 其余情况最多等待 timeout 秒（None 表示不限），超时报忙
+        - hold_resources=False 的工具不占用名额；调用链上已持有的资源（嵌套调用）跳过
+        失败时释放已获取的名额并抛出 ResourceBusyError
+        """
+        acquired: List[asyncio.Semaphore] = []
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        held = _held_resources.get()
+        resources = sorted(set(tool.resources) - held) if tool is not None and tool.hold_resources else []
+        try:
+            for resource in resources:
+                sem = self.resource_semaphore(resource)
+                job_id = self._resource_jobs.get(resource)
+                if job_id is not None and sem.locked():
+                    raise ResourceBusyError(
+                        f"资源忙：{resource} 正被后台作业 {job_id} 占用，"
+                        f"可用 subagent_job 查询/等待该作业，或用 cancel_subagent_job 取消后重试"
+                    )
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    await asyncio.wait_for(sem.acquire(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    raise ResourceBusyError(f"资源忙：等待 {resource} 超时 ({timeout:.0f}秒)，请稍后重试") from None
+                acquired.append(sem)
+        except BaseException:
+            for sem in reversed(acquired):
+                sem.release()
+            raise
+        return acquired
+
+    @asynccontextmanager
+    async def resource_slots(self, tool: Optional[BaseTool], timeout: Optional[float]) -> AsyncIterator[None]:
+        """在上下文内持有工具的资源名额，并登记为已持有（其中的嵌套工具调用不再重复获取）"""
+        acquired = await self.acquire_resources(tool, timeout)
+        held = frozenset(tool.resources) if tool is not None and tool.hold_resources else frozenset()
+        token = _held_resources.set(_held_resources.get() | held)
         try:
-            # 为降低外部 API 压力，将并发默认值从 5 下调到 1（可通过环境变量覆盖）
-            max_c = int(_os.getenv("MAX_TOOL_CONCURRENCY", "1"))
+            yield
+        finally:
+            _held_resources.reset(token)
+            for sem in reversed(acquired):
+                sem.release()
+
+    def _max_tool_concurrency(self) -> int:
+        try:
+            # 外部 API 压力由各资源的并发上限控制（见 tools/base.py RESOURCE_LIMITS），
+            # 这里只限制单批次同时执行的工具数
+            max_c = int(_os.getenv("MAX_TOOL_CONCURRENCY", "4"))
             if max_c <= 0:
                 max_c = 1
         except Exception:
-            max_c = 5
-
-        sem = asyncio.Semaphore(max_c)
-
-        async def run_one(tool_call: Dict[str, Any]) -> Dict[str, Any]:
-            tool_id = tool_call.get("id", "unknown")
-            function = tool_call.get("function", {})
-            tool_name = function.get("name")
-            arguments_str = function.get("arguments", "{}")
-
-            # 解析参数
-            try:
-                arguments = json.loads(arguments_str)
-            except json.JSONDecodeError:
-                return {
-                    "tool_call_id": tool_id,
-                    "role": "tool",
-                    "content": json.dumps({
-                        "error": True,
-                        "message": "参数解析失败：无效的JSON格式"
-                    }, ensure_ascii=False)
-                }
-
-            async with sem:
-                result = await self.execute_tool(tool_name, arguments, session_id=session_id)  # ✅ 传递session_id
+            max_c = 4
+        return max_c
+
+    def resource_semaphore(self, resource: str) -> asyncio.Semaphore:
+        """资源的并发闸门（跨批次、跨会话共享）"""
+        sem = self._resource_sems.get(resource)
+        if sem is None:
+            sem = asyncio.Semaphore(resource_limit(resource))
+            self._resource_sems[resource] = sem
+        return sem
+
+    def conflicts(self, first: Optional[str], second: Optional[str]) -> bool:
+        """同一批次中两个调用是否冲突（冲突的调用按提交顺序串行）
+
+        - 只读调用之间互不冲突
+        - 有副作用的调用与共享任一资源的调用冲突
+        - 有副作用且未声明资源的工具与所有调用冲突（未知副作用，保守处理）
+        - 未注册的工具直接返回错误，不参与调度
+        """
+        a, b = self.tools.get(first or ""), self.tools.get(second or "")
+        if a is None or b is None:
+            return False
+        if a.read_only and b.read_only:
+            return False
+        if (not a.read_only and not a.resources) or (not b.read_only and not b.resources):
+            return True
+        return bool(set(a.resources) & set(b.resources))
+
+    def create_dispatcher(self, session_id: str = "default") -> "ToolCallDispatcher":
+        """创建增量派发器：流式解析出一个tool_call就提交一个"""
+        return ToolCallDispatcher(self, session_id=session_id, max_concurrency=self._max_tool_concurrency())
+
+    async def run_tool_call(
+        self,
+        tool_call: Dict[str, Any],
+        session_id: str = "default",
+        sem: Optional[asyncio.Semaphore] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """执行单个OpenAI格式的tool_call，返回 role=tool 的消息"""
+        tool_id = tool_call.get("id", "unknown")
+        function = tool_call.get("function", {})
+        tool_name = function.get("name")
+        arguments_str = function.get("arguments", "{}")
 
+        # 解析参数
+        try:
+            arguments = json_codec.loads(arguments_str or "{}")
+        except json_codec.JSONDecodeError:
             return {
                 "tool_call_id": tool_id,
                 "role": "tool",
                 "name": tool_name,
-                "content": json.dumps(result, ensure_ascii=False)
+                "content": json_codec.dumps({
+                    "error": True,
+                    "message": "参数解析失败：无效的JSON格式"
+                })
             }
 
-        tasks = [run_one(tc) for tc in tool_calls]
-        return await asyncio.gather(*tasks)
+        # 用量账本归属：工具内部（如SubAgent）发起的LLM调用记到该工具名下
+        # 检查点：SubAgent 按 tool_call_id 记录/恢复自己的检查点
+        token = current_tool_call_id.set(tool_id)
+        try:
+            with usage_scope(tool=tool_name):
+                if sem is not None:
+                    async with sem:
+                        result = await self.execute_tool(tool_name, arguments, session_id=session_id, timeout=timeout)  # ✅ 传递session_id
+                else:
+                    result = await self.execute_tool(tool_name, arguments, session_id=session_id, timeout=timeout)
+        finally:
+            current_tool_call_id.reset(token)
+
+        return {
+            "tool_call_id": tool_id,
+            "role": "tool",
+            "name": tool_name,
+            "content": json_codec.dumps(result)
+        }
+
+    async def execute_tool_calls(
+        self, tool_calls: List[Dict[str, Any]], session_id: str = "default"  # ✅ 新增：session_id参数
+    ) -> List[Dict[str, Any]]:
+        """批量执行工具调用（按依赖关系并发）
+
+        - 互不冲突的调用并发执行，冲突的调用（如两个 browser_subagent）按顺序串行
+        - 通过 env `MAX_TOOL_CONCURRENCY` 配置单批次并发度（默认 4），各资源另有并发上限
+        - 返回顺序与传入的 tool_calls 顺序一致
+        - session_id: 会话ID，用于TODO隔离和SubAgent上下文传递
+        """
+        dispatcher = self.create_dispatcher(session_id=session_id)
+        return await dispatcher.results(tool_calls)
+
+
+class ResourceBusyError(Exception):
+    """资源名额不可用（被后台作业占用或等待超时）"""
+
+
+class ToolCallDispatcher:
+    """工具调用增量派发器
+
+    流式生成时，每个tool_call的参数一完整就 submit_early()，只读工具立即在后台开始执行；
+    模型还在输出后续调用时，前面的工具已经在跑。results() 按给定顺序收集结果，
+    stream() 按完成顺序逐个产出开始/完成事件（快的工具结果不必等慢的）。
+
+    - 提前派发只限只读工具：流式中断或最终消息没有采用该调用时 cancel() 无法撤销已产生的副作用，
+      有副作用的调用（及其后的所有调用，保持提交顺序）等完整回复确定后再由 results()/stream() 补交
+
+    - 依赖调度：提交时找出同批次中先前提交且与之冲突的调用（见 ToolManager.conflicts），
+      等它们结束后再执行；互不冲突的调用（如多个 tavily_search 与 list_todos）直接并发
+    - 资源闸门：执行前获取所用资源的并发名额（进程级，如 playwright 同时只允许 1 个）；
+      等待时间计入工具超时，资源被后台作业占用时直接返回“资源忙”
+    - 同一批次共享一个 Semaphore（MAX_TOOL_CONCURRENCY）
+    - 调用按位置对应而非按 id：results()/stream() 认领提前派发过的同一调用（id、函数名与参数一致），
+      其余调用在此补交，每个位置恰好执行一次
+    - cancel(): 放弃本批次（模型最终没有采用这些调用或循环异常退出时）
+    """
+
+    def __init__(self, manager: ToolManager, session_id: str = "default", max_concurrency: int = 1) -> None:
+        self.manager = manager
+        self.session_id = session_id
+        self._sem = asyncio.Semaphore(max_concurrency)
+        # 按提交顺序记录 (调用, 任务)；以提交序号区分调用，不依赖 tool_call id
+        # （LLM_STREAM=0 时 id 可能为空，个别兼容服务也会重复 id）
+        self._entries: List[Tuple[Dict[str, Any], asyncio.Task]] = []
+        # 开始/完成事件（提前派发阶段产生的事件先缓存，stream() 时再取出）
+        self._events: asyncio.Queue = asyncio.Queue()
+        # 已有调用被推迟到完整回复之后（此后的调用也不再提前派发）
+        self._deferred = False
+
+    @property
+    def submitted(self) -> int:
+        return len(self._entries)
+
+    def submit_early(self, tool_call: Dict[str, Any]) -> bool:
+        """流式阶段提前派发：只读工具立即提交，返回是否已提交"""
+        tool = self.manager.tools.get((tool_call.get("function") or {}).get("name") or "")
+        if self._deferred or tool is None or not tool.read_only:
+            self._deferred = True
+            return False
+        self.submit(tool_call)
+        return True
+
+    def submit(self, tool_call: Dict[str, Any]) -> int:
+        """提交一个调用，返回其提交序号"""
+        tool_name = (tool_call.get("function") or {}).get("name")
+        deps = [
+            task for tc, task in self._entries
+            if self.manager.conflicts((tc.get("function") or {}).get("name"), tool_name)
+        ]
+        slot = len(self._entries)
+        task = asyncio.create_task(self._run(slot, tool_call, tool_name, deps))
+        self._entries.append((tool_call, task))
+        return slot
+
+    async def _run(
+        self, slot: int, tool_call: Dict[str, Any], tool_name: Optional[str], deps: List[asyncio.Task]
+    ) -> Dict[str, Any]:
+        tool_id = tool_call.get("id", "unknown")
+        started: Optional[float] = None
+        result: Optional[Dict[str, Any]] = None
+        try:
+            # 先等冲突的前序调用结束（失败或被取消都算结束）
+            if deps:
+                await asyncio.wait(deps)
+            tool = self.manager.tools.get(tool_name or "")
+            timeout = self.manager.tool_timeout()
+            waiting = time.monotonic()
+            async with self.manager.resource_slots(tool, timeout if timeout > 0 else None), self._sem:
+                started = time.monotonic()
+                self._events.put_nowait({"event": "start", "slot": slot, "id": tool_id, "tool": tool_name})
+                # 等待资源的时间计入工具超时
+                remaining = max(1.0, timeout - (started - waiting)) if timeout > 0 else None
+                result = await self.manager.run_tool_call(tool_call, session_id=self.session_id, timeout=remaining)
+            return result
+        except ResourceBusyError as e:
+            result = {
+                "tool_call_id": tool_id,
+                "role": "tool",
+                "name": tool_name,
+                "content": json_codec.dumps({"error": True, "message": str(e), "data": None}),
+            }
+            return result
+        except Exception as e:
+            result = {
+                "tool_call_id": tool_id,
+                "role": "tool",
+                "name": tool_name,
+                "content": json_codec.dumps({"error": True, "message": f"工具执行异常: {e}"}),
+            }
+            return result
+        except asyncio.CancelledError:
+            result = {
+                "tool_call_id": tool_id,
+                "role": "tool",
+                "name": tool_name,
+                "content": json_codec.dumps({"error": True, "message": "工具调用已取消"}),
+            }
+            raise
+        finally:
+            self._events.put_nowait({
+                "event": "finish",
+                "slot": slot,
+                "id": tool_id,
+                "tool": tool_name,
+                "elapsed": round(time.monotonic() - started, 3) if started is not None else 0.0,
+                "result": result,
+            })
+
+    def _collect(self, tool_calls: List[Dict[str, Any]]) -> List[int]:
+        """为每个位置认领已提前派发的同一调用或补交，取消模型最终未采用的调用
+
+        返回与 tool_calls 一一对应的提交序号列表。
+        """
+        claimed: Set[int] = set()
+        slots: List[int] = []
+        early = len(self._entries)
+        for tc in tool_calls:
+            slot = next(
+                (
+                    i for i in range(early)
+                    if i not in claimed and same_tool_call(self._entries[i][0], tc)
+                ),
+                None,
+            )
+            if slot is None:
+                slot = self.submit(tc)
+            claimed.add(slot)
+            slots.append(slot)
+        for i in range(early):
+            if i not in claimed:
+                self._entries[i][1].cancel()
+        return slots
+
+    async def results(self, tool_calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """等待并按 tool_calls 的顺序返回结果；未提交过的调用在此补交"""
+        slots = self._collect(tool_calls)
+        return list(await asyncio.gather(*[self._entries[i][1] for i in slots]))
+
+    async def stream(self, tool_calls: List[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        """按发生顺序产出保留调用的进度事件，直到全部完成
+
+        事件：
+        - {"event": "start", "index", "id", "tool"}：开始执行（依赖与资源名额已就绪）
+        - {"event": "finish", "index", "id", "tool", "elapsed", "result"}：执行结束，result 为 role=tool 的消息
+        index 为该调用在 tool_calls 中的位置，调用方据此按模型给出的顺序写回记忆
+        （id 为空或重复时也一一对应）。
+        """
+        slots = self._collect(tool_calls)
+        index_of = {slot: i for i, slot in enumerate(slots)}
+        pending = set(slots)
+        while pending:
+            event = await self._events.get()
+            slot = event.pop("slot")
+            if slot not in index_of:
+                continue
+            if event["event"] == "finish":
+                if slot not in pending:
+                    continue
+                pending.discard(slot)
+            yield {**event, "index": index_of[slot]}
+
+    def cancel(self) -> None:
+        for _, task in self._entries:
+            if not task.done():
+                task.cancel()
 
 
 # 全局单例
@@ -21,6 +21,9 @@ class ReadReportTool(BaseTool):
     """读取SearchSubAgent报告工具"""
 
     name = "read_report"
+    read_only = True
+    resources = ("report_store",)
+    cache_ttl = 600
     description = """读取SearchSubAgent生成的完整报告。
 
 SubAgent执行完成后会返回report_id，使用此工具可查看完整的搜索结果、TODO执行记录和关键发现。
@@ -106,6 +109,9 @@ class ListReportsTool(BaseTool):
     """列出最近的报告工具"""
 
     name = "list_reports"
+    read_only = True
+    resources = ("report_store",)
+    cache_ttl = 60
     description = """列出最近的SearchSubAgent报告。
 
 查看最近执行的搜索任务报告列表，可以获取report_id用于读取详细内容。
@@ -187,6 +193,8 @@ class DeleteReportTool(BaseTool):
     """删除报告工具"""
 
     name = "delete_report"
+    read_only = False
+    resources = ("report_store",)
     description = """删除指定的SearchSubAgent报告。
 
 用于清理不需要的报告文件。
@@ -0,0 +1,201 @@
+"""
+工具结果缓存（会话内记忆化）
+
+目标：
+- 模型在同一会话/SubAgent 中经常以相同参数重复调用 tavily_search、read_report 等工具，
+  重复调用只增加延迟、消耗 Tavily 额度；无副作用的工具在 TTL 内直接返回缓存结果
+- 只缓存声明了 cache_ttl 的工具（见 BaseTool.cache_ttl），执行失败的结果不缓存
+- 键：session_id + 工具名 + 规范化参数（键排序、去除 _timeout/session_id 等内部参数与 None 值、
+  字符串去首尾空白），主循环与该会话内 SubAgent 的调用共享
+- 失效：有副作用（read_only=False）的工具执行后，清除该会话中共享任一资源的缓存
+  （如 delete_report / search_subagent 之后 list_reports、read_report 重新执行）；
+  未声明 cache_ttl 的只读工具（如 view_image、list_todos）既不缓存也不触发失效
+- 按编码后结果的总字节数 LRU 淘汰；命中时返回解码出的新对象，调用方修改结果不影响缓存
+
+环境变量：
+- TOOL_CACHE_ENABLED: 1 启用（默认）/ 0 关闭
+- TOOL_CACHE_MB: 缓存结果总字节上限（MB），默认 32
+- TOOL_CACHE_TTL_<工具名大写>: 覆盖单个工具的 TTL（秒），0 表示不缓存，如 TOOL_CACHE_TTL_TAVILY_SEARCH=300
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from core import json_codec
+
+logger = logging.getLogger(__name__)
+
+# 不参与缓存键的参数（执行控制或由调用方自动注入）
+_IGNORED_ARGS = ("session_id",)
+
+
+def _canonical(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {
+            k: _canonical(v) for k, v in value.items()
+            if v is not None and not k.startswith("_") and k not in _IGNORED_ARGS
+        }
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def canonical_arguments(arguments: Dict[str, Any]) -> str:
+    """参数的规范化表示（键排序），语义相同的参数得到相同的键"""
+    return json.dumps(_canonical(arguments), sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def tool_cache_ttl(tool: Any) -> float:
+    """工具的缓存 TTL（秒）：环境变量优先，其次工具声明的 cache_ttl；0 表示不缓存"""
+    default = float(getattr(tool, "cache_ttl", 0) or 0)
+    name = getattr(tool, "name", "") or ""
+    try:
+        return max(0.0, float(os.getenv(f"TOOL_CACHE_TTL_{name.upper()}", str(default))))
+    except Exception:
+        return default
+
+
+class ToolResultCache:
+    """(session_id, 工具名, 规范化参数) -> 编码后的工具结果，按总字节数 LRU 淘汰"""
+
+    def __init__(self, max_bytes: Optional[int] = None) -> None:
+        if max_bytes is None:
+            try:
+                max_bytes = int(float(os.getenv("TOOL_CACHE_MB", "32")) * 1024 * 1024)
+            except Exception:
+                max_bytes = 32 * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.enabled = os.getenv("TOOL_CACHE_ENABLED", "1") == "1"
+        # key -> (过期时间, 资源, 编码后的结果)
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[float, Tuple[str, ...], bytes]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._per_tool: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, tool_name: str, field: str) -> None:
+        stats = self._per_tool.setdefault(tool_name, {"hits": 0, "misses": 0})
+        stats[field] += 1
+
+    def key(self, session_id: str, tool_name: str, arguments: Dict[str, Any]) -> Tuple[str, str, str]:
+        return (session_id or "default", tool_name, canonical_arguments(arguments))
+
+    def get(self, key: Tuple[str, str, str]) -> Optional[Dict[str, Any]]:
+        """命中时返回结果的新副本；未命中或已过期返回 None"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self._drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            self._count(key[1], "misses")
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self._count(key[1], "hits")
+        logger.info(f"♻️ 工具结果缓存命中: {key[1]} ({len(entry[2])} 字节)")
+        return json_codec.loads(entry[2])
+
+    def put(self, key: Tuple[str, str, str], result: Any, ttl: float, resources: Iterable[str] = ()) -> None:
+        if ttl <= 0 or not isinstance(result, dict) or result.get("error"):
+            return
+        try:
+            data = json_codec.dumps_bytes(result)
+        except Exception:
+            return
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.monotonic() + ttl, tuple(resources), data)
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, session_id: str, resources: Iterable[str]) -> int:
+        """清除该会话中使用任一资源的缓存（有副作用的工具执行后调用），返回清除条数"""
+        resources = set(resources)
+        if not resources:
+            return 0
+        session_id = session_id or "default"
+        stale = [k for k, v in self._entries.items() if k[0] == session_id and resources & set(v[1])]
+        for key in stale:
+            self._drop(key)
+        self.invalidations += len(stale)
+        return len(stale)
+
+    def invalidate_all(self, resources: Iterable[str]) -> int:
+        """清除所有会话中使用任一资源的缓存（会话之外修改了共享存储时调用，如上传文件）"""
+        resources = set(resources)
+        stale = [k for k, v in self._entries.items() if resources & set(v[1])]
+        for key in stale:
+            self._drop(key)
+        self.invalidations += len(stale)
+        return len(stale)
+
+    def _drop(self, key: Tuple[str, str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[2])
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "tools": self._per_tool,
+        }
+
+
+# 单例，便于全局使用
+tool_result_cache = ToolResultCache()
+
+
+async def execute_cached(
+    tool: Any,
+    session_id: str,
+    arguments: Dict[str, Any],
+    run: Callable[[], Awaitable[Dict[str, Any]]],
+) -> Dict[str, Any]:
+    """带缓存执行工具：声明了 cache_ttl 的工具先查缓存，有副作用的工具执行后清除同资源的缓存
+
+    Args:
+        tool: 工具实例（BaseTool）
+        session_id: 会话ID（缓存按会话隔离）
+        arguments: 工具参数
+        run: 无参协程函数，实际执行工具
+    """
+    cache = tool_result_cache
+    if not cache.enabled:
+        return await run()
+    ttl = tool_cache_ttl(tool)
+    resources = tuple(getattr(tool, "resources", ()) or ())
+    if ttl <= 0:
+        result = await run()
+        if not getattr(tool, "read_only", False):
+            cache.invalidate(session_id, resources)
+        return result
+    key = cache.key(session_id, getattr(tool, "name", ""), arguments)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    result = await run()
+    cache.put(key, result, ttl, resources)
+    return result
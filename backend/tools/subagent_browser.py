@@ -302,6 +302,8 @@ class BrowserSubAgentTool(BaseTool):
     """BrowserSubAgent 调用工具（主 Agent 侧用）"""
 
     name = "browser_subagent"
+    read_only = False
+    resources = ("playwright", "desktop", "todo_store")
     description = """网页交互自动化（视觉坐标 + Playwright有头；复杂任务支持 TODO 与选择器优先）。"""
 
     async def execute(
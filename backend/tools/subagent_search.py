@@ -230,6 +230,11 @@ class SearchSubAgentTool(BaseTool):
     """
 
     name = "search_subagent"
+    # 写 TODO 与研究报告（保存后会清除同会话 read_report 等结果缓存），并占用 Tavily 配额
+    read_only = False
+    resources = ("tavily", "report_store", "todo_store")
+    # 运行可达数分钟：不整段占用名额，内部每次 Tavily 检索各自获取 tavily 名额
+    hold_resources = False
     description = """【必须使用】学术论文/技术文档全面收集。
 
 ✅ 必须使用场景：
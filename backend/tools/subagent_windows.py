@@ -121,6 +121,8 @@ class WindowsSubAgentTool(BaseTool):
     """
 
     name = "windows_subagent"
+    read_only = False
+    resources = ("desktop", "todo_store")
     description = """Windows应用操作和进程管理。
 
 ✅ 适用场景：
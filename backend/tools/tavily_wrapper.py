@@ -71,6 +71,9 @@ class TavilySearchTool(BaseTool):
     """
 
     name = "tavily_search"
+    read_only = True
+    resources = ("tavily",)
+    cache_ttl = 600
     description = "实时网页搜索，支持论文搜索（指定域名）、新闻搜索（时间过滤）、深度搜索。"
 
     def __init__(self) -> None:
@@ -252,6 +255,9 @@ class TavilyExtractTool(BaseTool):
     """
 
     name = "tavily_extract"
+    read_only = True
+    resources = ("tavily",)
+    cache_ttl = 1800
     description = "从URL列表提取主要内容（Markdown格式），支持表格提取。"
 
     def __init__(self) -> None:
@@ -365,6 +371,9 @@ class TavilyMapTool(BaseTool):
     """
 
     name = "tavily_map"
+    read_only = True
+    resources = ("tavily",)
+    cache_ttl = 1800
     description = "映射网站结构，返回所有页面URL列表。Beta功能。"
 
     def __init__(self) -> None:
@@ -445,6 +454,9 @@ class TavilyCrawlTool(BaseTool):
     """
 
     name = "tavily_crawl"
+    read_only = True
+    resources = ("tavily",)
+    cache_ttl = 1800
     description = "爬取网站并提取内容（Map + Extract 组合）。Beta功能。"
 
     def __init__(self) -> None:
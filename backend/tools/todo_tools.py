@@ -17,6 +17,8 @@ class TodoListTool(BaseTool):
     """列出所有待办任务"""
 
     name = "list_todos"
+    read_only = True
+    resources = ("todo_store",)
     description = "列出所有待办任务。返回任务列表，包含每个任务的id、标题、描述、状态和创建时间。"
 
     async def execute(self, session_id: str = "default") -> Dict[str, Any]:
@@ -37,6 +39,8 @@ class TodoCreateTool(BaseTool):
     """创建新的待办任务"""
 
     name = "create_todo"
+    read_only = False
+    resources = ("todo_store",)
     description = "创建新的待办任务。需要提供任务标题，可选提供描述和状态。"
 
     async def execute(
@@ -94,6 +98,8 @@ class TodoUpdateTool(BaseTool):
     """更新待办任务"""
 
     name = "update_todo"
+    read_only = False
+    resources = ("todo_store",)
     description = "更新待办任务的信息。需要提供任务ID，可以更新标题、描述或状态。"
 
     async def execute(
@@ -149,6 +155,8 @@ class TodoDeleteTool(BaseTool):
     """删除待办任务"""
 
     name = "delete_todo"
+    read_only = False
+    resources = ("todo_store",)
     description = "删除指定的待办任务。需要提供任务ID。"
 
     async def execute(self, todo_id: str, session_id: str = "default") -> Dict[str, Any]:
@@ -175,6 +183,8 @@ class TodoReorderTool(BaseTool):
     """重排待办任务顺序"""
 
     name = "reorder_todos"
+    read_only = False
+    resources = ("todo_store",)
     description = "根据提供的任务ID顺序，重排ToDo列表的顺序。需要提供任务ID数组，数组顺序即新的顺序。"
 
     async def execute(self, order: List[str], session_id: str = "default") -> Dict[str, Any]:
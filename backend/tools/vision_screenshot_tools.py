@@ -60,6 +60,9 @@ class ScreenshotTool(BaseTool):
     - 工作流3：screenshot多次截图 → 模型对比前后变化
     """
     name = "screenshot"
+    # 截图写入 file_store（save_upload）：与文件写入/清理按顺序执行，并使文件列表缓存失效
+    read_only = False
+    resources = ("desktop", "file_store")
     description = """截取屏幕并保存到file_store，返回file_id供模型查看和复用。
 
     核心优势：
@@ -272,6 +275,8 @@ class ScreenshotAndAnalyzeTool(BaseTool):
     - 适用于快速查看屏幕内容的场景
     """
     name = "screenshot_and_analyze"
+    read_only = False
+    resources = ("desktop", "file_store")
     description = """截取屏幕并立即让模型分析内容。一步完成截图+分析。
 
     使用场景：
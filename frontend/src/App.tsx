@@ -5,8 +5,8 @@ import { Sidebar } from './components/Sidebar'
 import { MessageItem } from './components/MessageItem'
 import { ChatInput } from './components/ChatInput'
 import { TodoList } from './components/TodoList'
-import { streamChat, extractPreferences, generateTitle, fetchTodos, updateTodoStatus, subscribeTodoStream } from './services/api'
-import { Message, Todo } from './types'
+import { streamChat, cancelChat, extractPreferences, generateTitle, fetchTodos, updateTodoStatus, subscribeTodoStream, subscribeJobStream, cancelJob } from './services/api'
+import { JobEvent, Message, SubAgentJob, Todo, ToolProgress, ToolResult } from './types'
 import { AlertCircle } from 'lucide-react'
 
 function App() {
@@ -28,6 +28,8 @@ function App() {
 
   const messagesEndRef = useRef<HTMLDivElement>(null)
   const [error, setError] = useState<string | null>(null)
+  const [toolProgress, setToolProgress] = useState<Record<string, ToolProgress>>({})
+  const [jobs, setJobs] = useState<Record<string, SubAgentJob>>({})
   const abortControllerRef = useRef<AbortController | null>(null)
 
   // 初始化：确保有一个对话
@@ -80,6 +82,35 @@ function App() {
     return () => sub.close()
   }, [currentConversationId])
 
+  // SSE订阅：后台SubAgent作业进度（状态、迭代轮次、当前工具）
+  useEffect(() => {
+    setJobs({})
+    if (!currentConversationId) return
+    const sessionId = currentConversationId
+    const sub = subscribeJobStream(sessionId, (event: JobEvent) => {
+      if (event.type === 'jobs') {
+        setJobs(Object.fromEntries(event.jobs.map((job) => [job.job_id, job])))
+        return
+      }
+      if (event.type === 'done') {
+        // 作业结束后刷新TODO（SubAgent内部已持久化）
+        fetchTodos(sessionId).then(setTodos).catch(() => {})
+      }
+      setJobs((prev) => {
+        const job = prev[event.job_id]
+        if (!job) return prev
+        const next = { ...job }
+        if (event.type === 'status') next.status = event.status
+        else if (event.type === 'iteration') next.iteration = event.iteration
+        else if (event.type === 'tool') next.current_tool = event.status === 'running' ? event.tool : null
+        // 回执晚于 running 状态事件到达时，据进度事件补正状态
+        if ((event.type === 'iteration' || event.type === 'tool') && next.status === 'queued') next.status = 'running'
+        return { ...prev, [event.job_id]: next }
+      })
+    })
+    return () => sub.close()
+  }, [currentConversationId])
+
   // 发送消息
   const handleSendMessage = async (text: string, files?: File[]) => {
     if (!text.trim() && (!files || files.length === 0)) return
@@ -127,9 +158,13 @@ function App() {
           // 文本内容,累加到助手消息
           accumulatedContent += chunk.content
           updateMessage(assistantId, accumulatedContent)
+        } else if (chunk.type === 'progress' && chunk.data) {
+          // 工具执行进度：按调用id更新状态
+          const progress = chunk.data as ToolProgress
+          setToolProgress((prev) => ({ ...prev, [progress.call_id]: progress }))
         } else if (chunk.type === 'tool' && chunk.data) {
           // 工具调用结果
-          const toolResult = chunk.data
+          const toolResult = chunk.data as ToolResult
           const toolName = toolResult.tool
 
           // 统一处理：只要返回 data.todos 就整体刷新
@@ -157,6 +192,12 @@ function App() {
             }
           }
 
+          // 后台作业回执：先加入作业列表，之后由作业进度流更新
+          const job = toolResult.data?.job as SubAgentJob | undefined
+          if (job?.job_id) {
+            setJobs((prev) => (prev[job.job_id] ? prev : { ...prev, [job.job_id]: job }))
+          }
+
           // 子代理执行结束后，主动刷新当前会话的TODO（SubAgent内部已持久化）
           if (toolName.endsWith('_subagent') && currentConversationId) {
             try {
@@ -199,6 +240,7 @@ function App() {
       }
     } finally {
       setLoading(false)
+      setToolProgress({})
       abortControllerRef.current = null
     }
   }
@@ -206,6 +248,10 @@ function App() {
   // 中断当前请求
   const handleAbort = () => {
     if (abortControllerRef.current) {
+      // 先通知后端停止本轮（在途的LLM请求、工具与SubAgent一并取消），再断开流
+      if (currentConversationId) {
+        cancelChat(currentConversationId).catch(() => {})
+      }
       abortControllerRef.current.abort()
     }
   }
@@ -293,6 +339,49 @@ function App() {
             />
           ))}
 
+          {/* 工具执行进度 */}
+          {Object.keys(toolProgress).length > 0 && (
+            <div className="mb-4 flex flex-wrap gap-2 text-xs opacity-80">
+              {Object.values(toolProgress)
+                .sort((a, b) => a.index - b.index)
+                .map((p) => (
+                  <span
+                    key={p.call_id}
+                    className="px-2 py-1 rounded bg-primary-100/60 dark:bg-gray-700/60"
+                  >
+                    {p.status === 'running' ? '⏳' : p.status === 'error' ? '❌' : '✓'} {p.tool}
+                    {p.elapsed !== undefined && p.status !== 'running' ? ` ${p.elapsed.toFixed(1)}s` : ''}
+                  </span>
+                ))}
+            </div>
+          )}
+
+          {/* 后台SubAgent作业 */}
+          {Object.values(jobs).some((j) => j.status === 'queued' || j.status === 'running') && (
+            <div className="mb-4 flex flex-wrap gap-2 text-xs opacity-80">
+              {Object.values(jobs)
+                .filter((j) => j.status === 'queued' || j.status === 'running')
+                .sort((a, b) => a.created_at - b.created_at)
+                .map((j) => (
+                  <span
+                    key={j.job_id}
+                    className="px-2 py-1 rounded bg-primary-100/60 dark:bg-gray-700/60"
+                    title={j.task}
+                  >
+                    {j.status === 'queued' ? '🕒' : '🛰️'} {j.tool}
+                    {j.status === 'running' ? ` · 第${j.iteration}轮` : ' · 排队中'}
+                    {j.current_tool ? ` · ${j.current_tool}` : ''}
+                    <button
+                      className="ml-2 opacity-60 hover:opacity-100"
+                      onClick={() => cancelJob(j.job_id).catch(() => {})}
+                    >
+                      ✕
+                    </button>
+                  </span>
+                ))}
+            </div>
+          )}
+
           {/* 错误提示 */}
           {error && (
             <div className="mb-4 p-4 bg-red-500/10 border border-red-500/20 rounded-lg flex items-center gap-3 text-red-600 dark:text-red-400">
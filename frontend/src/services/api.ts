@@ -1,8 +1,36 @@
-import { Message, ToolResult, MetaInfo, Todo } from '../types'
+import { Message, ToolResult, ToolProgress, MetaInfo, Todo, ChatEvent, JobEvent } from '../types'
 import { config } from '../config'
 
 const API_BASE_URL = config.apiBaseUrl
 
+// 历史同步：记录每个会话服务端已持有的历史版本（history_hash）及其覆盖的前端消息条数，
+// 版本一致时只需发送增量消息
+interface HistorySync {
+  hash: string
+  count: number
+}
+
+const HISTORY_SYNC_KEY = 'nanami-history-sync'
+
+// 事件流中断后的最大续传次数（退避 0.5s、1s、2s…）
+const MAX_STREAM_RETRIES = 5
+
+const loadHistorySync = (): Record<string, HistorySync> => {
+  try {
+    return JSON.parse(localStorage.getItem(HISTORY_SYNC_KEY) || '{}')
+  } catch {
+    return {}
+  }
+}
+
+const historySync: Record<string, HistorySync> = loadHistorySync()
+
+const saveHistorySync = () => {
+  try {
+    localStorage.setItem(HISTORY_SYNC_KEY, JSON.stringify(historySync))
+  } catch {}
+}
+
 // 流式聊天接口
 export async function* streamChat(
   input: string,
@@ -11,94 +39,224 @@ export async function* streamChat(
   sessionId?: string,  // 会话ID，用于后端TODO和记忆隔离
   signal?: AbortSignal
 ): AsyncGenerator<{
-  type: 'text' | 'tool' | 'meta'
+  type: 'text' | 'tool' | 'meta' | 'progress'
   content: string
-  data?: ToolResult | MetaInfo
+  data?: ToolResult | ToolProgress | MetaInfo
 }> {
-  const formData = new FormData()
-  formData.append('input', input)
+  const history = historyMessages || []
 
-  // 传递会话ID（核心修改：实现对话窗口级别的session持久化）
-  if (sessionId) {
-    formData.append('session_id', sessionId)
-  }
+  const buildForm = (sync?: HistorySync) => {
+    const formData = new FormData()
+    formData.append('input', input)
+    // 结构化事件流（NDJSON，协议见后端 core/chat_protocol.py）
+    formData.append('stream_format', 'ndjson')
 
-  if (files && files.length > 0) {
-    files.forEach((file) => {
-      formData.append('files', file)
-    })
-  }
+    // 传递会话ID（核心修改：实现对话窗口级别的session持久化）
+    if (sessionId) {
+      formData.append('session_id', sessionId)
+    }
+
+    if (files && files.length > 0) {
+      files.forEach((file) => {
+        formData.append('files', file)
+      })
+    }
 
-  // 发送历史消息（最近10轮对话，避免上下文过长）
-  if (historyMessages && historyMessages.length > 0) {
-    // 只取最近20条消息（10轮对话）
-    const recentMessages = historyMessages.slice(-20).map(msg => ({
-      role: msg.role,
-      content: msg.content
-    }))
-    formData.append('messages', JSON.stringify(recentMessages))
+    // 服务端已持有历史：只发送其后新增的消息；否则发送最近20条消息（10轮对话，避免上下文过长）
+    const outgoing = sync ? history.slice(sync.count) : history.slice(-20)
+    if (sync) {
+      formData.append('history_hash', sync.hash)
+    }
+    if (outgoing.length > 0) {
+      const recentMessages = outgoing.map(msg => ({
+        role: msg.role,
+        content: msg.content
+      }))
+      formData.append('messages', JSON.stringify(recentMessages))
+    }
+    return formData
   }
 
-  const response = await fetch(`${API_BASE_URL}/chat`, {
+  const post = (sync?: HistorySync) => fetch(`${API_BASE_URL}/chat`, {
     method: 'POST',
-    body: formData,
+    body: buildForm(sync),
     signal: signal
   })
 
+  const sync = sessionId ? historySync[sessionId] : undefined
+  const canSync = !!sync && sync.count <= history.length
+  let response = await post(canSync ? sync : undefined)
+
+  // 409：服务端历史版本不一致（服务重启后磁盘版本不同、上一轮被中断等），改为发送完整历史
+  if (response.status === 409 && canSync && sessionId) {
+    delete historySync[sessionId]
+    saveHistorySync()
+    response = await post()
+  }
+
   if (!response.ok) {
     throw new Error(`HTTP ${response.status}: ${response.statusText}`)
   }
 
-  const reader = response.body!.getReader()
-  const decoder = new TextDecoder()
+  // 可续传：记录运行ID与最后收到的事件编号，连接中断时从该编号续传（服务端运行不受影响）
+  let runId = response.headers.get('X-Run-Id') || ''
+  let lastEventId = 0
+  let finished = false
+  let retries = 0
+  // 取得会话锁时历史已被另一轮推进（history_mismatch）：与 409 相同，改为发送完整历史重试一次
+  let resyncRetried = false
+  let resync = false
 
-  try {
-    while (true) {
-      const { done, value } = await reader.read()
-      if (done) break
+  while (true) {
+    const reader = response.body!.getReader()
+    const decoder = new TextDecoder()
+    let buffer = ''
+
+    try {
+      read: while (true) {
+        const { done, value } = await reader.read()
+        if (done) break
 
-      const chunk = decoder.decode(value, { stream: true })
+        // NDJSON：每行一个事件，最后一行可能不完整，留到下一块数据
+        buffer += decoder.decode(value, { stream: true })
+        const lines = buffer.split('\n')
+        buffer = lines.pop() || ''
 
-      // 解析不同类型的消息
-      if (chunk.includes('[meta]')) {
-        // 元信息
-        const match = chunk.match(/\[meta\]\s*(.+)/)
-        if (match) {
+        for (const line of lines) {
+          if (!line.trim()) continue
+          let event: ChatEvent & { id?: number }
           try {
-            const meta = JSON.parse(match[1].replace(/'/g, '"'))
-            yield { type: 'meta', content: chunk, data: meta }
+            event = JSON.parse(line)
           } catch {
-            yield { type: 'meta', content: chunk }
+            continue
           }
-        }
-      } else if (chunk.includes('[🔧')) {
-        // 工具调用通知
-        yield { type: 'tool', content: chunk }
-      } else if (chunk.includes('[✓')) {
-        // 工具执行结果
-        const match = chunk.match(/\[✓\s+(\w+)\]:\s*(.+)/)
-        if (match) {
-          try {
-            const toolResult: ToolResult = {
-              tool: match[1],
-              error: false,
-              data: JSON.parse(match[2]),
+          if (event.id !== undefined) {
+            if (event.id <= lastEventId) continue  // 续传时服务端不会重复发送，这里仅作防护
+            lastEventId = event.id
+          }
+          retries = 0
+
+          switch (event.type) {
+            case 'start':
+              runId = event.run_id || runId
+              break
+            case 'content':
+              yield { type: 'text', content: event.delta }
+              break
+            case 'meta':
+              if (event.data?.history_sync && sessionId) {
+                // 本轮完成：服务端历史覆盖到本轮的用户消息与助手回复
+                historySync[sessionId] = { hash: event.data.history_sync.hash, count: history.length + 2 }
+                saveHistorySync()
+              }
+              yield { type: 'meta', content: line, data: event.data }
+              break
+            case 'usage':
+              yield { type: 'meta', content: line, data: { usage: event } }
+              break
+            case 'tool_progress':
+              yield { type: 'progress', content: line, data: event as ToolProgress }
+              break
+            case 'tool_call':
+              yield { type: 'tool', content: event.message }
+              break
+            case 'tool_result': {
+              // 大型结果以 file_id 引用发送，需要时通过 fetchFile 获取完整内容
+              const toolResult: ToolResult = {
+                tool: event.tool,
+                error: event.error,
+                data: event.result,
+                file_id: event.file_id,
+                preview: event.preview,
+              }
+              yield { type: 'tool', content: line, data: toolResult }
+              break
             }
-            yield { type: 'tool', content: chunk, data: toolResult }
-          } catch {
-            yield { type: 'tool', content: chunk }
+            case 'cancelled':
+              yield { type: 'text', content: '\n\n⏹️ 已停止\n' }
+              break
+            case 'error':
+              if (event.code === 'history_mismatch' && canSync && !resyncRetried) {
+                resync = true
+                resyncRetried = true
+                break read
+              }
+              yield { type: 'text', content: `\n\n❌ ${event.message}\n` }
+              break
+            case 'done':
+              finished = true
+              break
           }
         }
-      } else if (chunk.trim()) {
-        // 文本内容
-        yield { type: 'text', content: chunk }
       }
+    } catch (err) {
+      // 用户主动中断直接抛出；网络中断则在下面尝试续传
+      if (signal?.aborted || !runId) throw err
+    } finally {
+      reader.releaseLock()
+    }
+
+    if (signal?.aborted) return
+    if (resync && sessionId) {
+      resync = false
+      await response.body?.cancel().catch(() => {})
+      delete historySync[sessionId]
+      saveHistorySync()
+      response = await post()
+      if (!response.ok) {
+        throw new Error(`HTTP ${response.status}: ${response.statusText}`)
+      }
+      runId = response.headers.get('X-Run-Id') || ''
+      lastEventId = 0
+      retries = 0
+      continue
+    }
+    if (finished) return
+
+    // 连接在运行结束前中断：退避后从最后收到的事件编号续传
+    let resumed: Response | null = null
+    while (!resumed) {
+      if (!runId || retries >= MAX_STREAM_RETRIES) {
+        throw new Error('连接已中断，且无法续传')
+      }
+      retries += 1
+      await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** (retries - 1)))
+      try {
+        resumed = await fetch(
+          `${API_BASE_URL}/chat/runs/${encodeURIComponent(runId)}/events?after=${lastEventId}&stream_format=ndjson`,
+          { signal }
+        )
+      } catch (err) {
+        if (signal?.aborted) throw err
+      }
+    }
+    response = resumed
+    if (response.status === 404) {
+      throw new Error('连接已中断，服务端运行已过期')
+    }
+    if (!response.ok) {
+      throw new Error(`HTTP ${response.status}: ${response.statusText}`)
     }
-  } finally {
-    reader.releaseLock()
   }
 }
 
+// 按 file_id 获取缓存文件内容（如事件流中以引用发送的大型工具结果）
+export async function fetchFile(fileId: string): Promise<string> {
+  const res = await fetch(`${API_BASE_URL}/files/${encodeURIComponent(fileId)}`)
+  if (!res.ok) throw new Error(`HTTP ${res.status}`)
+  return await res.text()
+}
+
+// 停止指定会话正在执行的对话轮次
+export async function cancelChat(sessionId: string): Promise<number> {
+  const res = await fetch(`${API_BASE_URL}/chat/${encodeURIComponent(sessionId)}/cancel`, {
+    method: 'POST'
+  })
+  if (!res.ok) throw new Error(`HTTP ${res.status}`)
+  const data = await res.json()
+  return data.cancelled as number
+}
+
 // 列出指定会话的TODO列表
 export async function fetchTodos(sessionId: string): Promise<Todo[]> {
   const res = await fetch(`${API_BASE_URL}/todos?session_id=${encodeURIComponent(sessionId)}`)
@@ -139,6 +297,47 @@ export function subscribeTodoStream(
   }
 }
 
+// 订阅指定会话的后台SubAgent作业进度（SSE：先收到 jobs 快照，之后为各作业的事件）
+export function subscribeJobStream(
+  sessionId: string,
+  onEvent: (event: JobEvent) => void
+) {
+  const url = `${API_BASE_URL}/jobs/stream?session_id=${encodeURIComponent(sessionId)}&stream_format=sse`
+  let es: EventSource | null = null
+  try {
+    es = new EventSource(url)
+
+    const handle = (dataText: string) => {
+      try {
+        onEvent(JSON.parse(dataText) as JobEvent)
+      } catch {}
+    }
+
+    for (const type of ['jobs', 'status', 'iteration', 'tool', 'todo', 'result', 'done']) {
+      es.addEventListener(type, (ev: MessageEvent) => handle(ev.data))
+    }
+    es.onerror = () => {
+      // EventSource 会自动重连，重连后以 jobs 快照为准
+    }
+  } catch {
+    // 忽略，作业结果仍可由 subagent_job 工具取回
+  }
+
+  return {
+    close: () => { try { es?.close() } catch {} }
+  }
+}
+
+// 取消后台SubAgent作业
+export async function cancelJob(jobId: string): Promise<boolean> {
+  const res = await fetch(`${API_BASE_URL}/jobs/${encodeURIComponent(jobId)}/cancel`, {
+    method: 'POST'
+  })
+  if (!res.ok) throw new Error(`HTTP ${res.status}`)
+  const data = await res.json()
+  return data.cancelled as boolean
+}
+
 // 更新指定TODO状态/内容（最常见：标记完成）
 export async function updateTodoStatus(
   todoId: string,
@@ -32,8 +32,46 @@ export interface ToolResult {
   tool: string
   error: boolean
   data: any
+  // 大型结果以引用发送：data 为空，完整内容通过 file_id 获取
+  file_id?: string
+  preview?: string
 }
 
+// 工具执行进度（每个工具开始/完成时推送）
+export interface ToolProgress {
+  call_id: string
+  tool: string
+  index: number
+  status: 'running' | 'done' | 'error'
+  elapsed?: number
+}
+
+// 后台 SubAgent 作业（*_subagent 以 background=true 调用时提交）
+export interface SubAgentJob {
+  job_id: string
+  session_id: string
+  tool: string
+  task: string
+  status: 'queued' | 'running' | 'done' | 'error' | 'cancelled'
+  iteration: number
+  current_tool: string | null
+  created_at: number
+  started_at: number | null
+  finished_at: number | null
+  elapsed: number
+  last_event_id: number
+}
+
+// 后台作业进度事件（GET /jobs/stream；jobs 为连接时的快照，其余事件带 job_id）
+export type JobEvent =
+  | { type: 'jobs'; jobs: SubAgentJob[] }
+  | { type: 'status'; job_id: string; status: SubAgentJob['status'] }
+  | { type: 'iteration'; job_id: string; iteration: number }
+  | { type: 'tool'; job_id: string; tool: string; status: 'running' | 'done' | 'error'; elapsed?: number }
+  | { type: 'todo'; job_id: string; index?: number; title?: string; status?: string; todos?: { title: string; status: string }[] }
+  | { type: 'result'; job_id: string; error: boolean; summary?: string; message?: string }
+  | { type: 'done'; job_id: string }
+
 // 主题类型
 export type Theme = 'light' | 'dark'
 
@@ -41,14 +79,42 @@ export type Theme = 'light' | 'dark'
 export interface MetaInfo {
   compact?: {
     compacted: boolean
+    masked?: number
     tokens: number
     threshold: number
+    background?: boolean
   }
   ltm_saved?: boolean
   path?: string
   kind?: string
+  history_sync?: {
+    hash: string
+  }
+  usage?: {
+    prompt_tokens: number
+    cached_tokens: number
+    completion_tokens: number
+  }
+  resumed?: {
+    iteration: number
+    restored: number
+    pending_tool_calls: number
+  }
 }
 
+// /chat 结构化事件流（NDJSON，协议版本 1；每个事件带递增的 id，用于断线续传）
+export type ChatEvent =
+  | { type: 'start'; v: number; session_id?: string; run_id?: string }
+  | { type: 'content'; delta: string }
+  | { type: 'tool_call'; message: string }
+  | ({ type: 'tool_progress' } & ToolProgress)
+  | { type: 'tool_result'; tool: string; error: boolean; size: number; result?: any; file_id?: string; preview?: string }
+  | { type: 'meta'; data: MetaInfo }
+  | { type: 'usage'; prompt_tokens: number; cached_tokens: number; completion_tokens: number }
+  | { type: 'cancelled'; reason: string }
+  | { type: 'error'; message: string; code?: string }
+  | { type: 'done' }
+
 // 全局窗口类型扩展(Electron API)
 declare global {
   interface Window {